@@ -1,14 +1,18 @@
 # GodLocal API Backend v18.0 — Full OASIS Agent
 # Tools: Telegram · Twitter/X · GitHub · Instagram · Web · Crypto · Memory
 # WebSocket: /ws/oasis /ws/deep
-# REST: /health /ping /memory /profile /market /v2/council
+# REST: /health /ping /memory /profile /market /v2/council /models/health /scheduler /cache/stats /ws/stats /metrics /admin/profile
 
-import os, sys, time, json, threading, asyncio, logging, uuid, base64
+import os, re, sys, math, time, json, threading, asyncio, logging, uuid, base64
+import concurrent.futures, functools, hashlib, io, unicodedata
 import requests
+import httpx
+from collections import OrderedDict, deque
 from datetime import datetime
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+import metrics, tracing, state
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("godlocal")
@@ -20,6 +24,7 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], all
 
 GROQ_KEY    = os.environ.get("GROQ_API_KEY", "")
 SERPER_KEY  = os.environ.get("SERPER_API_KEY", "")
+SERPER_URL  = os.environ.get("SERPER_URL", "https://google.serper.dev/search")
 TG_TOKEN    = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 TG_CHAT     = os.environ.get("TELEGRAM_CHAT_ID", "")  # default channel
 
@@ -191,103 +196,1388 @@ SYSTEM_PROMPT = """# SYSTEM PROMPT v20.0 — OASIS Strategic Advisor
 - 💰 `crypto_price` — курсы
 - 🧠 `remember` — сохранять решения и договорённости в память
 
-Дата: {date}
 Дата: {date}"""
 
 # ── Memory ─────────────────────────────────────────────────────────────────────
+# Per-session fixed-size ring buffers, lock-striped by session id so sessions
+# never contend with each other; add/delete are O(1) slot writes. Changes are
+# queued and flushed write-behind (batched on size/time) to a persistent
+# backend, and a session is loaded from it on first touch after a restart.
+# With a shared state backend (STATE_BACKEND=sqlite) every flush bumps the
+# session's version there, and other workers reload a session whose version
+# moved past the one their ring was built from.
+
+shared_state = state.open_state()     # profiles, user keys, memory versions
+
+MEM_PER_SESSION    = int(os.environ.get("MEMORY_PER_SESSION", "50"))
+MEM_STRIPES        = int(os.environ.get("MEMORY_STRIPES", "32"))
+MEM_BACKEND        = os.environ.get("MEMORY_BACKEND", "sqlite").lower()   # sqlite | supabase | none
+MEM_DB_PATH        = os.environ.get("MEMORY_DB_PATH", "godlocal_memory.db")
+MEM_FLUSH_INTERVAL = float(os.environ.get("MEMORY_FLUSH_INTERVAL", "2"))
+MEM_FLUSH_BATCH    = int(os.environ.get("MEMORY_FLUSH_BATCH", "200"))
+MEM_PENDING_MAX    = int(os.environ.get("MEMORY_PENDING_MAX", "20000"))  # oldest ops dropped past this
+MEM_FLUSH_RETRIES  = int(os.environ.get("MEMORY_FLUSH_RETRIES", "5"))    # then the op is dead-lettered
+MEM_RETRY_MAX      = 300.0      # cap on the doubling backoff after failed flushes
+
+class MemEntry:
+    __slots__ = ("id", "content", "ts", "type")
+
+    def __init__(self, id: str, content: str, ts: int, type: str = "fact"):
+        self.id, self.content, self.ts, self.type = id, content, ts, type
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "content": self.content, "ts": self.ts, "type": self.type}
+
+MEM_PROMPT_BUDGET = int(os.environ.get("MEMORY_PROMPT_TOKENS", "400"))
+MEM_FACT_BOOST    = 1.3      # explicit `remember` facts beat auto Q/A summaries
+BM25_K1, BM25_B   = 1.2, 0.75
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def _terms(text: str) -> list:
+    # prefix "stemming" is crude but cheap and folds most RU/EN inflections
+    return [w[:6] for w in _WORD_RE.findall(text.lower()) if len(w) > 1]
+
+class _BM25:
+    """Incremental BM25 over one session's memories (tens of docs — scoring is microseconds)."""
+    __slots__ = ("postings", "lengths", "total")
+
+    def __init__(self):
+        self.postings: dict = {}      # term -> {entry id: tf}
+        self.lengths:  dict = {}      # entry id -> doc length
+        self.total = 0
+
+    def add(self, entry):
+        terms = _terms(entry.content)
+        self.lengths[entry.id] = len(terms)
+        self.total += len(terms)
+        for t in terms:
+            docs = self.postings.setdefault(t, {})
+            docs[entry.id] = docs.get(entry.id, 0) + 1
+
+    def remove(self, entry):
+        n = self.lengths.pop(entry.id, None)
+        if n is None:
+            return
+        self.total -= n
+        for t in set(_terms(entry.content)):
+            docs = self.postings.get(t)
+            if docs:
+                docs.pop(entry.id, None)
+                if not docs:
+                    del self.postings[t]
+
+    def scores(self, query: str) -> dict:
+        n = len(self.lengths)
+        if not n:
+            return {}
+        avg = self.total / n or 1.0
+        out: dict = {}
+        for t in set(_terms(query)):
+            docs = self.postings.get(t)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for mid, tf in docs.items():
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[mid] / avg)
+                out[mid] = out.get(mid, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return out
+
+class _MemRing:
+    __slots__ = ("slots", "index", "next", "bm25", "version")
+
+    def __init__(self, size: int, version: int = 0):
+        self.slots = [None] * size
+        self.index: dict = {}       # entry id -> slot
+        self.next  = 0              # total entries ever written
+        self.bm25  = _BM25()
+        self.version = version      # shared mem_version this ring reflects
+
+    def add(self, entry: MemEntry):
+        """Write into the next slot; returns the entry it overwrote, if any."""
+        slot    = self.next % len(self.slots)
+        evicted = self.slots[slot]
+        if evicted is not None:
+            self.index.pop(evicted.id, None)
+            self.bm25.remove(evicted)
+        self.slots[slot]      = entry
+        self.index[entry.id]  = slot
+        self.next            += 1
+        self.bm25.add(entry)
+        return evicted
+
+    def delete(self, mid: str) -> bool:
+        slot = self.index.pop(mid, None)
+        if slot is None:
+            return False
+        self.bm25.remove(self.slots[slot])
+        self.slots[slot] = None
+        return True
+
+    def entries(self) -> list:
+        n = len(self.slots)
+        return [e for e in (self.slots[i % n] for i in range(max(0, self.next - n), self.next)) if e]
+
+class SQLiteMemoryBackend:
+    def __init__(self, path: str):
+        import sqlite3
+        self._db   = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")    # other workers may hold the write lock
+        self._db.execute("""create table if not exists memories (
+            session_id text not null, id text not null, content text not null,
+            ts integer not null, type text not null default 'fact',
+            primary key (session_id, id))""")
+        self._db.execute("create index if not exists memories_sid_ts on memories(session_id, ts)")
+
+    def load(self, sid: str, limit: int) -> list:
+        with self._lock:
+            rows = self._db.execute(
+                "select id, content, ts, type from memories where session_id=? order by ts desc limit ?",
+                (sid, limit)).fetchall()
+        return [MemEntry(*row) for row in reversed(rows)]
+
+    def write_batch(self, ops: list):
+        adds    = [(sid, e.id, e.content, e.ts, e.type) for op, sid, e in ops if op == "add"]
+        deletes = [(sid, mid) for op, sid, mid in ops if op == "delete"]
+        with self._lock:
+            self._db.execute("begin")
+            try:
+                self._db.executemany("insert or replace into memories values (?,?,?,?,?)", adds)
+                self._db.executemany("delete from memories where session_id=? and id=?", deletes)
+                self._db.execute("commit")
+            except Exception:
+                self._db.execute("rollback")
+                raise
+
+class SupabaseMemoryBackend:
+    """Table `memories` — supabase/migrations/20261018_memories.sql."""
+
+    def __init__(self):
+        from supabase import create_client
+        self._db = metrics.instrument_supabase(
+            create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]))
+
+    def load(self, sid: str, limit: int) -> list:
+        rows = (self._db.table("memories").select("id,content,ts,type").eq("session_id", sid)
+                .order("ts", desc=True).limit(limit).execute().data)
+        return [MemEntry(r["id"], r["content"], r["ts"], r.get("type", "fact")) for r in reversed(rows)]
+
+    def write_batch(self, ops: list):
+        adds = [{"session_id": sid, **e.to_dict()} for op, sid, e in ops if op == "add"]
+        if adds:
+            self._db.table("memories").upsert(adds).execute()
+        for op, sid, mid in ops:
+            if op == "delete":
+                self._db.table("memories").delete().eq("session_id", sid).eq("id", mid).execute()
+
+class MemoryStore:
+    def __init__(self, backend=None, versions=None):
+        self._backend = backend
+        # Cross-worker coherence only makes sense when the rings can be reloaded from a shared backend
+        self._versions = versions if backend is not None and versions is not None and versions.shared else None
+        self._locks   = [threading.Lock() for _ in range(MEM_STRIPES)]
+        self._shards  = [{} for _ in range(MEM_STRIPES)]     # sid -> _MemRing
+        self._pending = deque(maxlen=MEM_PENDING_MAX)         # write-behind (op, failed attempts)
+        self._dead    = deque(maxlen=1000)                    # ops dropped after MEM_FLUSH_RETRIES
+        self._wake    = threading.Event()
+        self._thread  = None
+        self._failures = 0                                    # consecutive failed flushes
+        self._retry_at = 0.0
+        self.stats    = {"flushed_ops": 0, "flushes": 0, "flush_errors": 0, "loads": 0, "reloads": 0,
+                         "dropped_ops": 0, "dead_ops": 0}
+
+    def _ring(self, sid: str) -> tuple:
+        i = hash(sid) % MEM_STRIPES
+        return self._locks[i], self._shards[i]
+
+    def _session(self, shard: dict, sid: str) -> _MemRing:
+        ring    = shard.get(sid)
+        version = 0
+        if self._versions is not None:
+            try:
+                version = self._versions.get("mem_version", sid, 0)
+            except Exception as e:
+                logger.warning(f"Memory version check failed for {sid}: {e}")
+                version = ring.version if ring is not None else 0
+            if ring is not None and ring.version != version:
+                ring = None                  # another worker flushed changes to this session
+                self.stats["reloads"] += 1
+        if ring is None:
+            ring = shard[sid] = _MemRing(MEM_PER_SESSION, version)
+            if self._backend is not None:
+                try:
+                    for e in self._backend.load(sid, MEM_PER_SESSION):
+                        ring.add(e)
+                    self.stats["loads"] += 1
+                except Exception as e:
+                    logger.warning(f"Memory load failed for {sid}: {e}")
+        return ring
+
+    def _enqueue(self, op: tuple):
+        if self._backend is None:
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self.stats["dropped_ops"] += 1
+            if self.stats["dropped_ops"] % 1000 == 1:
+                logger.warning(f"Memory write-behind queue full ({MEM_PENDING_MAX}); dropping oldest ops "
+                               f"({self.stats['dropped_ops']} so far)")
+        self._pending.append((op, 0))
+        if len(self._pending) >= MEM_FLUSH_BATCH or self._versions is not None:
+            self._wake.set()         # shared: flush promptly so other workers see it
+
+    def add(self, sid: str, text: str, type: str = "fact") -> MemEntry:
+        entry = MemEntry(uuid.uuid4().hex[:8], text, int(time.time() * 1000), type)
+        lock, shard = self._ring(sid)
+        with lock:
+            evicted = self._session(shard, sid).add(entry)
+        self._enqueue(("add", sid, entry))
+        if evicted is not None:      # keep the backend a mirror of the ring
+            self._enqueue(("delete", sid, evicted.id))
+        return entry
+
+    def get(self, sid: str) -> list:
+        lock, shard = self._ring(sid)
+        with lock:
+            return [e.to_dict() for e in self._session(shard, sid).entries()]
+
+    def relevant(self, sid: str, query: str, budget_tokens: int = MEM_PROMPT_BUDGET,
+                 count_tokens=None) -> list:
+        """Best memories for `query` that fit the token budget; recent facts fill in on no overlap."""
+        count_tokens = count_tokens or (lambda text: len(text) // 3 + 1)
+        lock, shard = self._ring(sid)
+        with lock:
+            ring    = self._session(shard, sid)
+            entries = ring.entries()
+            scores  = ring.bm25.scores(query)
+        n = len(entries)
+        ranked = []
+        for pos, e in enumerate(entries):
+            score = scores.get(e.id, 0.0) * (MEM_FACT_BOOST if e.type == "fact" else 1.0)
+            recency = (pos + 1) / n                     # tie-breaker, 0..1
+            ranked.append((score + 0.01 * recency, score > 0 or e.type == "fact", e))
+        ranked.sort(key=lambda r: r[0], reverse=True)
+        picked, used = [], 0
+        for _, useful, e in ranked:
+            if not useful:
+                continue
+            cost = count_tokens(e.content)
+            if used + cost > budget_tokens:
+                continue
+            picked.append(e.to_dict())
+            used += cost
+        return picked
+
+    def delete(self, sid: str, mid: str):
+        lock, shard = self._ring(sid)
+        with lock:
+            removed = self._session(shard, sid).delete(mid)
+        if removed:
+            self._enqueue(("delete", sid, mid))
+
+    def flush(self, force: bool = False):
+        """Write a batch to the backend; after failures, waits out a doubling backoff unless `force`."""
+        if not force and time.monotonic() < self._retry_at:
+            return
+        batch = []
+        while self._pending and len(batch) < MEM_FLUSH_BATCH * 5:
+            batch.append(self._pending.popleft())
+        if not batch:
+            return
+        ops = [op for op, _ in batch]
+        try:
+            self._backend.write_batch(ops)
+            self.stats["flushes"]     += 1
+            self.stats["flushed_ops"] += len(ops)
+            self._failures = 0
+            self._retry_at = 0.0
+        except Exception as e:
+            self.stats["flush_errors"] += 1
+            self._failures += 1
+            delay = min(MEM_RETRY_MAX, MEM_FLUSH_INTERVAL * 2 ** self._failures)
+            self._retry_at = time.monotonic() + delay
+            retry = [(op, n + 1) for op, n in batch if n + 1 < MEM_FLUSH_RETRIES]
+            dead  = [op for op, n in batch if n + 1 >= MEM_FLUSH_RETRIES]
+            if dead:
+                self._dead.extend(dead)
+                self.stats["dead_ops"] += len(dead)
+            logger.warning(f"Memory flush failed ({len(retry)} ops re-queued, {len(dead)} dead-lettered, "
+                           f"next try in {delay:.0f}s): {e}")
+            self._pending.extendleft(reversed(retry))
+            return
+        if self._versions is not None:
+            self._publish({sid for _, sid, _ in ops})
 
-_lock     = threading.Lock()
-_memories: dict = {}
-_profiles: dict = {}
-
-def mem_add(sid: str, text: str):
-    with _lock:
-        if sid not in _memories:
-            _memories[sid] = []
-        _memories[sid].append({
-            "id": str(uuid.uuid4())[:8],
-            "content": text,
-            "ts": int(time.time() * 1000),
-            "type": "fact"
-        })
-        _memories[sid] = _memories[sid][-50:]
+    def _publish(self, sids: set):
+        """Bump each flushed session's shared version; our ring stays current unless someone else wrote too."""
+        for sid in sids:
+            try:
+                version = self._versions.incr("mem_version", sid)
+            except Exception as e:
+                logger.warning(f"Memory version bump failed for {sid}: {e}")
+                continue
+            lock, shard = self._ring(sid)
+            with lock:
+                ring = shard.get(sid)
+                if ring is not None and ring.version == version - 1:
+                    ring.version = version
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(MEM_FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        if self._backend is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name="memory-flush", daemon=True)
+            self._thread.start()
+
+    def snapshot(self) -> dict:
+        return {"backend": type(self._backend).__name__ if self._backend else None,
+                "shared": self._versions is not None,
+                "sessions": sum(len(s) for s in self._shards),
+                "pending": len(self._pending), "dead_letter": len(self._dead),
+                "retry_in_s": round(max(0.0, self._retry_at - time.monotonic()), 1), **self.stats}
+
+def _memory_backend():
+    try:
+        if MEM_BACKEND == "supabase":
+            return SupabaseMemoryBackend()
+        if MEM_BACKEND == "sqlite":
+            return SQLiteMemoryBackend(MEM_DB_PATH)
+    except Exception as e:
+        logger.warning(f"Memory backend {MEM_BACKEND} unavailable, keeping memory in-process only: {e}")
+    return None
+
+memory = MemoryStore(_memory_backend(), shared_state)
+if shared_state.shared and memory._backend is None:
+    logger.warning("STATE_BACKEND is shared but MEMORY_BACKEND=none — memories stay per worker")
+
+@app.on_event("startup")
+async def _start_memory_flush():
+    memory.start()
+
+@app.on_event("shutdown")
+async def _flush_memory():
+    if memory._backend is not None:
+        await memory_pool.run(memory.flush, True)
+
+def mem_add(sid: str, text: str, type: str = "fact"):
+    memory.add(sid, text, type)
 
 def mem_get(sid: str) -> list:
-    with _lock:
-        return list(_memories.get(sid, []))
+    return memory.get(sid)
 
 def mem_delete(sid: str, mid: str):
-    with _lock:
-        if sid in _memories:
-            _memories[sid] = [m for m in _memories[sid] if m["id"] != mid]
+    memory.delete(sid, mid)
+
+def mem_relevant(sid: str, query: str, budget_tokens: int = MEM_PROMPT_BUDGET) -> list:
+    return memory.relevant(sid, query, budget_tokens, count_tokens)
+
+# A session's first touch loads it from the backend (a Supabase round trip), so
+# the event loop goes through memory_pool instead of calling the above inline.
+
+async def mem_add_async(sid: str, text: str, type: str = "fact"):
+    try:
+        await memory_pool.run(mem_add, sid, text, type)
+    except PoolSaturated as e:
+        logger.warning(f"Memory write shed: {e}")
+
+async def mem_relevant_async(sid: str, query: str, budget_tokens: int = MEM_PROMPT_BUDGET) -> list:
+    try:
+        return await memory_pool.run(mem_relevant, sid, query, budget_tokens)
+    except PoolSaturated as e:
+        logger.warning(f"Memory lookup shed: {e}")
+        return []
+
+# ── Groq HTTP client ───────────────────────────────────────────────────────────
+# One pooled AsyncClient per process: keep-alive connections are reused across
+# agent rounds and sessions, and callers await it directly instead of parking a
+# thread in the default executor for every completion.
+
+GROQ_BASE_URL        = os.environ.get("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+GROQ_TIMEOUT         = float(os.environ.get("GROQ_TIMEOUT", "30"))
+GROQ_CONNECT_TIMEOUT = float(os.environ.get("GROQ_CONNECT_TIMEOUT", "5"))
+GROQ_MAX_CONNECTIONS = int(os.environ.get("GROQ_MAX_CONNECTIONS", "100"))
+GROQ_MAX_KEEPALIVE   = int(os.environ.get("GROQ_MAX_KEEPALIVE", "20"))
+GROQ_KEEPALIVE_TTL   = float(os.environ.get("GROQ_KEEPALIVE_TTL", "60"))
+GROQ_HTTP2           = os.environ.get("GROQ_HTTP2", "true").lower() == "true"
+
+_groq_http: httpx.AsyncClient | None = None
+
+def groq_client() -> httpx.AsyncClient:
+    global _groq_http
+    if _groq_http is None or _groq_http.is_closed:
+        http2 = GROQ_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401 — httpx needs it for HTTP/2
+            except ImportError:
+                http2 = False
+        _groq_http = httpx.AsyncClient(
+            base_url=GROQ_BASE_URL,
+            http2=http2,
+            limits=httpx.Limits(max_connections=GROQ_MAX_CONNECTIONS,
+                                max_keepalive_connections=GROQ_MAX_KEEPALIVE,
+                                keepalive_expiry=GROQ_KEEPALIVE_TTL),
+            timeout=httpx.Timeout(GROQ_TIMEOUT, connect=GROQ_CONNECT_TIMEOUT),
+            headers={"Authorization": f"Bearer {GROQ_KEY}",
+                     "Content-Type": "application/json"},
+        )
+        logger.info(f"Groq client ready (http2={http2}, pool={GROQ_MAX_CONNECTIONS})")
+    return _groq_http
+
+@app.on_event("shutdown")
+async def _close_groq_client():
+    if _groq_http is not None and not _groq_http.is_closed:
+        await _groq_http.aclose()
+
+def _call_timeout(timeout: float | None):
+    return httpx.Timeout(timeout, connect=GROQ_CONNECT_TIMEOUT) if timeout else httpx.USE_CLIENT_DEFAULT
+
+# ── Executors ──────────────────────────────────────────────────────────────────
+# Blocking work runs on pools sized per workload instead of the shared default
+# executor, each with a bounded queue: when it is full the call is rejected at
+# once (PoolSaturated) and the caller degrades, rather than queueing behind a
+# slow GitHub/Instagram call. LLM calls are async already, so their "pool" is
+# an admission gate capping in-flight + waiting completions per priority.
+
+class PoolSaturated(RuntimeError):
+    pass
+
+class BoundedPool:
+    def __init__(self, name: str, workers: int, queue_max: int):
+        self.name      = name
+        self.workers   = workers
+        self.queue_max = queue_max
+        self._pool     = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                               thread_name_prefix=f"{name}-pool")
+        self._lock     = threading.Lock()
+        self.pending   = 0      # submitted, not finished (queued + running)
+        self.running   = 0
+        self.rejected  = 0
+        self.completed = 0
+
+    def _admit(self):
+        with self._lock:
+            if self.pending >= self.workers + self.queue_max:
+                self.rejected += 1
+                metrics.EXECUTOR_REJECTED.inc(pool=self.name)
+                raise PoolSaturated(f"{self.name} pool saturated ({self.pending} pending)")
+            self.pending += 1
+            metrics.EXECUTOR_DEPTH.set(self.pending - self.running, pool=self.name)
+
+    def _wrap(self, fn, args):
+        def job():
+            with self._lock:
+                self.running += 1
+                metrics.EXECUTOR_DEPTH.set(self.pending - self.running, pool=self.name)
+                metrics.EXECUTOR_INFLIGHT.set(self.running, pool=self.name)
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    metrics.EXECUTOR_INFLIGHT.set(self.running, pool=self.name)
+        return metrics.queued(self.name, job)
+
+    def _release(self, fut: concurrent.futures.Future):
+        # Done-callback, so a job cancelled while still queued gives its slot back too
+        with self._lock:
+            self.pending   -= 1
+            self.completed += not fut.cancelled()
+            metrics.EXECUTOR_DEPTH.set(self.pending - self.running, pool=self.name)
+
+    def _submit(self, job) -> concurrent.futures.Future:
+        try:
+            fut = self._pool.submit(job)
+        except BaseException:
+            with self._lock:
+                self.pending -= 1
+            raise
+        fut.add_done_callback(self._release)
+        return fut
+
+    def prepare(self, fn, *args):
+        """Reserve a queue slot for fn(*args) (PoolSaturated if full); the job's `.waited` is its queue time."""
+        self._admit()
+        return self._wrap(fn, args)
+
+    def start(self, job):
+        """Run a prepared job; cancelling the awaitable before the job starts frees its slot."""
+        return asyncio.wrap_future(self._submit(job))
+
+    def run(self, fn, *args):
+        """Awaitable result of fn(*args) on this pool; raises PoolSaturated immediately when full."""
+        return self.start(self.prepare(fn, *args))
+
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        """Same for synchronous callers."""
+        self._admit()
+        return self._submit(self._wrap(fn, args))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "queue_max": self.queue_max,
+                    "queued": self.pending - self.running, "running": self.running,
+                    "completed": self.completed, "rejected": self.rejected}
+
+class AdmissionGate:
+    """Async limiter: `inflight` concurrent calls, then a waiting room whose share shrinks with priority."""
+    SHARE = {"interactive": 1.0, "batch": 0.5, "background": 0.25}
+
+    def __init__(self, name: str, inflight: int, waiting_max: int):
+        self.name        = name
+        self.inflight    = inflight
+        self.waiting_max = waiting_max
+        self._sem        = None
+        self.waiting = self.running = self.rejected = 0
+
+    async def acquire(self, priority: str = "interactive"):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.inflight)
+        if self._sem.locked() and self.waiting >= self.waiting_max * self.SHARE.get(priority, 1.0):
+            self.rejected += 1
+            metrics.EXECUTOR_REJECTED.inc(pool=self.name)
+            raise PoolSaturated(f"{self.name} admission full ({self.waiting} waiting)")
+        t0 = time.perf_counter()
+        self.waiting += 1
+        metrics.EXECUTOR_DEPTH.set(self.waiting, pool=self.name)
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+            metrics.EXECUTOR_DEPTH.set(self.waiting, pool=self.name)
+        self.running += 1
+        metrics.EXECUTOR_INFLIGHT.set(self.running, pool=self.name)
+        metrics.EXECUTOR_WAIT.observe(time.perf_counter() - t0, pool=self.name)
+
+    def release(self):
+        self.running -= 1
+        metrics.EXECUTOR_INFLIGHT.set(self.running, pool=self.name)
+        self._sem.release()
+
+    def admit(self, rejected):
+        """Decorator for async LLM calls: returns `rejected` instead of running when the gate is full."""
+        def deco(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                try:
+                    await self.acquire(kwargs.get("priority", "interactive"))
+                except PoolSaturated as e:
+                    logger.warning(str(e))
+                    return rejected
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.release()
+            return wrapper
+        return deco
+
+    def snapshot(self) -> dict:
+        return {"inflight_max": self.inflight, "waiting_max": self.waiting_max,
+                "running": self.running, "waiting": self.waiting, "rejected": self.rejected}
+
+tools_pool  = BoundedPool("tools",  int(os.environ.get("TOOLS_WORKERS", "16")),
+                          int(os.environ.get("TOOLS_QUEUE_MAX", "64")))
+memory_pool = BoundedPool("memory", int(os.environ.get("MEMORY_WORKERS", "2")),
+                          int(os.environ.get("MEMORY_QUEUE_MAX", "32")))
+media_pool  = BoundedPool("media",  int(os.environ.get("MEDIA_WORKERS", "2")),
+                          int(os.environ.get("MEDIA_QUEUE_MAX", "8")))
+llm_gate    = AdmissionGate("llm",  int(os.environ.get("LLM_MAX_INFLIGHT", "48")),
+                            int(os.environ.get("LLM_MAX_WAITING", "96")))
+POOLS = {p.name: p for p in (tools_pool, memory_pool, media_pool, llm_gate)}
+
+OVERLOADED = "Сервер перегружен — попробуй через минуту."
+
+@app.exception_handler(PoolSaturated)
+async def _pool_saturated(request: Request, exc: PoolSaturated):
+    return JSONResponse({"ok": False, "error": OVERLOADED}, status_code=503, headers={"Retry-After": "30"})
+
+# ── Model router ───────────────────────────────────────────────────────────────
+# Replaces the fixed MODELS walk: each model keeps a success rate, a latency
+# EWMA, a rate-limit window parsed from Groq's retry-after / x-ratelimit-*
+# headers and a circuit breaker, so a call goes straight to the best model that
+# can actually answer right now instead of sleeping through 429s.
+
+ROUTER_EWMA_ALPHA    = float(os.environ.get("ROUTER_EWMA_ALPHA", "0.3"))
+ROUTER_FAILS_TO_OPEN = int(os.environ.get("ROUTER_FAILS_TO_OPEN", "3"))
+ROUTER_OPEN_SECONDS  = float(os.environ.get("ROUTER_OPEN_SECONDS", "30"))
+ROUTER_LATENCY_REF   = float(os.environ.get("ROUTER_LATENCY_REF", "10"))
+ROUTER_DEFAULT_LIMIT = 10.0   # seconds to back off on a 429 without headers
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def _parse_duration(value) -> float | None:
+    """Parse Groq reset values: '7.66s', '2m59.56s', '120ms' or plain seconds."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(str(value))
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+
+class ModelHealth:
+    __slots__ = ("model", "ok", "fail", "consecutive_fail", "latency_ewma", "state",
+                 "opened_at", "open_for", "limited_until", "remaining_requests",
+                 "remaining_tokens", "last_error", "probe_until")
+
+    def __init__(self, model: str):
+        self.model              = model
+        self.ok                 = 0
+        self.fail               = 0
+        self.consecutive_fail   = 0
+        self.latency_ewma       = None
+        self.state              = "closed"      # closed | open | half_open
+        self.opened_at          = 0.0
+        self.open_for           = ROUTER_OPEN_SECONDS
+        self.limited_until      = 0.0
+        self.remaining_requests = None
+        self.remaining_tokens   = None
+        self.last_error         = ""
+        self.probe_until        = 0.0     # half-open: one trial call at a time
+
+    def success_rate(self) -> float:
+        return (self.ok + 1) / (self.ok + self.fail + 2)
+
+    def available_at(self) -> float:
+        reopen = self.opened_at + self.open_for if self.state == "open" else 0.0
+        return max(self.limited_until, reopen)
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            "state": self.state, "ok": self.ok, "fail": self.fail,
+            "success_rate": round(self.success_rate(), 3),
+            "latency_ewma_ms": round(self.latency_ewma * 1000) if self.latency_ewma is not None else None,
+            "rate_limited_for_s": round(max(0.0, self.limited_until - now), 2),
+            "circuit_open_for_s": round(max(0.0, self.opened_at + self.open_for - now), 2)
+                                  if self.state == "open" else 0.0,
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+            "last_error": self.last_error,
+        }
+
+class ModelRouter:
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self._health: dict[str, ModelHealth] = {}
+
+    def _get(self, model: str) -> ModelHealth:
+        h = self._health.get(model)
+        if h is None:
+            h = self._health[model] = ModelHealth(model)
+        return h
+
+    def _score(self, h: ModelHealth, rank: int) -> float:
+        preference = max(0.1, 1.0 - rank * 0.1)   # list order still encodes quality
+        latency    = h.latency_ewma or 0.0
+        return preference * h.success_rate() / (1.0 + latency / ROUTER_LATENCY_REF)
+
+    def candidates(self, models: list) -> list:
+        """Available models best-first; if none is available, soonest-available first."""
+        now = time.time()
+        with self._lock:
+            ready, waiting = [], []
+            for rank, model in enumerate(models):
+                h = self._get(model)
+                if h.state == "open" and now >= h.opened_at + h.open_for:
+                    h.state, h.probe_until = "half_open", 0.0
+                if h.limited_until > now or h.state == "open" or (h.state == "half_open" and h.probe_until > now):
+                    waiting.append((h.available_at(), rank, model))
+                    continue
+                ready.append((-self._score(h, rank), rank, model))
+            ready.sort()
+            if ready:
+                return [m for _, _, m in ready]
+            return [m for _, _, m in sorted(waiting)]
+
+    def begin(self, model: str) -> bool:
+        """
+        Called right before a request goes out. A half-open model admits one
+        probe at a time: the first caller claims it, others get False and move on.
+        """
+        now = time.time()
+        with self._lock:
+            h = self._get(model)
+            if h.state != "half_open":
+                return True
+            if h.probe_until > now:
+                return False
+            h.probe_until = now + GROQ_TIMEOUT
+            return True
+
+    def _apply_headers(self, h: ModelHealth, headers, now: float):
+        if headers is None:
+            return
+        rem_req = headers.get("x-ratelimit-remaining-requests")
+        rem_tok = headers.get("x-ratelimit-remaining-tokens")
+        try:
+            h.remaining_requests = int(rem_req) if rem_req is not None else h.remaining_requests
+            h.remaining_tokens   = int(rem_tok) if rem_tok is not None else h.remaining_tokens
+        except ValueError:
+            pass
+        if h.remaining_requests == 0:
+            reset = _parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if reset:
+                h.limited_until = max(h.limited_until, now + reset)
+        if h.remaining_tokens == 0:
+            reset = _parse_duration(headers.get("x-ratelimit-reset-tokens"))
+            if reset:
+                h.limited_until = max(h.limited_until, now + reset)
+
+    def record_success(self, model: str, latency: float, headers=None):
+        metrics.GROQ_LATENCY.observe(latency, model=model, outcome="ok")
+        tracing.record("groq", latency, model=model, outcome="ok")
+        now = time.time()
+        with self._lock:
+            h = self._get(model)
+            h.ok += 1
+            h.consecutive_fail = 0
+            h.latency_ewma = latency if h.latency_ewma is None else (
+                ROUTER_EWMA_ALPHA * latency + (1 - ROUTER_EWMA_ALPHA) * h.latency_ewma)
+            h.state, h.probe_until, h.open_for = "closed", 0.0, ROUTER_OPEN_SECONDS
+            self._apply_headers(h, headers, now)
+
+    def record_rate_limit(self, model: str, headers=None, latency: float | None = None):
+        if latency is not None:
+            metrics.GROQ_LATENCY.observe(latency, model=model, outcome="rate_limited")
+            tracing.record("groq", latency, model=model, outcome="rate_limited")
+        now = time.time()
+        with self._lock:
+            h = self._get(model)
+            h.last_error  = "429 rate limited"
+            h.probe_until = 0.0
+            wait = None
+            if headers is not None:
+                wait = (_parse_duration(headers.get("retry-after"))
+                        or _parse_duration(headers.get("x-ratelimit-reset-requests"))
+                        or _parse_duration(headers.get("x-ratelimit-reset-tokens")))
+                self._apply_headers(h, headers, now)
+            h.limited_until = max(h.limited_until, now + (wait or ROUTER_DEFAULT_LIMIT))
+
+    def record_failure(self, model: str, error: str, fatal: bool = False,
+                       latency: float | None = None):
+        """fatal=True for errors that won't fix themselves soon (e.g. model decommissioned)."""
+        if latency is not None:
+            outcome = "timeout" if error == "timeout" else "http_error" if error.startswith("HTTP") else "error"
+            metrics.GROQ_LATENCY.observe(latency, model=model, outcome=outcome)
+            tracing.record("groq", latency, model=model, outcome=outcome, error=error[:80])
+        now = time.time()
+        with self._lock:
+            h = self._get(model)
+            h.fail += 1
+            h.consecutive_fail += 1
+            h.last_error = error[:120]
+            if fatal or h.state == "half_open" or h.consecutive_fail >= ROUTER_FAILS_TO_OPEN:
+                h.open_for = ROUTER_OPEN_SECONDS * (20 if fatal else
+                                                   (2 if h.state == "half_open" else 1))
+                h.open_for = min(h.open_for, 3600.0)
+                h.state, h.opened_at, h.probe_until = "open", now, 0.0
+                logger.warning(f"Circuit open for {model} ({h.open_for:.0f}s): {h.last_error}")
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {m: h.snapshot(now) for m, h in self._health.items()}
+
+router = ModelRouter()
+
+# ── Prompt budget ──────────────────────────────────────────────────────────────
+# Token-aware request assembly: the formatted system prompt is cached per day,
+# the static tools JSON is serialized once, and messages are trimmed per model
+# (tool results first, then the oldest turns) so a fallback to a small-context
+# model never overflows.
+
+MODEL_CONTEXT = {
+    "llama-3.3-70b-versatile": 131072,
+    "llama-3.1-70b-versatile": 131072,
+    "llama-3.1-8b-instant":    131072,
+    "gemma2-9b-it":            8192,
+    "mixtral-8x7b-32768":      32768,
+}
+PROMPT_MAX_TOKENS     = int(os.environ.get("PROMPT_MAX_TOKENS", "6000"))    # cap even for big contexts
+HISTORY_BUDGET        = int(os.environ.get("HISTORY_BUDGET_TOKENS", "1500"))
+TOOL_RESULT_MIN       = 300      # never squeeze a tool result below this
+CONTEXT_SAFETY_MARGIN = 256
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:     # not installed / no cached encoding offline — fall back to a char heuristic
+    _encoding = None
+
+@functools.lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 3 + 1      # Cyrillic-heavy text runs ~3 chars/token
+
+def truncate_tokens(text: str, limit: int) -> str:
+    if count_tokens(text) <= limit:
+        return text
+    if _encoding is not None:
+        cut = _encoding.decode(_encoding.encode(text, disallowed_special=())[:limit])
+    else:
+        cut = text[:limit * 3]
+    return cut + "\n... [truncated]"
+
+def message_tokens(m: dict) -> int:
+    content = m.get("content")
+    if isinstance(content, list):
+        n = sum(count_tokens(p.get("text", "")) for p in content if isinstance(p, dict))
+    else:
+        n = count_tokens(content or "")
+    if m.get("tool_calls"):
+        n += count_tokens(json.dumps(m["tool_calls"], ensure_ascii=False))
+    return n + 4
+
+def prompt_budget(model: str, max_tokens: int) -> int:
+    context = MODEL_CONTEXT.get(model, 8192)
+    return min(PROMPT_MAX_TOKENS, context - max_tokens - CONTEXT_SAFETY_MARGIN)
+
+@functools.lru_cache(maxsize=2)
+def system_prompt(day: str) -> str:
+    return SYSTEM_PROMPT.format(date=day)
+
+def trim_history(history: list, budget: int = HISTORY_BUDGET) -> list:
+    """Newest user/assistant turns that fit `budget` tokens, in original order."""
+    out, used = [], 0
+    for m in reversed(history):
+        if m.get("role") not in ("user", "assistant") or not isinstance(m.get("content"), str):
+            continue
+        cost = message_tokens(m)
+        if used + cost > budget:
+            break
+        out.append(m)
+        used += cost
+    return out[::-1]
+
+def fit_messages(messages: list, model: str, max_tokens: int, reserved: int = 0) -> list:
+    """Trim `messages` into the model's prompt budget minus `reserved` tokens (the tool schemas)."""
+    budget = prompt_budget(model, max_tokens) - reserved
+    counts = [message_tokens(m) for m in messages]
+    total  = original = sum(counts)
+    if total <= budget:
+        return messages
+    msgs = list(messages)
+    # 1. squeeze tool results, oldest first
+    for i, m in enumerate(msgs):
+        if total <= budget:
+            break
+        if m.get("role") == "tool" and counts[i] > TOOL_RESULT_MIN:
+            keep    = max(TOOL_RESULT_MIN, counts[i] - (total - budget))
+            msgs[i] = {**m, "content": truncate_tokens(m.get("content") or "", keep)}
+            total  += message_tokens(msgs[i]) - counts[i]
+            counts[i] = message_tokens(msgs[i])
+    # 2. drop the oldest turns before the current user message; an assistant
+    #    tool_calls message goes together with its tool results, and the history
+    #    left over starts on a user turn, never on a reply whose question is gone
+    last_user = max((i for i, m in enumerate(msgs) if m.get("role") == "user"), default=len(msgs) - 1)
+    start = 1 if msgs and msgs[0].get("role") == "system" else 0
+    i = start
+    dropped = False
+    while i < last_user and (total > budget or (dropped and msgs[i].get("role") != "user")):
+        j = i + 1
+        while j < last_user and msgs[j].get("role") == "tool":
+            j += 1
+        total -= sum(counts[i:j])
+        del msgs[i:j], counts[i:j]
+        last_user -= j - i
+        dropped = True
+    # 3. last resort: cut the system prompt (memory block sits at its end)
+    if total > budget and start == 1:
+        over    = total - budget
+        keep    = max(200, counts[0] - over)
+        msgs[0] = {**msgs[0], "content": truncate_tokens(msgs[0]["content"], keep)}
+    logger.info(f"Prompt trimmed for {model}: {original} → budget {budget} tokens")
+    return msgs
+
+_tools_json_cache: dict = {}
+
+def _tools_fragment(tools: list) -> str:
+    """',"tools":[...],"tool_choice":"auto"' serialized once per tool list."""
+    cached = _tools_json_cache.get(id(tools))
+    if cached is None or cached[0] is not tools:
+        frag   = ',"tools":' + json.dumps(tools, ensure_ascii=False, separators=(",", ":")) \
+                 + ',"tool_choice":"auto"'
+        cached = _tools_json_cache[id(tools)] = (tools, frag)
+    return cached[1]
+
+# ── Groq scheduler ─────────────────────────────────────────────────────────────
+# Process-wide token buckets (requests/min + tokens/min per model) in front of
+# every Groq call. Waiters queue per session and are served round-robin within
+# a priority class, so one heavy session can't burn the shared quota and
+# background work never gets ahead of interactive chat. The Groq quota is per
+# API key, so with several workers each one gets 1/GROQ_WORKERS of it.
+
+PRIORITIES = {"interactive": 0, "batch": 1, "background": 2}
+
+GROQ_DEFAULT_RPM = int(os.environ.get("GROQ_RPM", "30"))
+GROQ_DEFAULT_TPM = int(os.environ.get("GROQ_TPM", "6000"))
+# (requests/min, tokens/min) per model. These are the Groq *free tier* quotas;
+# on a paid plan set GROQ_LIMITS to your own, e.g.
+#   GROQ_LIMITS='{"llama-3.3-70b-versatile": [1000, 300000]}'
+# (listed models are overridden, others keep GROQ_RPM/GROQ_TPM).
+GROQ_MODEL_LIMITS = {
+    "llama-3.3-70b-versatile":                       (30, 12000),
+    "llama-3.1-70b-versatile":                       (30, 6000),
+    "llama-3.1-8b-instant":                          (30, 6000),
+    "gemma2-9b-it":                                  (30, 15000),
+    "mixtral-8x7b-32768":                            (30, 5000),
+    "meta-llama/llama-4-scout-17b-16e-instruct":     (30, 30000),
+    "meta-llama/llama-4-maverick-17b-128e-instruct": (30, 6000),
+}
+GROQ_MODEL_LIMITS.update({m: tuple(v) for m, v in
+                          json.loads(os.environ.get("GROQ_LIMITS", "{}")).items()})
+GROQ_MAX_QUEUE_WAIT = float(os.environ.get("GROQ_MAX_QUEUE_WAIT", "20"))
+GROQ_WORKERS = max(1, int(os.environ.get("GROQ_WORKERS", os.environ.get("WEB_CONCURRENCY", "1"))))
+
+def _estimate_tokens(messages: list, tools: list, max_tokens: int, model: str) -> int:
+    """
+    Upper bound for the request _chat_body will build for `model`: the prompt as
+    fit_messages trims it, the tool schemas, and max_tokens (Groq counts the
+    requested completion against TPM; settle() returns what wasn't used).
+    """
+    tools_n = count_tokens(_tools_fragment(tools)) if tools else 0
+    prompt  = sum(message_tokens(m) for m in messages)
+    return min(prompt, prompt_budget(model, max_tokens) - tools_n) + tools_n + max_tokens
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "level", "ts")
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate     = per_minute / 60.0
+        self.level    = float(per_minute)
+        self.ts       = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.ts) * self.rate)
+        self.ts    = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+class _Waiter:
+    __slots__ = ("model", "tokens", "sid", "priority", "future", "enqueued")
+
+    def __init__(self, model, tokens, sid, priority, future):
+        self.model, self.tokens, self.sid, self.priority = model, tokens, sid, priority
+        self.future   = future
+        self.enqueued = time.monotonic()
+
+class GroqScheduler:
+    def __init__(self):
+        self._buckets: dict[str, tuple] = {}
+        # one OrderedDict per priority: sid -> deque[_Waiter]; dict order is the round-robin
+        self._queues  = [OrderedDict() for _ in PRIORITIES]
+        self._timer   = None
+        self._wake_at = 0.0
+        self._stats   = {name: {"granted": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+                         for name in PRIORITIES}
+
+    def _bucket(self, model: str) -> tuple:
+        b = self._buckets.get(model)
+        if b is None:
+            rpm, tpm = GROQ_MODEL_LIMITS.get(model, (GROQ_DEFAULT_RPM, GROQ_DEFAULT_TPM))
+            b = self._buckets[model] = (TokenBucket(max(1, rpm // GROQ_WORKERS)),
+                                        TokenBucket(max(1, tpm // GROQ_WORKERS)))
+        return b
+
+    def _wait_for(self, model: str, tokens: int, now: float) -> float:
+        req, tok = self._bucket(model)
+        return max(req.wait_time(1, now), tok.wait_time(tokens, now))
+
+    def _queued_for(self, model: str) -> bool:
+        return any(w.model == model for q in self._queues for dq in q.values() for w in dq)
+
+    def has_capacity(self, model: str, tokens: int) -> bool:
+        return not self._queued_for(model) and self._wait_for(model, tokens, time.monotonic()) <= 0
+
+    def prefer_ready(self, models: list, tokens) -> list:
+        """Stable reorder: models that can be called right now go first. `tokens` is a count or model -> count."""
+        need  = tokens if callable(tokens) else (lambda m: tokens)
+        ready = [m for m in models if self.has_capacity(m, need(m))]
+        return ready + [m for m in models if m not in ready]
+
+    def _grant(self, model: str, tokens: int, priority: str, waited: float):
+        req, tok = self._bucket(model)
+        req.take(1); tok.take(tokens)
+        st = self._stats[priority]
+        st["granted"]    += 1
+        st["wait_total"] += waited
+        st["wait_max"]    = max(st["wait_max"], waited)
+
+    def _pump(self):
+        self._timer = None
+        now         = time.monotonic()
+        blocked     = set()          # first blocked waiter claims its model for this pass
+        next_wake   = None
+        for q in self._queues:
+            progressed = True
+            while progressed:
+                progressed = False
+                for sid in list(q.keys()):
+                    dq = q[sid]
+                    w  = dq[0]
+                    if w.future.done():          # timed out / cancelled, not yet removed
+                        dq.popleft()
+                        if not dq:
+                            del q[sid]
+                        progressed = True
+                        continue
+                    if w.model in blocked:
+                        continue
+                    wait = self._wait_for(w.model, w.tokens, now)
+                    if wait > 0:
+                        blocked.add(w.model)
+                        next_wake = wait if next_wake is None else min(next_wake, wait)
+                        continue
+                    dq.popleft()
+                    self._grant(w.model, w.tokens, w.priority, now - w.enqueued)
+                    if not w.future.done():
+                        w.future.set_result(now - w.enqueued)
+                    if dq:
+                        q.move_to_end(sid)
+                    else:
+                        del q[sid]
+                    progressed = True
+        if next_wake is not None:
+            loop = asyncio.get_running_loop()
+            wake = now + next_wake
+            if self._timer is None or wake < self._wake_at:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._wake_at = wake
+                self._timer   = loop.call_later(next_wake, self._pump)
+
+    def _remove(self, w: _Waiter):
+        q  = self._queues[PRIORITIES[w.priority]]
+        dq = q.get(w.sid)
+        if dq and w in dq:
+            dq.remove(w)
+            if not dq:
+                del q[w.sid]
+
+    async def acquire(self, model: str, tokens: int, session_id: str = "default",
+                      priority: str = "interactive", max_wait: float = None) -> float:
+        """Wait for a slot on `model`; returns seconds spent queued. Raises TimeoutError."""
+        priority = priority if priority in PRIORITIES else "interactive"
+        if self.has_capacity(model, tokens):
+            self._grant(model, tokens, priority, 0.0)
+            return 0.0
+        fut = asyncio.get_running_loop().create_future()
+        w   = _Waiter(model, tokens, session_id, priority, fut)
+        q   = self._queues[PRIORITIES[priority]]
+        q.setdefault(session_id, deque()).append(w)
+        self._pump()
+        try:
+            return await asyncio.wait_for(fut, max_wait or GROQ_MAX_QUEUE_WAIT)
+        except asyncio.TimeoutError:
+            self._stats[priority]["timeouts"] += 1
+            raise TimeoutError(f"queued > {max_wait or GROQ_MAX_QUEUE_WAIT:.0f}s for {model}")
+        finally:
+            if not fut.done() or fut.cancelled():
+                self._remove(w)
+
+    def settle(self, model: str, estimated: int, usage: dict | None):
+        """Return over-estimated tokens to the bucket once real usage is known."""
+        if not usage or not usage.get("total_tokens"):
+            return
+        self._bucket(model)[1].give_back(max(0, estimated - int(usage["total_tokens"])))
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        queues = {}
+        for name, idx in PRIORITIES.items():
+            waiters = [w for dq in self._queues[idx].values() for w in dq]
+            st = self._stats[name]
+            queues[name] = {
+                "depth": len(waiters),
+                "sessions": len(self._queues[idx]),
+                "oldest_wait_s": round(max((now - w.enqueued for w in waiters), default=0.0), 3),
+                "granted": st["granted"], "timeouts": st["timeouts"],
+                "avg_wait_ms": round(st["wait_total"] / st["granted"] * 1000, 1) if st["granted"] else 0.0,
+                "max_wait_ms": round(st["wait_max"] * 1000, 1),
+            }
+        buckets = {}
+        for model, (req, tok) in self._buckets.items():
+            req._refill(now); tok._refill(now)
+            buckets[model] = {"requests_left": round(req.level, 1), "rpm": int(req.capacity),
+                              "tokens_left": round(tok.level), "tpm": int(tok.capacity)}
+        return {"workers": GROQ_WORKERS, "queues": queues, "buckets": buckets}
+
+scheduler = GroqScheduler()
+
+async def _acquire_slot(model: str, est: int, session_id: str, priority: str,
+                        deadline: float) -> bool:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return False
+    with tracing.span("groq.queue", model=model) as attrs:
+        try:
+            await scheduler.acquire(model, est, session_id, priority, max_wait=remaining)
+        except TimeoutError as e:
+            logger.warning(f"Scheduler: {e}")
+            attrs["timeout"] = True
+            return False
+        # the breaker's probe is claimed only for the model actually called
+        if not router.begin(model):
+            attrs["probe_taken"] = True
+            return False
+        return True
 
 # ── Vision ─────────────────────────────────────────────────────────────────────
 
-def analyze_image(image_base64: str, prompt: str) -> str:
+async def analyze_image(image_base64: str, prompt: str, timeout: float | None = None,
+                        session_id: str = "default", priority: str = "interactive") -> str:
+    """Decode/resize on media_pool first, then take an LLM admission slot only for the Groq call."""
     if not GROQ_KEY:
         return "GROQ_API_KEY not set"
-    if "," in image_base64:
-        image_base64 = image_base64.split(",", 1)[1]
-    headers = {
-        "Authorization": f"Bearer {GROQ_KEY}",
-        "Content-Type": "application/json"
-    }
-    for model in VISION_MODELS:
+    try:
+        image_url, digest = await media_pool.run(prepare_image, image_base64)
+    except ValueError as e:
+        return f"Изображение не принято: {e}"
+    except PoolSaturated:
+        return OVERLOADED
+    del image_base64      # callers hand the upload over; this was the last reference
+    cache_key = (digest, prompt or "")
+    cached    = _vision_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    return await _vision_call(image_url, cache_key, prompt, timeout,
+                              session_id=session_id, priority=priority)
+
+@llm_gate.admit(OVERLOADED)
+async def _vision_call(image_url: str, cache_key: tuple, prompt: str, timeout: float | None,
+                       session_id: str = "default", priority: str = "interactive") -> str:
+    client   = groq_client()
+    est      = 1024 + 1500   # image tokens are billed flat-ish; budget roughly
+    deadline = time.monotonic() + GROQ_MAX_QUEUE_WAIT
+    for model in scheduler.prefer_ready(router.candidates(VISION_MODELS), est):
+        if not await _acquire_slot(model, est, session_id, priority, deadline):
+            continue
         body = {
             "model": model,
             "messages": [{"role": "user", "content": [
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}},
+                {"type": "image_url", "image_url": {"url": image_url}},
                 {"type": "text", "text": prompt or "Опиши что на этом изображении подробно."}
             ]}],
             "max_tokens": 1024,
         }
+        t0 = time.perf_counter()
         try:
-            r = requests.post("https://api.groq.com/openai/v1/chat/completions",
-                              json=body, headers=headers, timeout=30)
-            if r.status_code in (429, 400, 404):
-                time.sleep(1); continue
+            r = await client.post("/chat/completions", json=body, timeout=_call_timeout(timeout))
+            if r.status_code == 429:
+                router.record_rate_limit(model, r.headers, latency=time.perf_counter() - t0); continue
+            if r.status_code in (400, 404):
+                router.record_failure(model, f"HTTP {r.status_code}", fatal=r.status_code == 404,
+                                      latency=time.perf_counter() - t0)
+                continue
             r.raise_for_status()
-            return r.json()["choices"][0]["message"].get("content", "") or ""
+            router.record_success(model, time.perf_counter() - t0, r.headers)
+            data = r.json()
+            scheduler.settle(model, est, data.get("usage"))
+            answer = data["choices"][0]["message"].get("content", "") or ""
+            if answer:
+                _vision_cache.set(cache_key, answer)
+            return answer
         except Exception as e:
+            router.record_failure(model, str(e), latency=time.perf_counter() - t0)
             logger.warning(f"Vision error on {model}: {e}")
             continue
     return "Не смог проанализировать изображение."
 
 # ── Groq LLM ───────────────────────────────────────────────────────────────────
 
-def groq_chat(messages: list, tools: list = None, max_tokens: int = 1024) -> tuple:
+def _chat_body(model: str, messages: list, tools: list, max_tokens: int,
+               stream: bool = False) -> tuple:
+    """(request bytes, tokens to reserve): the fitted prompt plus tool schemas plus max_tokens."""
+    tools_frag = _tools_fragment(tools) if tools else ""
+    tools_n    = count_tokens(tools_frag)
+    fitted     = fit_messages(messages, model, max_tokens, tools_n)
+    body = {
+        "model": model,
+        "messages": fitted,
+        "max_tokens": max_tokens,
+        "temperature": 0.85,
+    }
+    if stream:
+        body["stream"] = True
+    raw = json.dumps(body, ensure_ascii=False, separators=(",", ":"))
+    if tools_frag:
+        raw = raw[:-1] + tools_frag + "}"
+    return raw.encode(), sum(message_tokens(m) for m in fitted) + tools_n + max_tokens
+
+@llm_gate.admit((None, OVERLOADED))
+async def groq_chat(messages: list, tools: list = None, max_tokens: int = 1024,
+                    timeout: float | None = None, session_id: str = "default",
+                    priority: str = "interactive") -> tuple:
     if not GROQ_KEY:
         return None, "GROQ_API_KEY not set"
-    headers = {
-        "Authorization": f"Bearer {GROQ_KEY}",
-        "Content-Type": "application/json"
-    }
-    for model in MODELS:
-        body = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": max_tokens,
-            "temperature": 0.85,
-        }
-        if tools:
-            body["tools"] = tools
-            body["tool_choice"] = "auto"
+    client   = groq_client()
+    deadline = time.monotonic() + GROQ_MAX_QUEUE_WAIT
+    estimate = lambda m: _estimate_tokens(messages, tools, max_tokens, m)
+    for model in scheduler.prefer_ready(router.candidates(MODELS), estimate):
+        body, est = _chat_body(model, messages, tools, max_tokens)
+        if not await _acquire_slot(model, est, session_id, priority, deadline):
+            continue
+        t0 = time.perf_counter()
         try:
-            r = requests.post("https://api.groq.com/openai/v1/chat/completions",
-                              json=body, headers=headers, timeout=30)
+            r = await client.post("/chat/completions", content=body, timeout=_call_timeout(timeout))
             if r.status_code == 429:
                 logger.warning(f"Rate limit on {model}, trying next...")
-                time.sleep(2); continue
+                router.record_rate_limit(model, r.headers, latency=time.perf_counter() - t0); continue
             if r.status_code in (400, 404):
                 err_msg = r.json().get("error", {}).get("message", "")
                 logger.warning(f"Model {model} error {r.status_code}: {err_msg[:80]}")
+                router.record_failure(model, f"HTTP {r.status_code}: {err_msg}",
+                                      fatal=r.status_code == 404,
+                                      latency=time.perf_counter() - t0)
                 continue
             r.raise_for_status()
-            return r.json(), None
-        except requests.exceptions.Timeout:
-            logger.warning(f"Timeout on {model}"); continue
+            router.record_success(model, time.perf_counter() - t0, r.headers)
+            data = r.json()
+            scheduler.settle(model, est, data.get("usage"))
+            return data, None
+        except httpx.TimeoutException:
+            logger.warning(f"Timeout on {model}")
+            router.record_failure(model, "timeout", latency=time.perf_counter() - t0); continue
+        except Exception as e:
+            logger.warning(f"Error on {model}: {e}")
+            router.record_failure(model, str(e), latency=time.perf_counter() - t0); continue
+    return None, "All models failed"
+
+# ── Groq streaming ─────────────────────────────────────────────────────────────
+
+def _merge_tool_call_deltas(acc: dict, deltas: list):
+    """Fold streamed tool_calls fragments (keyed by index) into full calls."""
+    for d in deltas:
+        tc = acc.setdefault(d.get("index", len(acc)), {
+            "id": "", "type": "function", "function": {"name": "", "arguments": ""}
+        })
+        if d.get("id"):
+            tc["id"] = d["id"]
+        if d.get("type"):
+            tc["type"] = d["type"]
+        fn = d.get("function") or {}
+        if fn.get("name"):
+            tc["function"]["name"] += fn["name"]
+        if fn.get("arguments"):
+            tc["function"]["arguments"] += fn["arguments"]
+
+class _ConsumerError(Exception):
+    """on_token itself failed (client went away) — not the model's fault."""
+
+@llm_gate.admit((None, OVERLOADED))
+async def groq_stream(messages: list, on_token, tools: list = None,
+                      max_tokens: int = 1024, timeout: float | None = None,
+                      session_id: str = "default", priority: str = "interactive",
+                      on_progress=None) -> tuple:
+    """
+    Same contract as groq_chat, but with stream=true: content deltas are passed
+    to `await on_token(text)` as they arrive and the returned response is the
+    assembled non-streaming shape (content + tool_calls + finish_reason).
+    Falls back to the next model only while nothing has been emitted yet.
+    `await on_progress(text)`, if given, hears about queueing and model choice.
+    """
+    if not GROQ_KEY:
+        return None, "GROQ_API_KEY not set"
+    client   = groq_client()
+    deadline = time.monotonic() + GROQ_MAX_QUEUE_WAIT
+    estimate = lambda m: _estimate_tokens(messages, tools, max_tokens, m)
+    for model in scheduler.prefer_ready(router.candidates(MODELS), estimate):
+        body, est = _chat_body(model, messages, tools, max_tokens, stream=True)
+        if on_progress and not scheduler.has_capacity(model, est):
+            await on_progress(f"Жду свободный слот у {model}...")
+        if not await _acquire_slot(model, est, session_id, priority, deadline):
+            continue
+        if on_progress:
+            await on_progress(f"Модель: {model}")
+        content, calls, finish, usage = [], {}, None, None
+        emitted = False
+        t0 = time.perf_counter()
+        try:
+            async with client.stream("POST", "/chat/completions", content=body,
+                                     timeout=_call_timeout(timeout)) as r:
+                if r.status_code == 429:
+                    logger.warning(f"Rate limit on {model}, trying next...")
+                    router.record_rate_limit(model, r.headers, latency=time.perf_counter() - t0); continue
+                if r.status_code in (400, 404):
+                    await r.aread()
+                    err_msg = r.json().get("error", {}).get("message", "")
+                    logger.warning(f"Model {model} error {r.status_code}: {err_msg[:80]}")
+                    router.record_failure(model, f"HTTP {r.status_code}: {err_msg}",
+                                          fatal=r.status_code == 404,
+                                          latency=time.perf_counter() - t0)
+                    continue
+                r.raise_for_status()
+                headers = r.headers
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == "[DONE]":
+                        break
+                    chunk = json.loads(payload)
+                    usage = (chunk.get("x_groq") or {}).get("usage") or chunk.get("usage") or usage
+                    if not chunk.get("choices"):
+                        continue
+                    choice = chunk["choices"][0]
+                    delta  = choice.get("delta") or {}
+                    if delta.get("content"):
+                        if not emitted:
+                            tracing.mark("first_token", model=model)
+                        content.append(delta["content"])
+                        emitted = True
+                        try:
+                            await on_token(delta["content"])
+                        except Exception as e:
+                            raise _ConsumerError() from e
+                    if delta.get("tool_calls"):
+                        _merge_tool_call_deltas(calls, delta["tool_calls"])
+                    finish = choice.get("finish_reason") or finish
+            router.record_success(model, time.perf_counter() - t0, headers)
+        except _ConsumerError as e:
+            scheduler.settle(model, est, usage)
+            raise e.__cause__ from None
+        except httpx.TimeoutException:
+            logger.warning(f"Stream timeout on {model}")
+            router.record_failure(model, "timeout", latency=time.perf_counter() - t0)
+            if not emitted: continue
+            finish = "length"
         except Exception as e:
-            logger.warning(f"Error on {model}: {e}"); continue
+            logger.warning(f"Stream error on {model}: {e}")
+            router.record_failure(model, str(e), latency=time.perf_counter() - t0)
+            if not emitted: continue
+            finish = "length"
+        message = {"role": "assistant", "content": "".join(content)}
+        if calls:
+            message["tool_calls"] = [calls[i] for i in sorted(calls)]
+            finish = finish or "tool_calls"
+        resp = {"model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish or "stop"}]}
+        if usage:
+            resp["usage"] = usage
+        scheduler.settle(model, est, usage)
+        return resp, None
     return None, "All models failed"
 
 # ── Tool Definitions ───────────────────────────────────────────────────────────
@@ -370,12 +1660,18 @@ TOOL_DEFS = [
         "type": "function",
         "function": {
             "name": "github_read_file",
-            "description": "Read a file from a GitHub repository",
+            "description": "Read a file from a GitHub repository. Returns numbered lines. Large files return the top plus an outline of definitions — then read just what you need with start_line/end_line, search or symbol.",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "repo": {"type": "string", "description": "Repository in format owner/repo (e.g. GodLocal2026/godlocal-site)"},
-                    "path": {"type": "string", "description": "File path in the repository (e.g. src/app/page.tsx)"}
+                    "path": {"type": "string", "description": "File path in the repository (e.g. src/app/page.tsx)"},
+                    "ref": {"type": "string", "description": "Branch, tag or commit (default: repo default branch)"},
+                    "start_line": {"type": "integer", "description": "First line to return (1-based)"},
+                    "end_line": {"type": "integer", "description": "Last line to return (inclusive)"},
+                    "search": {"type": "array", "items": {"type": "string"}, "description": "Return lines containing any of these terms (case-insensitive) with surrounding context"},
+                    "symbol": {"type": "string", "description": "Function/class/const name — returns its whole definition"},
+                    "context": {"type": "integer", "description": "Context lines around search matches (default 5)"}
                 },
                 "required": ["repo", "path"]
             }
@@ -385,16 +1681,30 @@ TOOL_DEFS = [
         "type": "function",
         "function": {
             "name": "github_push_file",
-            "description": "Create or update a file in a GitHub repository",
+            "description": "Create or update files in a GitHub repository. For a change touching several files pass them all in `files` — they are written as a single commit.",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "repo": {"type": "string", "description": "Repository in format owner/repo"},
-                    "path": {"type": "string", "description": "File path"},
-                    "content": {"type": "string", "description": "Full file content"},
+                    "path": {"type": "string", "description": "File path (single-file mode)"},
+                    "content": {"type": "string", "description": "Full file content (single-file mode)"},
+                    "files": {
+                        "type": "array",
+                        "description": "Batch mode: files to write in one commit",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "path": {"type": "string"},
+                                "content": {"type": "string", "description": "Full file content"},
+                                "delete": {"type": "boolean", "description": "Remove this path instead"}
+                            },
+                            "required": ["path"]
+                        }
+                    },
+                    "branch": {"type": "string", "description": "Target branch (default: repo default branch)"},
                     "message": {"type": "string", "description": "Git commit message"}
                 },
-                "required": ["repo", "path", "content", "message"]
+                "required": ["repo", "message"]
             }
         }
     },
@@ -407,7 +1717,8 @@ TOOL_DEFS = [
                 "type": "object",
                 "properties": {
                     "repo": {"type": "string", "description": "Repository in format owner/repo"},
-                    "path": {"type": "string", "description": "Directory path (empty string for root)"}
+                    "path": {"type": "string", "description": "Directory path (empty string for root)"},
+                    "ref": {"type": "string", "description": "Branch, tag or commit (default: repo default branch)"}
                 },
                 "required": ["repo"]
             }
@@ -461,45 +1772,581 @@ TOOL_LABELS = {
     "post_instagram":  "📸 Instagram",
 }
 
+# ── Caches ─────────────────────────────────────────────────────────────────────
+
+_MISS  = object()
+CACHES: dict = {}      # name -> TTLCache, reported by /cache/stats
+
+class TTLCache:
+    """Thread-safe LRU with per-entry TTL and single-flight loads (tools run on executor threads)."""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name      = name
+        self.maxsize   = maxsize
+        self.ttl       = ttl
+        self._data     = OrderedDict()      # key -> (expires_at, value)
+        self._inflight: dict = {}           # key -> concurrent.futures.Future
+        self._lock     = threading.Lock()
+        self.hits = self.misses = self.coalesced = self.evictions = 0
+        CACHES[name] = self
+        metrics.register_cache(name, self.stats)
+
+    def _lookup(self, key, now: float):
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISS
+        if entry[0] < now:
+            del self._data[key]
+            return _MISS
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key, time.monotonic())
+            if value is _MISS:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def get_or_load(self, key, loader, cacheable=None):
+        """Return the cached value or call loader() once, sharing the result with concurrent callers."""
+        with self._lock:
+            value = self._lookup(key, time.monotonic())
+            if value is not _MISS:
+                self.hits += 1
+                return value
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader:
+                self.misses += 1
+                fut = self._inflight[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return fut.result()
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            fut.set_exception(e)
+            raise
+        if cacheable is None or cacheable(value):
+            self.set(key, value)
+        with self._lock:
+            self._inflight.pop(key, None)
+        fut.set_result(value)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._data), "maxsize": self.maxsize, "ttl_s": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "evictions": self.evictions,
+                    "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0}
+
+SEARCH_CACHE_TTL  = float(os.environ.get("SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "512"))
+_search_cache = TTLCache("web_search", SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+def _normalize_query(q: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", q).lower().split()).strip(" ?!.,")
+
+# ── Image pipeline ─────────────────────────────────────────────────────────────
+# Uploads are decoded once, downsized and re-encoded to a bounded JPEG, and
+# hashed; vision answers are cached by (hash, prompt) so a re-sent screenshot
+# costs nothing and the Groq request carries ~100 KB instead of a raw photo.
+
+VISION_MAX_DIM       = int(os.environ.get("VISION_MAX_DIM", "1280"))
+VISION_JPEG_QUALITY  = int(os.environ.get("VISION_JPEG_QUALITY", "80"))
+VISION_MAX_UPLOAD_MB = float(os.environ.get("VISION_MAX_UPLOAD_MB", "15"))
+VISION_CACHE_SIZE    = int(os.environ.get("VISION_CACHE_SIZE", "128"))
+VISION_CACHE_TTL     = float(os.environ.get("VISION_CACHE_TTL", "3600"))
+_vision_cache = TTLCache("vision", VISION_CACHE_SIZE, VISION_CACHE_TTL)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    logger.info("Pillow not installed — images are forwarded without resizing")
+
+def prepare_image(image_base64: str) -> tuple:
+    """Data URL / base64 in → (data URL of normalized image, sha256 of its bytes). CPU-bound."""
+    mime = "image/jpeg"
+    if image_base64.startswith("data:"):
+        header, image_base64 = image_base64.split(",", 1)
+        mime = header[5:].split(";", 1)[0] or mime
+    if len(image_base64) * 3 / 4 > VISION_MAX_UPLOAD_MB * 1024 * 1024:
+        raise ValueError(f"image larger than {VISION_MAX_UPLOAD_MB:.0f} MB")
+    try:
+        raw = base64.b64decode(image_base64, validate=False)
+    except Exception:
+        raise ValueError("invalid base64")
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(raw)) as img:
+                img = ImageOps.exif_transpose(img).convert("RGB")
+                img.thumbnail((VISION_MAX_DIM, VISION_MAX_DIM))
+                out = io.BytesIO()
+                img.save(out, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+            raw, mime = out.getvalue(), "image/jpeg"
+        except Exception as e:
+            raise ValueError(f"unreadable image: {e}")
+    digest = hashlib.sha256(raw).hexdigest()
+    return f"data:{mime};base64,{base64.b64encode(raw).decode()}", digest
+
+# ── Crypto prices ──────────────────────────────────────────────────────────────
+# One in-process price book behind /market and the crypto_price tool: requested
+# coin ids are batched into a single CoinGecko call, fresh entries are served
+# from memory, stale ones are served immediately while a background refresh
+# runs, and concurrent refreshes collapse into one upstream request.
+
+COINGECKO_URL          = os.environ.get("COINGECKO_BASE_URL", "https://api.coingecko.com/api/v3")
+PRICE_FRESH_TTL        = float(os.environ.get("PRICE_FRESH_TTL", "60"))
+PRICE_MAX_STALE        = float(os.environ.get("PRICE_MAX_STALE", "1800"))
+PRICE_REFRESH_INTERVAL = float(os.environ.get("PRICE_REFRESH_INTERVAL", "45"))
+PRICE_TRACK_TTL        = float(os.environ.get("PRICE_TRACK_TTL", "1800"))
+PRICE_TRACK_MAX        = int(os.environ.get("PRICE_TRACK_MAX", "200"))
+PRICE_FETCH_CHUNK      = 50     # ids per simple/price request
+PRICE_DEFAULT_IDS      = ("bitcoin", "ethereum", "solana")
+
+class PriceService:
+    def __init__(self):
+        self._prices: dict  = {}     # coin -> (fetched_at, info)
+        self._tracked: dict = {c: float("inf") for c in PRICE_DEFAULT_IDS}   # coin -> last asked
+        self._lock          = threading.Lock()
+        self._fetch_lock    = threading.Lock()    # one upstream request at a time
+        self._session       = requests.Session()
+        self._backoff_until = 0.0
+        self._thread        = None
+        self._refreshing    = False     # one background SWR refresh at a time
+        self.stats = {"fresh": 0, "stale": 0, "missing": 0, "fetches": 0, "errors": 0, "rate_limited": 0}
+
+    @staticmethod
+    def _normalize(ids) -> list:
+        out = []
+        for c in ids or ():
+            c = str(c).strip().lower()
+            if c and c not in out:
+                out.append(c)
+        return out[:50]
+
+    def _classify(self, ids: list, now: float) -> tuple:
+        fresh, stale, missing = {}, [], []
+        with self._lock:
+            for c in ids:
+                entry = self._prices.get(c)
+                if entry is None or now - entry[0] > PRICE_MAX_STALE:
+                    missing.append(c); continue
+                self._track(c, now)
+                fresh[c] = entry[1]
+                if now - entry[0] > PRICE_FRESH_TTL:
+                    stale.append(c)
+            self.stats["fresh"]   += len(fresh) - len(stale)
+            self.stats["stale"]   += len(stale)
+            self.stats["missing"] += len(missing)
+        return fresh, stale, missing
+
+    def _track(self, coin: str, now: float):
+        """Keep `coin` in the refresh set (caller holds _lock); only ids CoinGecko has answered for get here."""
+        if coin not in self._tracked and len(self._tracked) >= PRICE_TRACK_MAX:
+            oldest = min(self._tracked, key=self._tracked.get)
+            if self._tracked[oldest] == float("inf"):
+                return
+            del self._tracked[oldest]
+        self._tracked[coin] = max(self._tracked.get(coin, 0.0), now)
+
+    def peek(self, ids) -> tuple:
+        """Non-blocking: (known prices, ids that need a synchronous fetch). Kicks off SWR refresh."""
+        ids = self._normalize(ids)
+        known, stale, missing = self._classify(ids, time.time())
+        if stale:
+            self.refresh_in_background(stale)
+        return known, missing
+
+    def get(self, ids) -> dict:
+        """Blocking read (executor threads): fetches whatever isn't cached yet."""
+        ids = self._normalize(ids)
+        known, missing = self.peek(ids)
+        if missing:
+            self._fetch(missing)
+            now = time.time()
+            with self._lock:
+                for c in missing:
+                    if c in self._prices:
+                        known[c] = self._prices[c][1]
+                        self._track(c, now)
+        return {c: known[c] for c in ids if c in known}
+
+    def _fetch(self, ids: list, blocking: bool = True):
+        if not self._fetch_lock.acquire(blocking=blocking):
+            return
+        try:
+            now = time.time()
+            with self._lock:   # someone may have refreshed these while we waited
+                ids = [c for c in ids if c not in self._prices
+                       or now - self._prices[c][0] > PRICE_FRESH_TTL]
+            if not ids or now < self._backoff_until:
+                return
+            self.stats["fetches"] += 1
+            r = self._session.get(f"{COINGECKO_URL}/simple/price",
+                                  params={"ids": ",".join(ids), "vs_currencies": "usd",
+                                          "include_24hr_change": "true"},
+                                  timeout=8)
+            if r.status_code == 429:
+                self.stats["rate_limited"] += 1
+                wait = _parse_duration(r.headers.get("retry-after")) or 60.0
+                self._backoff_until = time.time() + wait
+                logger.warning(f"CoinGecko 429 — serving cached prices for {wait:.0f}s")
+                return
+            r.raise_for_status()
+            data    = r.json()
+            fetched = time.time()
+            with self._lock:
+                for coin, info in data.items():
+                    self._prices[coin] = (fetched, info)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"CoinGecko fetch failed: {e}")
+        finally:
+            self._fetch_lock.release()
+
+    def refresh_in_background(self, ids: list):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self._fetch(ids, False)
+            finally:
+                self._refreshing = False
+        threading.Thread(target=run, daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            now = time.time()
+            with self._lock:
+                for c in [c for c, ts in self._tracked.items() if now - ts > PRICE_TRACK_TTL]:
+                    del self._tracked[c]
+                for c in [c for c, (ts, _) in self._prices.items()
+                          if c not in self._tracked and now - ts > PRICE_MAX_STALE]:
+                    del self._prices[c]
+                ids = list(self._tracked)
+            for i in range(0, len(ids), PRICE_FETCH_CHUNK):
+                self._fetch(ids[i:i + PRICE_FETCH_CHUNK])
+            time.sleep(PRICE_REFRESH_INTERVAL)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, name="price-refresh", daemon=True)
+            self._thread.start()
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {"coins": len(self._prices), "tracked": len(self._tracked),
+                    "backoff_s": round(max(0.0, self._backoff_until - now), 1),
+                    "oldest_age_s": round(max((now - ts for ts, _ in self._prices.values()), default=0.0), 1),
+                    **self.stats}
+
+prices = PriceService()
+
+@app.on_event("startup")
+async def _start_price_refresh():
+    prices.start()
+
+# ── GitHub ─────────────────────────────────────────────────────────────────────
+# Long-lived REST client for the github_* tools. Every GET is conditional
+# (If-None-Match on the stored ETag) — 304s are free against the rate limit —
+# and the recursive repo tree is cached so directory listings are served
+# locally after one fetch.
+
+GITHUB_API_URL   = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+GH_DEFAULT_REPO  = "GodLocal2026/godlocal-site"
+GH_CACHE_SIZE    = int(os.environ.get("GH_CACHE_SIZE", "256"))
+GH_BLOB_BYTES    = int(os.environ.get("GH_BLOB_CACHE_MB", "32")) * 1024 * 1024   # decoded file text
+GH_TREE_TTL      = float(os.environ.get("GH_TREE_TTL", "60"))   # revalidate tree after this
+
+class GitHubClient:
+    def __init__(self, token: str):
+        self._session = requests.Session()
+        self._session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28",
+        })
+        self._lock     = threading.Lock()
+        self._etags    = OrderedDict()   # (kind, repo, path, ref) -> (etag, payload)
+        self._blobs    = OrderedDict()   # blob sha -> (decoded file split into lines, chars)
+        self._blob_bytes = 0
+        self._trees: dict = {}           # (repo, ref) -> (checked_at, entries, truncated)
+        self._branches: dict = {}        # repo -> default branch
+        self._pool     = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="gh")
+        self.stats_counters = {"requests": 0, "not_modified": 0, "served_local": 0, "fetched": 0,
+                               "blob_hits": 0, "blob_misses": 0}
+        CACHES["github"] = self
+        # 304s and locally served tree listings are hits, full GET bodies misses
+        metrics.register_cache("github", lambda: {
+            "hits":   self.stats_counters["not_modified"] + self.stats_counters["served_local"],
+            "misses": self.stats_counters["fetched"]})
+        metrics.register_cache("github_blobs", lambda: {
+            "hits": self.stats_counters["blob_hits"], "misses": self.stats_counters["blob_misses"]})
+
+    def _remember(self, store: OrderedDict, key, value):
+        with self._lock:
+            store[key] = value
+            store.move_to_end(key)
+            while len(store) > GH_CACHE_SIZE:
+                store.popitem(last=False)
+
+    def _get(self, url: str, key: tuple, params: dict = None, cache: bool = True):
+        with self._lock:
+            cached = self._etags.get(key) if cache else None
+            if cached:
+                self._etags.move_to_end(key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        self.stats_counters["requests"] += 1
+        r = self._session.get(f"{GITHUB_API_URL}{url}", params=params, headers=headers, timeout=15)
+        if r.status_code == 304 and cached:
+            self.stats_counters["not_modified"] += 1
+            return cached[1]
+        r.raise_for_status()
+        self.stats_counters["fetched"] += 1
+        payload = r.json()
+        if cache and r.headers.get("ETag"):
+            self._remember(self._etags, key, (r.headers["ETag"], payload))
+        return payload
+
+    def default_branch(self, repo: str) -> str:
+        branch = self._branches.get(repo)
+        if branch is None:
+            branch = self._get(f"/repos/{repo}", ("repo", repo, "", ""))["default_branch"]
+            self._branches[repo] = branch
+        return branch
+
+    def _remember_blob(self, sha: str, lines: list):
+        """LRU bounded by GH_CACHE_SIZE entries and GH_BLOB_BYTES of text; bigger files aren't kept."""
+        size = sum(len(line) + 1 for line in lines)
+        if size > GH_BLOB_BYTES:
+            return
+        with self._lock:
+            old = self._blobs.pop(sha, None)
+            if old is not None:
+                self._blob_bytes -= old[1]
+            self._blobs[sha] = (lines, size)
+            self._blob_bytes += size
+            while len(self._blobs) > GH_CACHE_SIZE or self._blob_bytes > GH_BLOB_BYTES:
+                self._blob_bytes -= self._blobs.popitem(last=False)[1][1]
+
+    def _decode(self, sha: str, payload: dict, repo: str) -> list:
+        # The ETag cache keeps this payload dict; its base64 body is dropped here so
+        # each file's text is held once, in _blobs. An evicted blob is refetched.
+        content = payload.pop("content", None)
+        with self._lock:
+            cached = self._blobs.get(sha)
+            if cached is not None:
+                self._blobs.move_to_end(sha)
+                self.stats_counters["blob_hits"] += 1
+                return cached[0]
+        self.stats_counters["blob_misses"] += 1
+        if payload.get("encoding") == "base64" and content:
+            raw = base64.b64decode(content)
+        else:   # > 1 MB or already stripped: the blob API has the body (immutable by sha, so no ETag entry)
+            blob = self._get(f"/repos/{repo}/git/blobs/{sha}", ("blob", repo, sha, ""), cache=False)
+            raw  = base64.b64decode(blob.get("content") or "")
+        lines = raw.decode("utf-8", errors="replace").splitlines()
+        self._remember_blob(sha, lines)
+        return lines
+
+    def get_file(self, repo: str, path: str, ref: str = None) -> dict:
+        payload = self._get(f"/repos/{repo}/contents/{path.lstrip('/')}",
+                            ("contents", repo, path, ref or ""),
+                            params={"ref": ref} if ref else None)
+        if isinstance(payload, list):
+            raise IsADirectoryError(f"{path} is a directory")
+        return {"path": payload["path"], "sha": payload["sha"], "size": payload.get("size", 0),
+                "lines": self._decode(payload["sha"], payload, repo)}
+
+    def file_sha(self, repo: str, path: str, ref: str = None) -> str | None:
+        try:
+            payload = self._get(f"/repos/{repo}/contents/{path.lstrip('/')}",
+                                ("contents", repo, path, ref or ""),
+                                params={"ref": ref} if ref else None)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+        return None if isinstance(payload, list) else payload["sha"]
+
+    def tree(self, repo: str, ref: str = None) -> tuple:
+        """(entries, truncated) for the whole repo at ref, revalidated at most every GH_TREE_TTL."""
+        ref = ref or self.default_branch(repo)
+        now = time.monotonic()
+        cached = self._trees.get((repo, ref))
+        if cached and now - cached[0] < GH_TREE_TTL:
+            self.stats_counters["served_local"] += 1
+            return cached[1], cached[2]
+        payload = self._get(f"/repos/{repo}/git/trees/{ref}", ("tree", repo, "", ref),
+                            params={"recursive": "1"})
+        entries = [{"path": e["path"], "type": "dir" if e["type"] == "tree" else "file",
+                    "size": e.get("size", 0), "sha": e["sha"], "mode": e.get("mode")}
+                   for e in payload.get("tree", [])]
+        truncated = bool(payload.get("truncated"))
+        self._trees[(repo, ref)] = (now, entries, truncated)
+        return entries, truncated
+
+    def list_dir(self, repo: str, path: str = "", ref: str = None) -> list:
+        """[(name, type)] for a directory, from the cached tree when it's complete."""
+        path = path.strip("/")
+        entries, truncated = self.tree(repo, ref)
+        if not truncated:
+            if path and not any(e["path"] == path and e["type"] == "dir" for e in entries):
+                raise FileNotFoundError(f"{path} not found in {repo}")
+            prefix = f"{path}/" if path else ""
+            return [(e["path"][len(prefix):], e["type"]) for e in entries
+                    if e["path"].startswith(prefix) and "/" not in e["path"][len(prefix):]]
+        payload = self._get(f"/repos/{repo}/contents/{path}", ("contents", repo, path, ref or ""),
+                            params={"ref": ref} if ref else None)
+        return [(f["name"], f["type"]) for f in payload]
+
+    def put_file(self, repo: str, path: str, content: str, message: str, branch: str = None) -> tuple:
+        """Create or update one file on `branch` (default branch if None); returns (commit sha, created?)."""
+        sha  = self.file_sha(repo, path, branch)
+        body = {"message": message, "content": base64.b64encode(content.encode()).decode()}
+        if sha:
+            body["sha"] = sha
+        if branch:
+            body["branch"] = branch
+        r = self._session.put(f"{GITHUB_API_URL}/repos/{repo}/contents/{path.lstrip('/')}",
+                              json=body, timeout=30)
+        r.raise_for_status()
+        self.invalidate(repo)
+        return r.json()["commit"]["sha"], sha is None
+
+    def _post(self, url: str, body: dict) -> dict:
+        self.stats_counters["requests"] += 1
+        r = self._session.post(f"{GITHUB_API_URL}{url}", json=body, timeout=30)
+        r.raise_for_status()
+        return r.json()
+
+    def commit_files(self, repo: str, files: list, message: str, branch: str = None) -> str:
+        """
+        Write several files as one commit via the Git data API: blobs are created
+        concurrently, then one tree, one commit and a fast-forward of the branch.
+        files: [{"path": ..., "content": ...}] — "delete": true removes the path.
+        """
+        branch = branch or self.default_branch(repo)
+
+        def make_blob(f):
+            if f.get("delete"):
+                return None
+            return self._post(f"/repos/{repo}/git/blobs",
+                              {"content": f.get("content", ""), "encoding": "utf-8"})["sha"]
+
+        blob_shas = list(self._pool.map(make_blob, files))
+        for attempt in range(3):
+            ref = self._session.get(f"{GITHUB_API_URL}/repos/{repo}/git/ref/heads/{branch}", timeout=15)
+            ref.raise_for_status()
+            head      = ref.json()["object"]["sha"]
+            base = self._session.get(f"{GITHUB_API_URL}/repos/{repo}/git/commits/{head}", timeout=15)
+            base.raise_for_status()
+            base_tree = base.json()["tree"]["sha"]
+            # Existing paths keep their mode (executable bits, symlinks); only new files get 100644.
+            # A tree sha is immutable, so tree() caches it for free.
+            modes = {e["path"]: e["mode"] for e in self.tree(repo, base_tree)[0] if e["mode"]}
+            tree  = [{"path": path, "mode": modes.get(path, "100644"), "type": "blob", "sha": sha}
+                     for path, sha in ((f["path"].lstrip("/"), sha) for f, sha in zip(files, blob_shas))]
+            new_tree  = self._post(f"/repos/{repo}/git/trees", {"base_tree": base_tree, "tree": tree})
+            commit    = self._post(f"/repos/{repo}/git/commits",
+                                   {"message": message, "tree": new_tree["sha"], "parents": [head]})
+            r = self._session.patch(f"{GITHUB_API_URL}/repos/{repo}/git/refs/heads/{branch}",
+                                    json={"sha": commit["sha"]}, timeout=15)
+            if r.status_code == 422 and attempt < 2:   # branch moved underneath us — rebase on new head
+                continue
+            r.raise_for_status()
+            self.invalidate(repo)
+            return commit["sha"]
+        raise RuntimeError("branch kept moving, commit not applied")
+
+    def invalidate(self, repo: str):
+        with self._lock:
+            for key in [k for k in self._etags if k[0] == "contents" and k[1] == repo]:
+                del self._etags[key]
+            for key in [k for k in self._trees if k[0] == repo]:
+                del self._trees[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"etag_entries": len(self._etags), "blobs": len(self._blobs),
+                    "blob_mb": round(self._blob_bytes / 1048576, 1),
+                    "trees": len(self._trees), **self.stats_counters}
+
+_github: GitHubClient | None = None
+
+def github_client() -> GitHubClient:
+    global _github
+    if _github is None:
+        _github = GitHubClient(GH_TOKEN)
+    return _github
+
 # ── Tool Executors ─────────────────────────────────────────────────────────────
 
 def _tool_web_search(args: dict) -> str:
-    q = args.get("query", "")
+    q   = args.get("query", "")
+    key = _normalize_query(q)
+    if not key:
+        return "No results found"
+    return _search_cache.get_or_load(
+        key, lambda: _web_search_uncached(q),
+        cacheable=lambda out: not out.startswith(("Serper error", "Search error")))
+
+def _search_results(q: str, num: int = 5) -> list:
+    """Organic results as {title, url, snippet}: Serper when keyed, DuckDuckGo otherwise. Raises on provider errors."""
     if SERPER_KEY:
-        try:
-            r = requests.post("https://google.serper.dev/search",
-                              json={"q": q, "num": 5},
-                              headers={"X-API-KEY": SERPER_KEY}, timeout=10)
-            data = r.json()
-            results = []
-            for item in data.get("organic", [])[:5]:
-                title   = item.get('title', '')
-                snippet = item.get('snippet', '')[:200]
-                link    = item.get('link', '')
-                if link:
-                    results.append(f"[{title}]({link}): {snippet}")
-                else:
-                    results.append(f"{title}: {snippet}")
-            return "\n".join(results) if results else "No results found"
-        except Exception as e:
-            return f"Serper error: {e}"
-    # Fallback: DuckDuckGo
+        r = requests.post(SERPER_URL,
+                          json={"q": q, "num": num},
+                          headers={"X-API-KEY": SERPER_KEY}, timeout=10)
+        return [{"title": item.get("title", ""), "url": item.get("link", ""),
+                 "snippet": item.get("snippet", "")}
+                for item in r.json().get("organic", [])[:num]]
+    from duckduckgo_search import DDGS
+    with DDGS() as ddgs:
+        results = list(ddgs.text(q, max_results=num))
+    return [{"title": r.get("title", ""), "url": r.get("href", ""), "snippet": r.get("body", "")}
+            for r in results]
+
+def _web_search_uncached(q: str) -> str:
     try:
-        from duckduckgo_search import DDGS
-        with DDGS() as ddgs:
-            results = list(ddgs.text(q, max_results=5))
-        out = []
-        for r in results:
-            title   = r.get("title", "")
-            body    = r.get("body", "")[:200]
-            href    = r.get("href", "")
-            if href:
-                out.append(f"[{title}]({href}): {body}")
-            else:
-                out.append(f"{title}: {body}")
-        return "\n".join(out) if out else "No results"
+        results = _search_results(q)
     except Exception as e:
-        return f"Search error: {e}"
+        return f"{'Serper' if SERPER_KEY else 'Search'} error: {e}"
+    out = []
+    for r in results:
+        if r["url"]:
+            out.append(f"[{r['title']}]({r['url']}): {r['snippet'][:200]}")
+        else:
+            out.append(f"{r['title']}: {r['snippet'][:200]}")
+    return "\n".join(out) if out else ("No results found" if SERPER_KEY else "No results")
 
 def _tool_send_telegram(args: dict) -> str:
     if not TG_TOKEN:
@@ -563,70 +2410,167 @@ def _tool_search_twitter(args: dict) -> str:
     except Exception as e:
         return f"Twitter search error: {e}"
 
+# Line-indexed reads: return only the requested regions, numbered, so the
+# agent can pull one function out of a 3000-line file in a single call.
+
+READ_MAX_LINES   = int(os.environ.get("GH_READ_MAX_LINES", "200"))
+READ_CONTEXT     = 5
+READ_MAX_MATCHES = 20
+READ_BLOCK_CAP   = 150
+_DEF_RE = re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?"
+                     r"(?:def|class|function|interface|type|const|let|var)\s+([A-Za-z_$][\w$]*)")
+
+def _outline(lines: list, limit: int = 60) -> list:
+    """Line indexes of definitions; when there are too many, keep the least indented."""
+    defs = [(len(line) - len(line.lstrip()), i) for i, line in enumerate(lines) if _DEF_RE.match(line)]
+    return sorted(i for _, i in sorted(defs)[:limit])
+
+def _symbol_block(lines: list, i: int) -> tuple:
+    """0-based inclusive span of the definition starting at line i (indent- or brace-delimited)."""
+    head   = lines[i]
+    indent = len(head) - len(head.lstrip())
+    last   = min(len(lines) - 1, i + READ_BLOCK_CAP)
+    if head.rstrip().endswith(":"):                      # Python-style block
+        end = i
+        for j in range(i + 1, last + 1):
+            line = lines[j]
+            if line.strip() and len(line) - len(line.lstrip()) <= indent:
+                break
+            if line.strip():
+                end = j
+        return i, end
+    depth, opened = 0, False
+    for j in range(i, last + 1):
+        depth += lines[j].count("{") - lines[j].count("}")
+        opened = opened or "{" in lines[j]
+        if opened and depth <= 0:
+            return i, j
+        if not opened and j - i >= 2:
+            return i, i
+    return i, last
+
+def _find_symbol(lines: list, name: str) -> list:
+    pat = re.compile(rf"(?:\b(?:def|class|function|interface|type|const|let|var)\s+{re.escape(name)}\b"
+                     rf"|\b{re.escape(name)}\s*[:=]\s*(?:async\s*)?(?:function\b|\())")
+    return [i for i, line in enumerate(lines) if pat.search(line)]
+
+def _merge_regions(regions: list) -> list:
+    merged = []
+    for a, b in sorted(regions):
+        if merged and a <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    return merged
+
+def _render_regions(lines: list, regions: list) -> tuple:
+    out, shown = [], 0
+    for a, b in regions:
+        if shown >= READ_MAX_LINES:
+            break
+        if out:
+            out.append("  ...")
+        b = min(b, a + READ_MAX_LINES - shown - 1)
+        out.extend(f"{n + 1:>5}| {lines[n]}" for n in range(a, b + 1))
+        shown += b - a + 1
+    return "\n".join(out), shown
+
 def _tool_github_read_file(args: dict) -> str:
-    repo = args.get("repo", "GodLocal2026/godlocal-site")
+    repo = args.get("repo", GH_DEFAULT_REPO)
     path = args.get("path", "")
     if not GH_TOKEN:
         return "❌ GITHUB_TOKEN not set in Render env vars"
     try:
-        from github import Github
-        g    = Github(GH_TOKEN)
-        file = g.get_repo(repo).get_contents(path)
-        content = base64.b64decode(file.content).decode("utf-8", errors="replace")
-        # Truncate to avoid huge tokens
-        if len(content) > 4000:
-            content = content[:4000] + "\n... [truncated]"
-        return f"**{repo}/{path}** (SHA: {file.sha[:8]}):\n```\n{content}\n```"
+        file  = github_client().get_file(repo, path, args.get("ref"))
+        lines = file["lines"]
+        total = len(lines)
+        head  = f"**{repo}/{path}** (SHA: {file['sha'][:8]}, {total} lines)"
+        if not total:
+            return f"{head}: empty file"
+
+        regions, notes = [], []
+        context = max(0, min(int(args.get("context", READ_CONTEXT)), 50))
+        if args.get("start_line") or args.get("end_line"):
+            start = max(1, int(args.get("start_line") or 1))
+            end   = min(total, int(args.get("end_line") or start + READ_MAX_LINES - 1))
+            if start <= end:
+                regions.append((start - 1, end - 1))
+        for sym in filter(None, [args.get("symbol")]):
+            hits = _find_symbol(lines, sym)
+            regions.extend(_symbol_block(lines, i) for i in hits[:3])
+            if not hits:
+                notes.append(f"symbol `{sym}` not found")
+        terms = args.get("search") or []
+        if isinstance(terms, str):
+            terms = [terms]
+        for term in terms:
+            low  = term.lower()
+            hits = [i for i, line in enumerate(lines) if low in line.lower()]
+            regions.extend((max(0, i - context), min(total - 1, i + context))
+                           for i in hits[:READ_MAX_MATCHES])
+            notes.append(f"`{term}`: {len(hits)} match(es)"
+                         + (f", first {READ_MAX_MATCHES} shown" if len(hits) > READ_MAX_MATCHES else ""))
+
+        outline = ""
+        if not regions:
+            if total <= READ_MAX_LINES:
+                regions = [(0, total - 1)]
+            else:   # big file, no selector: the top plus a map of where things are
+                regions = [(0, 79)]
+                defs    = _outline(lines)
+                if defs:
+                    outline = "\n\nOutline (line: definition):\n" + "\n".join(
+                        f"{i + 1}: {lines[i].strip()[:100]}" for i in defs)
+                notes.append("use start_line/end_line, search or symbol to read further")
+
+        body, shown = _render_regions(lines, _merge_regions(regions))
+        if shown >= READ_MAX_LINES:
+            notes.append(f"output capped at {READ_MAX_LINES} lines — narrow the range")
+        note = f" — {'; '.join(notes)}" if notes else ""
+        return f"{head}{note}:\n```\n{body}\n```{outline}"
     except Exception as e:
         return f"❌ GitHub read error: {e}"
 
 def _tool_github_push_file(args: dict) -> str:
-    repo    = args.get("repo", "GodLocal2026/godlocal-site")
+    repo    = args.get("repo", GH_DEFAULT_REPO)
     path    = args.get("path", "")
     content = args.get("content", "")
     message = args.get("message", "Update from OASIS Agent")
+    files   = [f for f in (args.get("files") or []) if isinstance(f, dict) and f.get("path")]
     if not GH_TOKEN:
         return "❌ GITHUB_TOKEN not set in Render env vars"
     try:
-        from github import Github
-        g    = Github(GH_TOKEN)
-        ghrepo = g.get_repo(repo)
-        try:
-            existing = ghrepo.get_contents(path)
-            result   = ghrepo.update_file(path, message, content, existing.sha)
-            sha = result["commit"].sha[:10]
-            return f"✅ Updated {repo}/{path} (commit: {sha})"
-        except Exception:
-            result = ghrepo.create_file(path, message, content)
-            sha = result["commit"].sha[:10]
-            return f"✅ Created {repo}/{path} (commit: {sha})"
+        if files:
+            if path:
+                files.append({"path": path, "content": content})
+            sha   = github_client().commit_files(repo, files, message, args.get("branch"))
+            paths = ", ".join(f["path"] for f in files)
+            return f"✅ Committed {len(files)} file(s) to {repo}: {paths} (commit: {sha[:10]})"
+        branch = args.get("branch")
+        sha, created = github_client().put_file(repo, path, content, message, branch)
+        where = f" on {branch}" if branch else ""
+        return f"✅ {'Created' if created else 'Updated'} {repo}/{path}{where} (commit: {sha[:10]})"
     except Exception as e:
         return f"❌ GitHub push error: {e}"
 
 def _tool_github_list_files(args: dict) -> str:
-    repo = args.get("repo", "GodLocal2026/godlocal-site")
+    repo = args.get("repo", GH_DEFAULT_REPO)
     path = args.get("path", "")
     if not GH_TOKEN:
         return "❌ GITHUB_TOKEN not set in Render env vars"
     try:
-        from github import Github
-        g       = Github(GH_TOKEN)
-        files   = g.get_repo(repo).get_contents(path)
-        entries = [f"{'📁' if f.type == 'dir' else '📄'} {f.name}" for f in files]
+        files   = github_client().list_dir(repo, path, args.get("ref"))
+        entries = [f"{'📁' if kind == 'dir' else '📄'} {name}" for name, kind in files]
         return "\n".join(entries) if entries else "Empty directory"
     except Exception as e:
         return f"❌ GitHub list error: {e}"
 
 def _tool_crypto_price(args: dict) -> str:
-    coins = args.get("coins", ["bitcoin", "ethereum", "solana"])
-    ids   = ",".join(coins)
+    coins = args.get("coins") or list(PRICE_DEFAULT_IDS)
+    if isinstance(coins, str):
+        coins = coins.split(",")
     try:
-        r = requests.get(
-            "https://api.coingecko.com/api/v3/simple/price",
-            params={"ids": ids, "vs_currencies": "usd", "include_24hr_change": "true"},
-            timeout=8
-        )
-        data = r.json()
+        data = prices.get(coins)
         lines = []
         for coin, info in data.items():
             price  = info.get("usd", "?")
@@ -683,29 +2627,595 @@ def run_tool(name: str, args: dict, sid: str) -> str:
     if name == "post_instagram":   return _tool_post_instagram(args)
     return f"Unknown tool: {name}"
 
+TOOL_TIMEOUT  = float(os.environ.get("TOOL_TIMEOUT", "20"))
+TOOL_TIMEOUTS = {
+    "remember":         2,
+    "crypto_price":     10,
+    "web_search":       15,
+    "search_twitter":   15,
+    "send_telegram":    15,
+    "github_read_file": 20,
+    "github_list_files":20,
+    "github_push_file": 45,
+    "post_instagram":   45,
+}
+
+TOOL_POOLS = {"remember": memory_pool}     # everything else is network-bound → tools_pool
+
+async def run_tool_async(name: str, args: dict, sid: str) -> str:
+    """run_tool on its pool with a per-tool timeout; never raises."""
+    timeout = TOOL_TIMEOUTS.get(name, TOOL_TIMEOUT)
+    pool    = TOOL_POOLS.get(name, tools_pool)
+    try:
+        job = pool.prepare(run_tool, name, args, sid)
+    except PoolSaturated as e:
+        logger.warning(f"Tool {name} shed: {e}")
+        metrics.TOOL_LATENCY.observe(0.0, tool=name, outcome="rejected")
+        return f"❌ {name}: {OVERLOADED}"
+    try:
+        with metrics.TOOL_LATENCY.time(tool=name) as labels, tracing.span("tool", tool=name) as attrs:
+            try:
+                result = await asyncio.wait_for(pool.start(job), timeout)
+            except asyncio.TimeoutError:
+                labels["outcome"] = attrs["outcome"] = "timeout"
+                raise
+            finally:
+                if job.waited is not None:
+                    attrs["queue_ms"] = round(job.waited * 1000, 1)
+        return str(result)
+    except asyncio.TimeoutError:
+        logger.warning(f"Tool {name} timed out after {timeout:.0f}s")
+        return f"❌ {name} timed out after {timeout:.0f}s"
+    except Exception as e:
+        logger.warning(f"Tool {name} failed: {e}")
+        return f"❌ {name} error: {e}"
+
+# ── Conversations ──────────────────────────────────────────────────────────────
+# Server-side /ws/oasis history keyed by sid: both roles are recorded, it
+# outlives the socket, and once it grows past CONV_COMPACT_AT turns the older
+# ones are folded in the background into layered summary state (the L2/L3/L5/L6
+# scheme of godlocal_hitl.cell_state.CellState), so prompt size stays flat.
+# History stays per worker process (not in state.py): with several workers a
+# reconnect that lands on another one starts a fresh history — memories, which
+# are shared, still carry over. Route by sid if that matters.
+
+CONV_MAX_TURNS    = int(os.environ.get("CONV_MAX_TURNS", "40"))     # hard bound per session
+CONV_COMPACT_AT   = int(os.environ.get("CONV_COMPACT_AT", "16"))
+CONV_KEEP_TURNS   = int(os.environ.get("CONV_KEEP_TURNS", "6"))     # raw turns kept after compaction
+CONV_TURN_CHARS   = 2000
+CONV_IDLE_TTL     = float(os.environ.get("CONV_IDLE_TTL", str(6 * 3600)))
+CONV_LAYERS       = ("l2_history", "l3_live", "l5_intent", "l6_actions")
+CONV_RETRY_BASE   = float(os.environ.get("CONV_RETRY_BASE", "60"))   # after a failed compaction, doubling
+CONV_RETRY_MAX    = 1800.0
+
+class Conversation:
+    __slots__ = ("sid", "turns", "layers", "compacting", "touched", "failures", "retry_at")
+
+    def __init__(self, sid: str):
+        self.sid        = sid
+        self.turns      = deque(maxlen=CONV_MAX_TURNS)
+        self.layers     = {}
+        self.compacting = False
+        self.touched    = time.time()
+        self.failures   = 0             # consecutive failed compactions
+        self.retry_at   = 0.0           # no compaction attempt before this
+
+    def render_summary(self) -> str:
+        if not self.layers:
+            return ""
+        l = self.layers
+        return ("## CELL STATE\n"
+                f"L2: {l.get('l2_history', '')}\n"
+                f"L3: {json.dumps(l.get('l3_live', {}), ensure_ascii=False)}\n"
+                f"L5: {json.dumps(l.get('l5_intent', {}), ensure_ascii=False)}\n"
+                f"L6: {json.dumps(l.get('l6_actions', {}), ensure_ascii=False)}")
+
+class ConversationStore:
+    def __init__(self):
+        self._convs: dict = {}
+        self._lock = threading.Lock()
+        self._tasks: set = set()     # running compactions; the loop only keeps weak references
+        self.stats = {"compactions": 0, "compaction_errors": 0, "evicted": 0}
+
+    def get(self, sid: str) -> Conversation:
+        with self._lock:
+            conv = self._convs.get(sid)
+            if conv is None:
+                conv = self._convs[sid] = Conversation(sid)
+            conv.touched = time.time()
+            return conv
+
+    def history(self, sid: str) -> list:
+        return [{"role": t["role"], "content": t["content"]} for t in self.get(sid).turns]
+
+    def summary(self, sid: str) -> str:
+        return self.get(sid).render_summary()
+
+    def add_turn(self, sid: str, role: str, content: str):
+        conv = self.get(sid)
+        conv.turns.append({"role": role, "content": content[:CONV_TURN_CHARS],
+                           "at": datetime.utcnow().isoformat()})
+        if len(conv.turns) >= CONV_COMPACT_AT and not conv.compacting and time.time() >= conv.retry_at:
+            conv.compacting = True
+            task = asyncio.get_running_loop().create_task(self._compact(conv))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, conv: Conversation):
+        old = list(conv.turns)[:-CONV_KEEP_TURNS]
+        try:
+            turns_text = "\n".join(f"[{t['role'].upper()}]: {t['content']}" for t in old)
+            prompt = f"""Compress into JSON layers. Output ONLY valid JSON:
+{{
+  "l2_history": "factual events + decisions (append to: {conv.layers.get('l2_history', '')[:800]})",
+  "l3_live": {{"project": {{"status":"...", "done":"...", "blocker":"...", "next":"..."}}}},
+  "l5_intent": {{"goals":["..."], "preferences":{{}}}},
+  "l6_actions": {{"completed":["..."], "next":[{{"label":"(AI)","action":"..."}}]}}
+}}
+Previous state: {json.dumps({k: conv.layers.get(k) for k in CONV_LAYERS[1:]}, ensure_ascii=False)[:1200]}
+
+TURNS:
+{truncate_tokens(turns_text, 3000)}"""
+            resp, err = await groq_chat([{"role": "user", "content": prompt}], max_tokens=700,
+                                        session_id=conv.sid, priority="background")
+            if err or not resp:
+                raise RuntimeError(err or "empty response")
+            raw    = resp["choices"][0]["message"].get("content") or ""
+            parsed = json.loads(raw[raw.find("{"):raw.rfind("}") + 1])
+            conv.layers.update({k: parsed[k] for k in CONV_LAYERS if k in parsed})
+            while conv.turns and conv.turns[0] in old:     # new turns may have arrived meanwhile
+                conv.turns.popleft()
+            conv.failures = 0
+            self.stats["compactions"] += 1
+        except Exception as e:
+            conv.failures += 1
+            delay = min(CONV_RETRY_MAX, CONV_RETRY_BASE * 2 ** (conv.failures - 1))
+            conv.retry_at = time.time() + delay
+            self.stats["compaction_errors"] += 1
+            logger.warning(f"Conversation compaction failed for {conv.sid} (retry in {delay:.0f}s): {e}")
+        finally:
+            conv.compacting = False
+
+    def evict_idle(self):
+        cutoff = time.time() - CONV_IDLE_TTL
+        with self._lock:
+            for sid in [sid for sid, c in self._convs.items() if c.touched < cutoff]:
+                del self._convs[sid]
+                self.stats["evicted"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._convs),
+                    "turns": sum(len(c.turns) for c in self._convs.values()),
+                    "summarized": sum(1 for c in self._convs.values() if c.layers),
+                    **self.stats}
+
+conversations = ConversationStore()
+
+# ── Deep research ──────────────────────────────────────────────────────────────
+# /ws/deep pipeline: the prompt is expanded into sub-queries, searches and page
+# fetches run concurrently under a shared bound, page text is extracted and
+# de-duplicated, each source is condensed in parallel (map) and one streamed
+# completion writes the cited answer (reduce). Gathering stops at
+# DEEP_BUDGET seconds; whatever has arrived by then is what gets synthesized.
+
+DEEP_SUBQUERIES     = int(os.environ.get("DEEP_SUBQUERIES", "4"))
+DEEP_RESULTS        = int(os.environ.get("DEEP_RESULTS", "5"))        # per sub-query
+DEEP_MAX_SOURCES    = int(os.environ.get("DEEP_MAX_SOURCES", "8"))
+DEEP_CONCURRENCY    = int(os.environ.get("DEEP_CONCURRENCY", "8"))    # searches + fetches in flight
+DEEP_BUDGET         = float(os.environ.get("DEEP_BUDGET", "20"))
+DEEP_FETCH_TIMEOUT  = float(os.environ.get("DEEP_FETCH_TIMEOUT", "6"))
+DEEP_PAGE_BYTES     = 1_500_000
+DEEP_SOURCE_CHARS   = 4000          # extracted text handed to one map call
+DEEP_NOTE_TOKENS    = 300
+_page_cache = TTLCache("pages", int(os.environ.get("PAGE_CACHE_SIZE", "256")),
+                       float(os.environ.get("PAGE_CACHE_TTL", "1800")))
+_deep_sem:  asyncio.Semaphore | None = None
+_page_http: httpx.AsyncClient | None = None
+
+def _deep_slots() -> asyncio.Semaphore:
+    global _deep_sem
+    if _deep_sem is None:
+        _deep_sem = asyncio.Semaphore(DEEP_CONCURRENCY)
+    return _deep_sem
+
+def page_client() -> httpx.AsyncClient:
+    global _page_http
+    if _page_http is None or _page_http.is_closed:
+        _page_http = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(DEEP_FETCH_TIMEOUT, connect=3),
+            limits=httpx.Limits(max_connections=DEEP_CONCURRENCY * 2, max_keepalive_connections=10),
+            headers={"User-Agent": "Mozilla/5.0 (compatible; GodLocalResearch/1.0)",
+                     "Accept": "text/html,text/plain;q=0.9,*/*;q=0.5"},
+        )
+    return _page_http
+
+@app.on_event("shutdown")
+async def _close_page_client():
+    if _page_http is not None and not _page_http.is_closed:
+        await _page_http.aclose()
+
+# Linear single-pass scan instead of block regexes: a boilerplate tag without
+# its closer (or a custom element like <nav-item>) made the old `<(nav|…)\b.*?</\1>`
+# quadratic, and html.parser rescans unclosed tags too. Every search below
+# either advances or ends the scan, and tag names are compared whole.
+_SKIP_TAGS  = frozenset({"nav", "header", "footer", "aside", "form", "noscript", "svg", "template"})
+_RAW_TAGS   = frozenset({"script", "style"})      # contents aren't markup: jump to the closer
+_BREAK_TAGS = frozenset({"p", "div", "br", "li", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "section",
+                         "article", "blockquote", "pre"})
+_TAG_RE     = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9:-]*)[^<>]*>")
+EXTRACT_MAX_CHARS = 600_000
+
+def extract_text(markup: str) -> str:
+    """Readable text from HTML: boilerplate blocks dropped, one paragraph per line. CPU-bound — call it off the loop."""
+    import html as _html
+    markup = markup[:EXTRACT_MAX_CHARS]
+    low    = markup.lower()
+    parts, skip, pos, n = [], 0, 0, len(markup)
+    while pos < n:
+        lt = markup.find("<", pos)
+        if lt < 0:
+            lt = n
+        if not skip and lt > pos:
+            parts.append(markup[pos:lt])
+        if lt >= n:
+            break
+        if markup.startswith("<!--", lt):
+            end = markup.find("-->", lt + 4)
+            if end < 0:
+                break
+            pos = end + 3
+            continue
+        if markup.startswith(("<!", "<?"), lt):
+            end = markup.find(">", lt)
+            if end < 0:
+                break
+            pos = end + 1
+            continue
+        m = _TAG_RE.match(markup, lt)
+        if m is None:                      # stray "<" in text
+            if not skip:
+                parts.append("<")
+            pos = lt + 1
+            continue
+        pos  = m.end()
+        name = m.group(2).lower()
+        if m.group(1):
+            if name in _SKIP_TAGS:
+                skip = max(0, skip - 1)
+            elif name in _BREAK_TAGS:
+                parts.append("\n")
+        elif name in _RAW_TAGS:
+            end = low.find(f"</{name}", pos)
+            if end < 0:
+                break
+            pos = end
+        elif name in _SKIP_TAGS and not m.group(0).endswith("/>"):
+            skip += 1
+        elif name in _BREAK_TAGS:
+            parts.append("\n")
+    text  = _html.unescape("".join(parts))
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if len(line) > 40)
+
+def _canonical_url(url: str) -> str:
+    url = url.split("#", 1)[0]
+    base, _, query = url.partition("?")
+    keep = "&".join(p for p in query.split("&") if p and not p.startswith(("utm_", "ref=", "fbclid=")))
+    return (base.rstrip("/") + ("?" + keep if keep else "")).lower()
+
+def _dedupe_paragraphs(text: str, seen: set) -> str:
+    """Drop paragraphs already contributed by an earlier source (mirrors, syndicated copies)."""
+    kept = []
+    for para in text.splitlines():
+        h = hashlib.blake2b(_normalize_query(para).encode(), digest_size=8).digest()
+        if h not in seen:
+            seen.add(h)
+            kept.append(para)
+    return "\n".join(kept)
+
+async def _fetch_page(url: str) -> str:
+    cached = _page_cache.get(url)
+    if cached is not None:
+        return cached
+    text = ""
+    async with _deep_slots():
+        try:
+            raw = None
+            async with page_client().stream("GET", url) as r:
+                ctype = r.headers.get("content-type", "")
+                if r.status_code == 200 and ("html" in ctype or "text/plain" in ctype):
+                    body = bytearray()
+                    async for part in r.aiter_bytes():
+                        body += part
+                        if len(body) >= DEEP_PAGE_BYTES:
+                            break
+                    raw = body.decode(r.encoding or "utf-8", errors="replace")
+            if raw is not None:
+                text = raw if "text/plain" in ctype else await media_pool.run(extract_text, raw)
+        except Exception as e:
+            logger.info(f"Deep fetch {url[:80]}: {e}")
+            return ""
+    if text:                 # errors, non-HTML and empty pages get retried next time
+        _page_cache.set(url, text)
+    return text
+
+async def _search(q: str) -> list:
+    key = ("results", _normalize_query(q))
+    async with _deep_slots():
+        try:
+            return await tools_pool.run(_search_cache.get_or_load, key,
+                                        lambda: _search_results(q, DEEP_RESULTS))
+        except Exception as e:
+            logger.warning(f"Deep search '{q[:60]}': {e}")
+            return []
+
+async def _until(aws: list, deadline: float) -> list:
+    """Run awaitables concurrently until `deadline`; unfinished ones are cancelled and dropped."""
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    if not tasks:
+        return []
+    done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+    for t in pending:
+        t.cancel()
+    return [t.result() if t in done and not t.cancelled() and t.exception() is None else None
+            for t in tasks]
+
+async def _expand_queries(prompt: str, session_id: str, deadline: float) -> list:
+    messages = [
+        {"role": "system", "content": (
+            f"Разбей вопрос на {DEEP_SUBQUERIES} коротких поисковых запроса, покрывающих разные аспекты. "
+            "Ответь только JSON-массивом строк.")},
+        {"role": "user", "content": prompt},
+    ]
+    resp, err = await groq_chat(messages, max_tokens=200, session_id=session_id, priority="batch",
+                                timeout=max(1.0, deadline - time.monotonic()))
+    queries = []
+    if resp and not err:
+        text  = resp["choices"][0]["message"].get("content") or ""
+        match = re.search(r"\[.*\]", text, re.S)
+        try:
+            queries = [q for q in json.loads(match.group(0)) if isinstance(q, str)] if match else []
+        except Exception:
+            queries = []
+    seen, out = set(), []
+    for q in [prompt[:200]] + queries:
+        if q.strip() and _normalize_query(q) not in seen:
+            seen.add(_normalize_query(q)); out.append(q.strip())
+    return out[:DEEP_SUBQUERIES + 1]
+
+async def _condense(prompt: str, source: dict, session_id: str, deadline: float) -> str:
+    messages = [
+        {"role": "system", "content": (
+            "Выпиши из источника только факты, относящиеся к вопросу: 2-5 коротких пунктов с цифрами и датами. "
+            "Если ничего относящегося нет — ответь NONE.")},
+        {"role": "user", "content": f"Вопрос: {prompt}\n\nИсточник: {source['title']}\n{source['text']}"},
+    ]
+    resp, err = await groq_chat(messages, max_tokens=DEEP_NOTE_TOKENS, session_id=session_id,
+                                priority="batch", timeout=max(1.0, deadline - time.monotonic()))
+    if err or not resp:
+        return ""
+    note = (resp["choices"][0]["message"].get("content") or "").strip()
+    return "" if note.upper().startswith("NONE") else note
+
+async def research(prompt: str, session_id: str, emit, on_token) -> tuple:
+    """
+    Full deep-research pass for one prompt. Progress goes out through
+    `await emit(frame)`, the synthesis through `await on_token(text)`;
+    returns groq_stream's (resp, err).
+    """
+    deadline = time.monotonic() + DEEP_BUDGET
+    t0 = time.perf_counter()
+
+    await emit({"t": "tool_start", "v": "🧭 план поиска"})
+    with tracing.span("deep.plan"):
+        queries = await _expand_queries(prompt, session_id, deadline)
+    await emit({"t": "tool_done", "v": "🧭 план поиска"})
+
+    label = f"🌐 поиск ({len(queries)})"
+    await emit({"t": "tool_start", "v": label})
+    with tracing.span("deep.search", n=len(queries)):
+        batches = await _until([_search(q) for q in queries], deadline)
+    sources, seen_urls = [], set()
+    # interleave round-robin so every sub-query contributes its best hits first
+    batches = [b or [] for b in batches]
+    ranked  = [b[rank] for rank in range(DEEP_RESULTS) for b in batches if rank < len(b)]
+    for r in ranked:
+        url = _canonical_url(r.get("url") or "")
+        if not url or url in seen_urls:
+            continue
+        seen_urls.add(url)
+        sources.append({"title": r.get("title") or url, "url": r["url"], "snippet": r.get("snippet", "")})
+        if len(sources) >= DEEP_MAX_SOURCES:
+            break
+    await emit({"t": "tool_done", "v": label})
+
+    label = f"📄 чтение ({len(sources)})"
+    await emit({"t": "tool_start", "v": label})
+    with tracing.span("deep.fetch", n=len(sources)):
+        pages = await _until([_fetch_page(s["url"]) for s in sources], deadline)
+    seen_paras = set()
+    for s, page in zip(sources, pages):
+        text = _dedupe_paragraphs(page or "", seen_paras)
+        s["text"] = (text or s["snippet"])[:DEEP_SOURCE_CHARS]
+    sources = [s for s in sources if s["text"].strip()]
+    await emit({"t": "tool_done", "v": label})
+
+    label = "🧠 конспект"
+    await emit({"t": "tool_start", "v": label})
+    with tracing.span("deep.map", n=len(sources)):
+        notes = await _until([_condense(prompt, s, session_id, deadline) for s in sources], deadline)
+    for s, note in zip(sources, notes):
+        s["note"] = note if note is not None else s["snippet"]
+    sources = [s for s in sources if s["note"]]
+    await emit({"t": "tool_done", "v": label})
+    logger.info(f"Deep research '{prompt[:40]}': {len(queries)} queries, {len(sources)} sources "
+                f"in {time.perf_counter() - t0:.1f}s")
+
+    today   = datetime.utcnow().strftime("%Y-%m-%d")
+    context = "\n\n".join(f"[{i}] {s['title']} — {s['url']}\n{s['note']}"
+                           for i, s in enumerate(sources, 1)) or "Источники не найдены."
+    messages = [
+        {"role": "system", "content": (
+            f"Ты — GodLocal Deep Research AI. Дата: {today}. Давай развёрнутый структурированный ответ "
+            "только по материалам ниже. Каждое утверждение помечай номером источника [n]. "
+            "В конце — раздел «Источники» со ссылками как [текст](url).")},
+        {"role": "user", "content": f"Вопрос: {prompt}\n\nМатериалы:\n{context}"},
+    ]
+    with tracing.span("deep.reduce", sources=len(sources)):
+        return await groq_stream(messages, on_token, tools=None, max_tokens=2048, session_id=session_id)
+
+# ── WebSocket framing ──────────────────────────────────────────────────────────
+# Token frames are coalesced over a short window / byte threshold instead of
+# one JSON frame per few characters; any other frame flushes pending tokens
+# first so ordering is kept. `?enc=msgpack` switches a socket to binary
+# msgpack frames when the package is available.
+
+FRAME_WINDOW   = float(os.environ.get("FRAME_WINDOW_MS", "40")) / 1000
+FRAME_MAX_BYTES = int(os.environ.get("FRAME_MAX_BYTES", "512"))
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WS_TOTALS = {"connections": 0, "active": 0, "frames": 0, "bytes": 0, "tokens": 0}
+
+class FrameWriter:
+    """Drop-in for WebSocket.send_json that batches {"t": "token"} frames."""
+
+    def __init__(self, ws: WebSocket, encoding: str = "json", endpoint: str = ""):
+        self.ws       = ws
+        self.endpoint = endpoint
+        self.binary   = encoding == "msgpack" and msgpack is not None
+        self._buf     = []
+        self._size    = 0
+        self._timer   = None
+        self._lock    = asyncio.Lock()
+        self.frames = self.bytes = self.tokens = 0
+        self.answers = 0       # "done" frames handed to send_json
+
+    async def _write(self, obj: dict):
+        async with self._lock:
+            if self.binary:
+                data = msgpack.packb(obj, use_bin_type=True)
+                await self.ws.send_bytes(data)
+            else:
+                data = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+                await self.ws.send_text(data)
+            n = len(data)
+            self.frames += 1; self.bytes += n
+            WS_TOTALS["frames"] += 1; WS_TOTALS["bytes"] += n
+            metrics.WS_FRAMES.inc(endpoint=self.endpoint)
+            metrics.WS_BYTES.inc(n, endpoint=self.endpoint)
+
+    async def flush(self):
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+        self._timer = None
+        if not self._buf:
+            return
+        text = "".join(self._buf)          # swap synchronously so order is kept
+        self._buf.clear(); self._size = 0
+        await self._write({"t": "token", "v": text})
+
+    async def _flush_later(self):
+        await asyncio.sleep(FRAME_WINDOW)
+        await self.flush()
+
+    async def send_json(self, obj: dict):
+        if obj.get("t") == "token" and set(obj) <= {"t", "v"}:
+            text = obj.get("v") or ""
+            self._buf.append(text)
+            self._size  += len(text.encode())
+            self.tokens += 1; WS_TOTALS["tokens"] += 1
+            if self._size >= FRAME_MAX_BYTES:
+                await self.flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().create_task(self._flush_later())
+            return
+        if obj.get("t") == "done":
+            self.answers += 1
+        await self.flush()
+        await self._write(obj)
+
+    async def close(self):
+        try:
+            await self.flush()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        return {"encoding": "msgpack" if self.binary else "json", "frames": self.frames,
+                "bytes": self.bytes, "tokens": self.tokens}
+
 # ── Core Agent Loop ────────────────────────────────────────────────────────────
 
-async def run_agent(ws: WebSocket, prompt: str, session_id: str,
-                    history: list, image_base64: str = None):
-    mems = mem_get(session_id)
+async def run_agent(ws: FrameWriter, prompt: str, session_id: str,
+                    history: list, image_base64: str = None, summary: str = "") -> str:
+    """
+    Answer one prompt over `ws`; returns the final text ("" if the model was unavailable).
+    The vision call starts before anything else and the first completion right
+    after it; thinking frames report what is actually happening (memory hits,
+    queueing, model choice, tools) and close when the first token or tool call lands.
+    """
+    vision = (asyncio.create_task(analyze_image(image_base64, prompt, session_id=session_id))
+              if image_base64 else None)
+    image_base64 = None      # the vision task owns the upload now
+    try:
+        return await _run_agent(ws, prompt, session_id, history, vision, summary)
+    finally:
+        # A cancel (or error) before `await vision` must not leave it calling Groq
+        if vision is not None:
+            if not vision.done():
+                vision.cancel()
+            elif not vision.cancelled():
+                vision.exception()       # mark retrieved
+
+async def _run_agent(ws: FrameWriter, prompt: str, session_id: str, history: list,
+                     vision: asyncio.Task | None, summary: str) -> str:
+    thinking = {"open": True}
+
+    async def think(step: str):
+        if thinking["open"]:
+            await ws.send_json({"t": "thinking", "v": step})
+
+    async def end_thinking():
+        if thinking["open"]:
+            thinking["open"] = False
+            await ws.send_json({"t": "thinking_done"})
+
+    await ws.send_json({"t": "thinking_start"})
+    await think(f"Анализирую запрос: «{prompt[:80]}{'...' if len(prompt)>80 else ''}»")
+    # Topic hints cost nothing, so they go out while vision/queueing is in flight
+    low = prompt.lower()
+    if any(w in low for w in ["swap", "fee", "jupiter", "phantom"]):
+        await think("Связано со свапом — смотрю Jupiter v6 интеграцию и fee механику...")
+    if any(w in low for w in ["твит", "twitter", "пост", "запуск", "launch"]):
+        await think("Маркетинговый запрос — думаю про @oassisx100 аудиторию и контент-стратегию...")
+    if any(w in low for w in ["ошибк", "баг", "error", "fix", "сломал"]):
+        await think("Технический вопрос — думаю про стек: FastAPI / Next.js / Render / Vercel...")
+    if any(w in low for w in ["монетиз", "деньги", "доход", "revenue", "заработ"]):
+        await think("Монетизация — приоритет: swap fee → Pro подписка → token creation fee...")
+
+    with tracing.span("memory"):
+        mems = await mem_relevant_async(session_id, prompt)
     mem_block = ""
     if mems:
         mem_block = "\n\nПамять пользователя:\n" + "\n".join(
-            f"- {m['content']}" for m in mems[-10:]
+            f"- {m['content']}" for m in mems
         )
+        await think(f"Нашёл в памяти: {len(mems)}")
     today       = datetime.utcnow().strftime("%Y-%m-%d")
-    sys_content = SYSTEM_PROMPT.format(date=today) + mem_block
+    sys_content = system_prompt(today) + (f"\n\n{summary}" if summary else "") + mem_block
 
-    hist = [m for m in history[-12:]
-            if m.get("role") in ("user", "assistant")
-            and isinstance(m.get("content"), str)]
+    hist = trim_history(history)
 
-    # Image analysis
-    if image_base64:
+    if vision is not None:
         await ws.send_json({"t": "tool_start", "v": "🖼 анализирую фото"})
-        vision_result = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: analyze_image(image_base64, prompt)
-        )
+        with tracing.span("vision.wait"):
+            vision_result = await vision
         await ws.send_json({"t": "tool_done", "v": "🖼 анализирую фото"})
         user_content = f"{prompt}\n\n[Анализ изображения]: {vision_result}"
     else:
@@ -717,42 +3227,23 @@ async def run_agent(ws: WebSocket, prompt: str, session_id: str,
         + [{"role": "user", "content": user_content}]
     )
 
-    # ── Thinking phase (before agent loop) ───────────────────────────────────
-    await ws.send_json({"t": "thinking_start"})
-
-    # Build thinking steps based on prompt context
-    thinking_steps = [
-        f"Анализирую запрос: «{prompt[:80]}{'...' if len(prompt)>80 else ''}»",
-        "Проверяю контекст проекта: slonik52, стратегия, технический стек...",
-    ]
-    # Add context-specific steps
-    low = prompt.lower()
-    if any(w in low for w in ["swap", "fee", "jupiter", "phantom"]):
-        thinking_steps.append("Связано со свапом — смотрю Jupiter v6 интеграцию и fee механику...")
-    if any(w in low for w in ["твит", "twitter", "пост", "запуск", "launch"]):
-        thinking_steps.append("Маркетинговый запрос — думаю про @oassisx100 аудиторию и контент-стратегию...")
-    if any(w in low for w in ["ошибк", "баг", "error", "fix", "сломал"]):
-        thinking_steps.append("Технический вопрос — думаю про стек: FastAPI / Next.js / Render / Vercel...")
-    if any(w in low for w in ["монетиз", "деньги", "доход", "revenue", "заработ"]):
-        thinking_steps.append("Монетизация — приоритет: swap fee → Pro подписка → token creation fee...")
-    thinking_steps.append("Формирую оптимальный ответ с конкретными рекомендациями...")
-
-    for step in thinking_steps:
-        await ws.send_json({"t": "thinking", "v": step})
-        await asyncio.sleep(0.12)
-
-    await ws.send_json({"t": "thinking_done"})
-
     # ── Agent loop (max 5 tool rounds) ────────────────────────────────────────
+    async def send_token(text: str):
+        await end_thinking()
+        await ws.send_json({"t": "token", "v": text})
+
+    full_text = ""
     for _round in range(5):
-        resp, err = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: groq_chat(messages, tools=TOOL_DEFS, max_tokens=1536)
-        )
+        with tracing.span("llm.round", round=_round):
+            resp, err = await groq_stream(messages, send_token, tools=TOOL_DEFS, max_tokens=1536,
+                                          session_id=session_id, on_progress=think)
         if err or not resp:
-            logger.error(f"groq_chat error: {err}")
-            await ws.send_json({"t": "token", "v": "Извини, AI временно недоступен. Попробуй снова."})
+            logger.error(f"groq_stream error: {err}")
+            await end_thinking()
+            await ws.send_json({"t": "token", "v": OVERLOADED if err == OVERLOADED else
+                                "Извини, AI временно недоступен. Попробуй снова."})
             await ws.send_json({"t": "done"})
-            return
+            return ""
 
         choice   = resp["choices"][0]
         msg_out  = choice["message"]
@@ -766,92 +3257,192 @@ async def run_agent(ws: WebSocket, prompt: str, session_id: str,
                 "content": msg_out.get("content") or "",
                 "tool_calls": msg_out["tool_calls"]
             })
+            calls = []
             for tc in msg_out["tool_calls"]:
                 fn = tc["function"]["name"]
                 try:
-                    args = json.loads(tc["function"].get("arguments", "{}"))
+                    args = json.loads(tc["function"].get("arguments") or "{}")
                 except Exception:
                     args = {}
-                label = TOOL_LABELS.get(fn, f"🔧 {fn}")
-                await ws.send_json({"t": "tool_start", "v": label})
-                tool_result = await asyncio.get_event_loop().run_in_executor(
-                    None, lambda fn=fn, args=args: run_tool(fn, args, session_id)
-                )
+                calls.append((tc, fn, args, TOOL_LABELS.get(fn, f"🔧 {fn}")))
+
+            async def run_one(fn, args, label):
+                result = await run_tool_async(fn, args, session_id)
                 await ws.send_json({"t": "tool_done", "v": label})
+                return result
+
+            # Dispatch the whole round at once; results keep the model's order
+            await think("Инструменты: " + ", ".join(fn for _, fn, _, _ in calls))
+            await end_thinking()
+            for _, _, _, label in calls:
+                await ws.send_json({"t": "tool_start", "v": label})
+            with tracing.span("tools", n=len(calls)):
+                results = await asyncio.gather(*(run_one(fn, args, label)
+                                                 for _, fn, args, label in calls))
+            for (tc, fn, _, _), tool_result in zip(calls, results):
                 messages.append({
                     "role": "tool",
                     "tool_call_id": tc["id"],
                     "name": fn,
-                    "content": str(tool_result)
+                    "content": tool_result
                 })
             # Continue loop for model to synthesize
             continue
 
         else:
-            # Final answer
+            # Final answer — already streamed token by token
             full_text = msg_out.get("content", "") or ""
             break
 
     if not full_text.strip():
         full_text = "Не смог сформировать ответ. Попробуй переформулировать."
-
-    # Stream response — faster chunks
-    chunk_size = 12
-    for i in range(0, len(full_text), chunk_size):
-        await ws.send_json({"t": "token", "v": full_text[i:i+chunk_size]})
-        await asyncio.sleep(0.003)
+        await send_token(full_text)
 
     await ws.send_json({"t": "done"})
 
-    # Auto-save to memory
+    # Auto-save to memory (ring write on memory_pool; persistence is write-behind)
     if len(full_text) > 30:
-        asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: mem_add(session_id,
-                f"[{today}] Q: {prompt[:60]} → A: {full_text[:100]}")
-        )
+        await mem_add_async(session_id, f"[{today}] Q: {prompt[:60]} → A: {full_text[:100]}", type="qa")
+    return full_text
 
 # ── WebSocket /ws/oasis ────────────────────────────────────────────────────────
 
+WS_QUEUE_MAX = int(os.environ.get("WS_QUEUE_MAX", "3"))   # follow-up prompts held per socket
+
 @app.websocket("/ws/oasis")
-async def ws_oasis(websocket: WebSocket, sid: str = "default"):
+async def ws_oasis(websocket: WebSocket, sid: str = "default", enc: str = "json",
+                   debug: bool = False):
+    """
+    The socket is read continuously: each prompt runs as its own task fed from
+    a small per-session queue, so pings are answered mid-answer and
+    {"type": "cancel"} aborts the in-flight run (its Groq stream and pending
+    tool awaits are cancelled with it). {"type": "cancel", "all": true} also
+    drops queued follow-ups. With ?debug=1 (or "debug": true on a prompt) a
+    {"t": "trace"} frame with the run's span timeline follows its "done".
+    """
     await websocket.accept()
     session_id = sid
-    history    = []
-    logger.info(f"WS /ws/oasis connected: {session_id}")
+    out = FrameWriter(websocket, enc, "/ws/oasis")
+    WS_TOTALS["connections"] += 1; WS_TOTALS["active"] += 1
+    metrics.WS_OPENED.inc(endpoint="/ws/oasis"); metrics.WS_CONNECTIONS.inc(endpoint="/ws/oasis")
+    conversations.evict_idle()
+    logger.info(f"WS /ws/oasis connected: {session_id} ({out.stats()['encoding']})")
+    pending: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_MAX)
+    current = {"run": None, "answers": 0}    # answers: out.answers when the run started
+
+    async def answer(data: dict):
+        prompt       = data["prompt"]
+        has_image    = bool(data.get("image_base64"))
+        history = conversations.history(session_id)
+        summary = conversations.summary(session_id)
+        conversations.add_turn(session_id, "user", prompt)
+        with tracing.trace("ws.oasis", sid=session_id, image=has_image) as tr:
+            # popped, not read: run_agent's vision task ends up the upload's only owner
+            text = await run_agent(out, prompt, session_id, history,
+                                   data.pop("image_base64", None), summary)
+        if debug or data.get("debug"):
+            await out.send_json({"t": "trace", "v": tr.timeline()})
+        if text:
+            conversations.add_turn(session_id, "assistant", text)
+
+    async def worker():
+        try:
+            while True:
+                data = await pending.get()
+                run  = asyncio.create_task(answer(data))
+                current["run"], current["answers"] = run, out.answers
+                await asyncio.wait({run})
+                current["run"] = None
+                if run.cancelled():
+                    logger.info(f"WS run cancelled: {session_id}")
+                    await out.send_json({"t": "cancelled"})
+                    await out.send_json({"t": "done"})
+                elif run.exception() is not None:
+                    e = run.exception()
+                    logger.error(f"WS run error: {e}", exc_info=e)
+                    await out.send_json({"t": "error", "v": str(e)})
+        finally:
+            if current["run"] is not None:
+                current["run"].cancel()
+
+    runner = asyncio.create_task(worker())
     try:
         while True:
             raw = await websocket.receive_text()
+            if raw.strip() in ("ping", '"ping"'):
+                await out.send_json({"t": "pong"})
+                continue
             try:
                 data = json.loads(raw)
             except Exception:
-                await websocket.send_json({"t": "error", "v": "Invalid JSON"})
+                data = None
+            raw = None               # may be a multi-MB image upload; don't hold it until the next frame
+            if not isinstance(data, dict):
+                await out.send_json({"t": "error", "v": "Invalid JSON"})
+                continue
+            kind = data.get("type")
+            if kind == "ping":
+                await out.send_json({"t": "pong"})
                 continue
-            if raw.strip() in ('ping', '"ping"') or data.get("type") == "ping":
-                await websocket.send_json({"t": "pong"})
+            if kind == "cancel":
+                if data.get("all"):
+                    while not pending.empty():
+                        pending.get_nowait()
+                # once the run's "done" is out, only bookkeeping (memory, history, trace) is
+                # left; cancelling it would send a second done and lose the assistant turn
+                if current["run"] is not None and out.answers == current["answers"]:
+                    current["run"].cancel()
                 continue
             prompt = data.get("prompt") or data.get("message") or data.get("content", "")
-            if not prompt.strip():
+            if not isinstance(prompt, str) or not prompt.strip():
+                continue
+            if pending.full():
+                await out.send_json({"t": "error", "v": "Слишком много запросов в очереди — дождись ответа."})
                 continue
-            lang          = data.get("lang", "ru")
-            image_base64  = data.get("image_base64")
-            history.append({"role": "user", "content": prompt})
-            await run_agent(websocket, prompt, session_id, history[:-1], image_base64)
+            pending.put_nowait({"prompt": prompt, "image_base64": data.pop("image_base64", None),
+                                "debug": bool(data.get("debug"))})
+            if current["run"] is not None:
+                await out.send_json({"t": "queued", "v": pending.qsize()})
     except WebSocketDisconnect:
-        logger.info(f"WS disconnected: {session_id}")
+        logger.info(f"WS disconnected: {session_id} {out.stats()}")
     except Exception as e:
         logger.error(f"WS error: {e}", exc_info=True)
         try:
-            await websocket.send_json({"t": "error", "v": str(e)})
+            await out.send_json({"t": "error", "v": str(e)})
         except Exception:
             pass
+    finally:
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        metrics.WS_CONNECTIONS.dec(endpoint="/ws/oasis")
+        WS_TOTALS["active"] -= 1
 
 # ── WebSocket /ws/deep ────────────────────────────────────────────────────────
 
 @app.websocket("/ws/deep")
-async def ws_deep(websocket: WebSocket, sid: str = "default"):
+async def ws_deep(websocket: WebSocket, sid: str = "default", enc: str = "json",
+                  debug: bool = False):
     await websocket.accept()
     session_id = sid
+    out = FrameWriter(websocket, enc, "/ws/deep")
+    WS_TOTALS["connections"] += 1; WS_TOTALS["active"] += 1
+    metrics.WS_OPENED.inc(endpoint="/ws/deep"); metrics.WS_CONNECTIONS.inc(endpoint="/ws/deep")
+
+    async def send_token(text: str):
+        await out.send_json({"t": "token", "v": text})
+
+    async def quick(prompt: str) -> tuple:
+        await out.send_json({"t": "tool_start", "v": "🌐 исследую"})
+        search_result = await run_tool_async("web_search", {"query": prompt}, session_id)
+        await out.send_json({"t": "tool_done", "v": "🌐 исследую"})
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        messages = [
+            {"role": "system", "content": f"Ты — GodLocal Deep Research AI. Дата: {today}. Давай развёрнутый структурированный ответ. Ссылки как [текст](url)."},
+            {"role": "user", "content": f"Вопрос: {prompt}\n\nРезультаты поиска:\n{search_result}\n\nДай подробный ответ."}
+        ]
+        return await groq_stream(messages, send_token, tools=None, max_tokens=2048,
+                                 session_id=session_id)
+
     try:
         while True:
             raw = await websocket.receive_text()
@@ -862,31 +3453,24 @@ async def ws_deep(websocket: WebSocket, sid: str = "default"):
             prompt = data.get("prompt") or data.get("message", "")
             if not prompt.strip():
                 continue
-            await websocket.send_json({"t": "tool_start", "v": "🌐 исследую"})
-            search_result = await asyncio.get_event_loop().run_in_executor(
-                None, lambda: run_tool("web_search", {"query": prompt}, session_id)
-            )
-            await websocket.send_json({"t": "tool_done", "v": "🌐 исследую"})
-            today = datetime.utcnow().strftime("%Y-%m-%d")
-            messages = [
-                {"role": "system", "content": f"Ты — GodLocal Deep Research AI. Дата: {today}. Давай развёрнутый структурированный ответ. Ссылки как [текст](url)."},
-                {"role": "user", "content": f"Вопрос: {prompt}\n\nРезультаты поиска:\n{search_result}\n\nДай подробный ответ."}
-            ]
-            resp, err = await asyncio.get_event_loop().run_in_executor(
-                None, lambda: groq_chat(messages, tools=None, max_tokens=2048)
-            )
+            mode = data.get("mode", "deep")
+            with tracing.trace("ws.deep", sid=session_id, mode=mode) as tr:
+                if mode == "quick":
+                    resp, err = await quick(prompt)
+                else:
+                    resp, err = await research(prompt, session_id, out.send_json, send_token)
             if err or not resp:
-                await websocket.send_json({"t": "token", "v": "Ошибка при исследовании."})
-            else:
-                answer = resp["choices"][0]["message"].get("content", "") or ""
-                for i in range(0, len(answer), 8):
-                    await websocket.send_json({"t": "token", "v": answer[i:i+8]})
-                    await asyncio.sleep(0.005)
-            await websocket.send_json({"t": "done"})
+                await out.send_json({"t": "token", "v": "Ошибка при исследовании."})
+            await out.send_json({"t": "done"})
+            if debug or data.get("debug"):
+                await out.send_json({"t": "trace", "v": tr.timeline()})
     except WebSocketDisconnect:
-        pass
+        logger.info(f"WS /ws/deep disconnected: {session_id} {out.stats()}")
     except Exception as e:
         logger.error(f"WS /ws/deep error: {e}")
+    finally:
+        metrics.WS_CONNECTIONS.dec(endpoint="/ws/deep")
+        WS_TOTALS["active"] -= 1
 
 # ── REST ───────────────────────────────────────────────────────────────────────
 
@@ -901,13 +3485,61 @@ def health():
         "vision": "llama-4-scout"
     })
 
+@app.get("/models/health")
+def models_health():
+    return JSONResponse({"models": MODELS, "vision_models": VISION_MODELS,
+                         "router": router.snapshot()})
+
+@app.get("/scheduler")
+def scheduler_stats():
+    return JSONResponse({**scheduler.snapshot(),
+                         "executors": {name: p.snapshot() for name, p in POOLS.items()}})
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+_profiler_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="profiler")
+
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 5.0, interval_ms: float = 10.0,
+                        idle: bool = False, format: str = "collapsed"):
+    """
+    Sample all thread stacks for `seconds` and return collapsed stacks
+    (flamegraph.pl / speedscope input). Needs ADMIN_TOKEN via X-Admin-Token
+    or Authorization: Bearer. Coroutines suspended in await don't show up;
+    the event loop thread shows what it is running at each sample.
+    """
+    token = request.headers.get("x-admin-token") or request.headers.get("authorization")
+    if not tracing.admin_allowed(token):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    try:
+        report = await asyncio.get_running_loop().run_in_executor(
+            _profiler_pool, tracing.sample_stacks, seconds, interval_ms / 1000, idle)
+    except RuntimeError as e:
+        return JSONResponse({"error": str(e)}, status_code=409)
+    if format == "json":
+        return JSONResponse(report)
+    return Response(report["collapsed"], media_type="text/plain; charset=utf-8",
+                    headers={"X-Samples": str(report["samples"])})
+
+@app.get("/ws/stats")
+def ws_stats():
+    return JSONResponse({**WS_TOTALS, "frame_window_ms": FRAME_WINDOW * 1000,
+                         "frame_max_bytes": FRAME_MAX_BYTES, "msgpack": msgpack is not None})
+
+@app.get("/cache/stats")
+def cache_stats():
+    return JSONResponse({name: c.stats() for name, c in CACHES.items()})
+
 @app.get("/ping")
 def ping():
     return JSONResponse({"pong": True})
 
 @app.get("/test-groq")
-def test_groq_endpoint():
-    resp, err = groq_chat([{"role": "user", "content": "say hi in 3 words"}], max_tokens=20)
+async def test_groq_endpoint():
+    resp, err = await groq_chat([{"role": "user", "content": "say hi in 3 words"}], max_tokens=20,
+                                session_id="test-groq", priority="batch")
     if err:
         return JSONResponse({"ok": False, "error": err}, status_code=500)
     content = resp["choices"][0]["message"].get("content", "")
@@ -917,6 +3549,11 @@ def test_groq_endpoint():
 def get_memory(session_id: str = "default"):
     return JSONResponse({"memories": mem_get(session_id)})
 
+@app.get("/memory/stats")
+def memory_stats():
+    return JSONResponse({**memory.snapshot(), "conversations": conversations.snapshot(),
+                         "state": shared_state.snapshot()})
+
 @app.delete("/memory/{session_id}/{mem_id}")
 def delete_memory_ep(session_id: str, mem_id: str):
     mem_delete(session_id, mem_id)
@@ -924,60 +3561,124 @@ def delete_memory_ep(session_id: str, mem_id: str):
 
 @app.get("/profile")
 def get_profile(session_id: str = "default"):
-    with _lock:
-        return JSONResponse(_profiles.get(session_id, {}))
+    return JSONResponse(shared_state.get("profiles", session_id, {}))
 
 @app.post("/profile")
 async def set_profile(request: Request):
     data = await request.json()
     sid  = data.get("session_id", "default")
-    with _lock:
-        _profiles[sid] = data
+    await memory_pool.run(shared_state.set, "profiles", sid, data)
     return JSONResponse({"ok": True})
 
+# Council members as (name, system prompt). COUNCIL_ARCHETYPES may replace the
+# list with a JSON array of [name, prompt] pairs; a request can pick a subset by
+# name via "agents". COUNCIL_SYNTHESIS turns on the final merged answer by
+# default ("synthesis" in the request overrides it).
+COUNCIL_ARCHETYPES = [
+    ("🧭 Стратег", "Ты — Стратег. Думай системно, на перспективу. Отвечай кратко (2-3 предложения). Ссылки как [текст](url)."),
+    ("⚡ Воин",    "Ты — Воин. Решителен, прямолинеен. Отвечай кратко (2-3 предложения). Ссылки как [текст](url)."),
+    ("🌟 Творец",  "Ты — Творец. Нестандартное мышление. Отвечай кратко (2-3 предложения). Ссылки как [текст](url)."),
+]
+if os.environ.get("COUNCIL_ARCHETYPES"):
+    try:
+        COUNCIL_ARCHETYPES = [(str(n), str(p)) for n, p in json.loads(os.environ["COUNCIL_ARCHETYPES"])]
+    except Exception as e:
+        logger.warning(f"COUNCIL_ARCHETYPES ignored: {e}")
+COUNCIL_SYNTHESIS  = os.environ.get("COUNCIL_SYNTHESIS", "false").lower() == "true"
+COUNCIL_SYNTH_NAME = "⚖️ Синтез"
+
 @app.post("/v2/council")
 async def council(request: Request):
+    """
+    All archetypes stream concurrently; SSE token events carry the agent name
+    in "a" so the client can route interleaved output. Events per agent:
+    agent → token* → agent_done, then an optional synthesis agent, then done.
+    """
     data   = await request.json()
     prompt = data.get("prompt", "")
-    archetypes = [
-        ("🧭 Стратег", "Ты — Стратег. Думай системно, на перспективу. Отвечай кратко (2-3 предложения). Ссылки как [текст](url)."),
-        ("⚡ Воин",    "Ты — Воин. Решителен, прямолинеен. Отвечай кратко (2-3 предложения). Ссылки как [текст](url)."),
-        ("🌟 Творец",  "Ты — Творец. Нестандартное мышление. Отвечай кратко (2-3 предложения). Ссылки как [текст](url)."),
-    ]
+    sid    = data.get("session_id", "council")
+    wanted = data.get("agents")
+    archetypes = [a for a in COUNCIL_ARCHETYPES if not wanted or a[0] in wanted] or COUNCIL_ARCHETYPES
+    synthesis  = bool(data.get("synthesis", COUNCIL_SYNTHESIS))
+
+    def sse(obj: dict) -> str:
+        return f"data: {json.dumps(obj, ensure_ascii=False)}\n\n"
+
+    events: asyncio.Queue = asyncio.Queue()   # (agent, text) deltas; (agent, None) when finished
+    replies = {name: [] for name, _ in archetypes}
+
+    async def speak(name: str, messages: list, max_tokens: int):
+        async def on_token(text: str):
+            await events.put((name, text))
+        try:
+            await groq_stream(messages, on_token, max_tokens=max_tokens, session_id=sid)
+        finally:
+            await events.put((name, None))
+
+    async def relay(running: int):
+        """Yield SSE events until `running` agents have finished, one token event per agent per FRAME_WINDOW."""
+        while running:
+            batch = [await events.get()]
+            await asyncio.sleep(FRAME_WINDOW)
+            while not events.empty():
+                batch.append(events.get_nowait())
+            merged = {}
+            for name, text in batch:
+                if text is not None:
+                    merged.setdefault(name, []).append(text)
+                    replies.setdefault(name, []).append(text)
+                    continue
+                if merged.get(name):
+                    yield sse({"t": "token", "a": name, "v": "".join(merged.pop(name))})
+                if not replies.get(name):
+                    yield sse({"t": "token", "a": name, "v": "..."})
+                yield sse({"t": "agent_done", "v": name})
+                running -= 1
+            for name, parts in merged.items():
+                yield sse({"t": "token", "a": name, "v": "".join(parts)})
+
     async def generate():
-        for name, role_prompt in archetypes:
-            yield f"data: {json.dumps({'t': 'agent', 'v': name})}\n\n"
-            await asyncio.sleep(0.05)
-            messages = [
-                {"role": "system", "content": role_prompt},
-                {"role": "user",   "content": prompt}
-            ]
-            resp, err = await asyncio.get_event_loop().run_in_executor(
-                None, lambda m=messages: groq_chat(m, max_tokens=200)
-            )
-            reply = resp["choices"][0]["message"].get("content","") if (resp and not err) else "..."
-            for i in range(0, len(reply), 6):
-                yield f"data: {json.dumps({'t': 'token', 'v': reply[i:i+6]})}\n\n"
-                await asyncio.sleep(0.008)
-            yield f"data: {json.dumps({'t': 'agent_done', 'v': name})}\n\n"
-            await asyncio.sleep(0.3)
-        yield f"data: {json.dumps({'t': 'done'})}\n\n"
+        tasks = []
+        try:
+            for name, role_prompt in archetypes:
+                yield sse({"t": "agent", "v": name})
+                messages = [
+                    {"role": "system", "content": role_prompt},
+                    {"role": "user",   "content": prompt}
+                ]
+                tasks.append(asyncio.create_task(speak(name, messages, 200)))
+            async for event in relay(len(tasks)):
+                yield event
+            if synthesis:
+                opinions = "\n\n".join(f"{name}: {''.join(replies[name])}" for name, _ in archetypes)
+                messages = [
+                    {"role": "system", "content": "Ты — модератор совета. Сведи мнения в одно решение: 3-4 предложения, отметь согласие и расхождения."},
+                    {"role": "user",   "content": f"Вопрос: {prompt}\n\nМнения совета:\n{opinions}"}
+                ]
+                yield sse({"t": "agent", "v": COUNCIL_SYNTH_NAME})
+                replies[COUNCIL_SYNTH_NAME] = []
+                tasks.append(asyncio.create_task(speak(COUNCIL_SYNTH_NAME, messages, 300)))
+                async for event in relay(1):
+                    yield event
+            yield sse({"t": "done"})
+        finally:
+            for t in tasks:
+                t.cancel()
     return StreamingResponse(generate(), media_type="text/event-stream",
                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # ── User API Keys Store (per session_id) ─────────────────────────────────────
-_user_keys: dict = {}   # { session_id: { "TELEGRAM_BOT_TOKEN": "...", ... } }
+# shared_state "user_keys": { session_id: { "TELEGRAM_BOT_TOKEN": "...", ... } }
 
 def get_user_env(session_id: str, key: str) -> str:
     """Get user-provided key, fall back to server env var."""
-    val = _user_keys.get(session_id, {}).get(key, "")
+    val = shared_state.get("user_keys", session_id, {}).get(key, "")
     return val or os.environ.get(key, "")
 
 @app.get("/settings")
 def get_settings(session_id: str = "default"):
-    with _lock:
-        keys = _user_keys.get(session_id, {})
+    keys = shared_state.get("user_keys", session_id, {})
     # Mask values: return asterisks for set keys, empty string for unset
     masked = {}
     for k, v in keys.items():
@@ -989,23 +3690,31 @@ async def save_settings(request: Request):
     data = await request.json()
     sid  = data.get("session_id", "default")
     keys = data.get("keys", {})
-    with _lock:
-        if sid not in _user_keys:
-            _user_keys[sid] = {}
+
+    def apply(current: dict) -> dict:
         for k, v in keys.items():
             if v == "":          # disconnect — clear key
-                _user_keys[sid].pop(k, None)
+                current.pop(k, None)
             elif v != "••••••••":  # real value (not masked placeholder)
-                _user_keys[sid][k] = v
+                current[k] = v
+        return current
+    await memory_pool.run(shared_state.update, "user_keys", sid, apply, {})
     return JSONResponse({"ok": True})
 
 
 @app.get("/market")
-async def market():
-    try:
-        r = requests.get("https://api.coingecko.com/api/v3/simple/price",
-                         params={"ids": "bitcoin,ethereum,solana", "vs_currencies": "usd"},
-                         timeout=8)
-        return JSONResponse(r.json())
-    except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
+async def market(ids: str = ",".join(PRICE_DEFAULT_IDS)):
+    coins = ids.split(",")
+    data, missing = prices.peek(coins)
+    if missing:
+        try:
+            data = await tools_pool.run(prices.get, coins)
+        except PoolSaturated:
+            pass        # serve whatever peek() had, stale or partial
+    if not data:
+        return JSONResponse({"error": "price data unavailable"}, status_code=503)
+    return JSONResponse(data)
+
+@app.get("/market/stats")
+def market_stats():
+    return JSONResponse(prices.snapshot())
@@ -0,0 +1,266 @@
+"""
+Local stand-ins for every upstream the backends call during a benchmark
+======================================================================
+One FastAPI app, mounted under path prefixes that match the backends' *_URL
+env overrides:
+
+  /openai/v1/chat/completions   Groq (OpenAI-compatible, stream + non-stream, tool_calls, 429s)
+  /serper/search                Serper search → links back to /pages/{n}
+  /pages/{n}                    HTML pages for /ws/deep fetches
+  /coingecko/simple/price       CoinGecko prices
+  /github/...                   GitHub REST (repo, contents, trees)
+  /composio/actions/{a}/execute Composio actions (server.py tools)
+
+Run:
+  python bench/fake_upstreams.py --port 9100 --latency-ms 300 --tps 80 --tool-rate 0.3 --rate-429 0.05
+
+then start app.py / server.py with the env printed at startup.
+"""
+import os, json, random, base64, asyncio, argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, Response
+
+app = FastAPI(title="GodLocal bench upstreams")
+
+CONFIG = {
+    "latency_ms": 300.0,    # time to first byte of a completion
+    "jitter_ms":  50.0,
+    "tps":        80.0,     # streamed tokens per second
+    "tokens":     120,      # completion length
+    "tool_rate":  0.3,      # chance of answering with tool_calls when tools are offered
+    "rate_429":   0.0,      # chance of a 429 before any work
+    "search_ms":  150.0,
+    "page_ms":    120.0,
+    "price_ms":   80.0,
+    "github_ms":  100.0,
+}
+STATS = {"completions": 0, "streams": 0, "tool_calls": 0, "rate_limited": 0,
+         "searches": 0, "pages": 0, "prices": 0, "github": 0, "composio": 0}
+
+# Tools the fake model may call, with arguments that are safe to execute in a benchmark.
+SAFE_TOOLS = {
+    "web_search":        {"query": "solana fees benchmark"},
+    "crypto_price":      {"coins": ["bitcoin", "solana"]},
+    "get_market_data":   {},
+    "get_system_status": {},
+    "get_recent_thoughts": {},
+}
+WORDS = ("the market moved as liquidity rotated into solana while fees stayed low and "
+         "builders shipped faster than expected so the plan is to keep iterating").split()
+
+
+async def _delay(ms: float):
+    jitter = CONFIG["jitter_ms"]
+    await asyncio.sleep(max(0.0, ms + random.uniform(-jitter, jitter)) / 1000)
+
+
+def _ratelimit_headers() -> dict:
+    return {"x-ratelimit-remaining-requests": "1000", "x-ratelimit-remaining-tokens": "100000",
+            "x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "1s"}
+
+
+def _pick_tool(body: dict):
+    """A tool call for the first round only: once a tool result is in the transcript, answer in text."""
+    if not body.get("tools") or any(m.get("role") == "tool" for m in body.get("messages", [])):
+        return None
+    if random.random() >= CONFIG["tool_rate"]:
+        return None
+    offered = [t["function"]["name"] for t in body["tools"] if t.get("type") == "function"]
+    names = [n for n in offered if n in SAFE_TOOLS]
+    if not names:
+        return None
+    name = random.choice(names)
+    return {"id": f"call_{random.randrange(1 << 30):x}", "type": "function",
+            "function": {"name": name, "arguments": json.dumps(SAFE_TOOLS[name])}}
+
+
+def _usage(body: dict, completion: int) -> dict:
+    prompt = sum(len(str(m.get("content") or "")) for m in body.get("messages", [])) // 4
+    return {"prompt_tokens": prompt, "completion_tokens": completion,
+            "total_tokens": prompt + completion}
+
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if random.random() < CONFIG["rate_429"]:
+        STATS["rate_limited"] += 1
+        return JSONResponse({"error": {"message": "Rate limit reached (bench)", "type": "rate_limit"}},
+                            status_code=429, headers={"retry-after": "1"})
+    model  = body.get("model", "bench")
+    n      = min(int(body.get("max_tokens") or CONFIG["tokens"]), CONFIG["tokens"])
+    call   = _pick_tool(body)
+    words  = [random.choice(WORDS) for _ in range(n)]
+    STATS["completions"] += 1
+    STATS["tool_calls"]  += bool(call)
+    await _delay(CONFIG["latency_ms"])
+
+    if not body.get("stream"):
+        await asyncio.sleep(n / CONFIG["tps"] if not call else 0)
+        message = ({"role": "assistant", "content": None, "tool_calls": [call]} if call
+                   else {"role": "assistant", "content": " ".join(words)})
+        return JSONResponse({"id": "bench", "object": "chat.completion", "model": model,
+                             "choices": [{"index": 0, "message": message,
+                                          "finish_reason": "tool_calls" if call else "stop"}],
+                             "usage": _usage(body, 0 if call else n)},
+                            headers=_ratelimit_headers())
+
+    STATS["streams"] += 1
+
+    async def events():
+        def chunk(delta: dict, finish=None, extra=None) -> str:
+            payload = {"id": "bench", "object": "chat.completion.chunk", "model": model,
+                       "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+            if extra:
+                payload.update(extra)
+            return f"data: {json.dumps(payload)}\n\n"
+        yield chunk({"role": "assistant"})
+        if call:
+            args = call["function"]["arguments"]
+            yield chunk({"tool_calls": [{"index": 0, "id": call["id"], "type": "function",
+                                         "function": {"name": call["function"]["name"], "arguments": ""}}]})
+            for i in range(0, len(args), 16):
+                yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": args[i:i + 16]}}]})
+            yield chunk({}, "tool_calls", {"x_groq": {"usage": _usage(body, 0)}})
+        else:
+            gap = 1.0 / CONFIG["tps"]
+            for i, w in enumerate(words):
+                yield chunk({"content": (" " if i else "") + w})
+                await asyncio.sleep(gap)
+            yield chunk({}, "stop", {"x_groq": {"usage": _usage(body, n)}})
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=_ratelimit_headers())
+
+
+@app.post("/serper/search")
+async def serper(request: Request):
+    body = await request.json()
+    STATS["searches"] += 1
+    await _delay(CONFIG["search_ms"])
+    base = str(request.base_url).rstrip("/")
+    q    = body.get("q", "")
+    seed = abs(hash(q)) % 1000
+    return {"organic": [{"title": f"{q} — result {i}", "link": f"{base}/pages/{seed + i}",
+                         "snippet": f"Snippet {i} about {q}: " + " ".join(random.sample(WORDS, 12))}
+                        for i in range(int(body.get("num", 5)))]}
+
+
+@app.get("/pages/{n}")
+async def page(n: int):
+    STATS["pages"] += 1
+    await _delay(CONFIG["page_ms"])
+    rnd   = random.Random(n)
+    paras = "".join(f"<p>{' '.join(rnd.choice(WORDS) for _ in range(60))}.</p>" for _ in range(12))
+    return HTMLResponse(f"<html><head><title>Page {n}</title><script>var x=1;</script></head>"
+                        f"<body><nav>home about</nav><article><h1>Page {n}</h1>{paras}</article></body></html>")
+
+
+@app.get("/coingecko/simple/price")
+async def coingecko(ids: str = "bitcoin", vs_currencies: str = "usd", include_24hr_change: str = "false"):
+    STATS["prices"] += 1
+    await _delay(CONFIG["price_ms"])
+    out = {}
+    for coin in filter(None, ids.split(",")):
+        rnd = random.Random(coin)
+        out[coin] = {"usd": round(rnd.uniform(0.1, 70000), 2), "usd_24h_change": round(rnd.uniform(-8, 8), 3)}
+    return out
+
+
+_FILE = "def handler(event):\n    return {'ok': True}\n\n" * 40
+
+
+@app.get("/github/repos/{owner}/{repo}")
+async def gh_repo(owner: str, repo: str):
+    STATS["github"] += 1
+    await _delay(CONFIG["github_ms"])
+    return JSONResponse({"full_name": f"{owner}/{repo}", "default_branch": "main"}, headers={"etag": '"repo-v1"'})
+
+
+@app.get("/github/repos/{owner}/{repo}/contents/{path:path}")
+async def gh_contents(owner: str, repo: str, path: str, request: Request):
+    STATS["github"] += 1
+    if request.headers.get("if-none-match") == f'"{path}-v1"':
+        return Response(status_code=304)
+    await _delay(CONFIG["github_ms"])
+    if not path or path.endswith("/") or "." not in path.rsplit("/", 1)[-1]:
+        return JSONResponse([{"name": f"file{i}.py", "path": f"{path.strip('/')}/file{i}.py".lstrip("/"),
+                              "type": "file", "size": len(_FILE)} for i in range(5)],
+                            headers={"etag": f'"{path}-v1"'})
+    return JSONResponse({"path": path, "sha": "0" * 40, "size": len(_FILE), "encoding": "base64",
+                         "content": base64.b64encode(_FILE.encode()).decode()},
+                        headers={"etag": f'"{path}-v1"'})
+
+
+@app.get("/github/repos/{owner}/{repo}/git/trees/{ref}")
+async def gh_tree(owner: str, repo: str, ref: str):
+    STATS["github"] += 1
+    await _delay(CONFIG["github_ms"])
+    dirs  = [{"path": d, "type": "tree", "sha": f"{n + 100:040x}"}
+             for n, d in enumerate(("src", "src/lib", "docs"))]
+    files = [{"path": f"{('src', 'src/lib', 'docs')[i % 3]}/file{i}.py", "type": "blob",
+              "size": len(_FILE), "sha": f"{i:040x}"} for i in range(20)]
+    return {"sha": "1" * 40, "truncated": False, "tree": dirs + files}
+
+
+@app.post("/composio/actions/{action}/execute")
+async def composio(action: str):
+    STATS["composio"] += 1
+    await _delay(CONFIG["github_ms"])
+    return {"successful": True, "data": {"action": action}}
+
+
+@app.get("/stats")
+def stats():
+    return {"config": CONFIG, **STATS}
+
+
+@app.post("/config")
+async def configure(request: Request):
+    """Change behaviour mid-run, e.g. {"rate_429": 0.2} to watch fallback under pressure."""
+    CONFIG.update({k: type(CONFIG[k])(v) for k, v in (await request.json()).items() if k in CONFIG})
+    return CONFIG
+
+
+# Per-model (requests/min, tokens/min) far above what the fakes can serve, so
+# app.py's scheduler never throttles and a run measures the serving path.
+BENCH_RPM, BENCH_TPM = 1_000_000, 1_000_000_000
+BENCH_MODELS = ("llama-3.3-70b-versatile", "llama-3.1-70b-versatile", "llama-3.1-8b-instant",
+                "gemma2-9b-it", "mixtral-8x7b-32768", "meta-llama/llama-4-scout-17b-16e-instruct",
+                "meta-llama/llama-4-maverick-17b-128e-instruct")
+
+
+def env_for(base: str, app_limits: bool = False) -> dict:
+    env = {"GROQ_BASE_URL": f"{base}/openai/v1", "GROQ_API_KEY": "bench",
+           "SERPER_URL": f"{base}/serper/search", "SERPER_API_KEY": "bench",
+           "COINGECKO_BASE_URL": f"{base}/coingecko", "GITHUB_API_URL": f"{base}/github",
+           "GITHUB_TOKEN": "bench", "COMPOSIO_BASE_URL": f"{base}/composio",
+           "MEMORY_BACKEND": "none"}
+    if not app_limits:
+        limits = {m: [BENCH_RPM, BENCH_TPM] for m in BENCH_MODELS}
+        env.update({"GROQ_RPM": str(BENCH_RPM), "GROQ_TPM": str(BENCH_TPM),
+                    "GROQ_LIMITS": "'" + json.dumps(limits, separators=(",", ":")) + "'"})
+    return env
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=int(os.environ.get("BENCH_UPSTREAM_PORT", "9100")))
+    ap.add_argument("--app-limits", action="store_true",
+                    help="keep app.py's own Groq RPM/TPM budgets instead of lifting them")
+    for key, value in CONFIG.items():
+        ap.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = ap.parse_args()
+    for key in CONFIG:
+        CONFIG[key] = getattr(args, key)
+    base = f"http://{args.host}:{args.port}"
+    print("Point the backend at the fakes with:")
+    for k, v in env_for(base, args.app_limits).items():
+        print(f"  export {k}={v}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
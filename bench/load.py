@@ -0,0 +1,226 @@
+"""
+Load driver for the GodLocal backends
+=====================================
+Drives N concurrent clients against one scenario and reports p50/p95/p99
+time-to-first-token, total latency, requests/sec and errors. A run that
+finishes with one of the backends' canned fallback answers (model unavailable,
+overloaded, empty) is a "fallback", not ok, and is counted separately.
+
+  scenario   backend     transport   first token =
+  oasis      app.py      WS          first {"t":"token"} frame   (server.py /ws/oasis works too)
+  deep       app.py      WS          first {"t":"token"} frame
+  council    app.py      SSE         first token event
+  think      server.py   HTTP POST   response headers (no streaming)
+  tick       server.py   HTTP GET    response headers (no streaming)
+
+  python bench/load.py oasis --target http://127.0.0.1:8000 -c 20 -n 200
+  python bench/load.py think --target http://127.0.0.1:5000 -c 10 --duration 60 --json out.json
+
+Point the backend at bench/fake_upstreams.py first so no real quota is spent.
+"""
+import json, time, asyncio, argparse, statistics
+import httpx
+import websockets
+
+PROMPTS = [
+    "Какие комиссии у свапа на Jupiter сейчас?",
+    "Сравни SOL и ETH по активности за неделю",
+    "Придумай твит про запуск Pro подписки",
+    "Почему падает билд на Render после обновления FastAPI?",
+]
+
+
+# Canned answers the backends send instead of a model reply (app.py / server.py)
+FALLBACKS = {
+    "Извини, AI временно недоступен": "model unavailable",
+    "Сервер перегружен":              "overloaded",
+    "Ошибка при исследовании":        "deep research failed",
+    "Не смог сформировать ответ":     "empty model answer",
+    "Internal error":                 "react failed",
+}
+
+
+class Result:
+    __slots__ = ("ok", "ttft", "total", "error", "fallback")
+
+    def __init__(self, ok: bool, ttft, total: float, error: str = "", fallback: bool = False):
+        self.ok, self.ttft, self.total, self.error = ok, ttft, total, error
+        self.fallback = fallback
+
+
+def _finished(text: str, ttft, total: float) -> Result:
+    """Result for a run that completed normally on the wire; the answer text decides if it was real."""
+    text = text.strip()
+    if not text or text == "...":
+        return Result(False, ttft, total, "empty answer", fallback=True)
+    for marker, label in FALLBACKS.items():
+        if text.startswith(marker):
+            return Result(False, ttft, total, label, fallback=True)
+    return Result(True, ttft, total)
+
+
+async def _ws_run(url: str, payload: dict, timeout: float) -> Result:
+    t0, ttft, text = time.perf_counter(), None, []
+    async with websockets.connect(url, max_size=None, open_timeout=timeout) as ws:
+        await ws.send(json.dumps(payload))
+        while True:
+            raw = await asyncio.wait_for(ws.recv(), timeout)
+            frame = json.loads(raw)
+            kind = frame.get("t")
+            if kind == "token":
+                if ttft is None:
+                    ttft = time.perf_counter() - t0
+                text.append(str(frame.get("v", "")))
+            elif kind == "error":
+                return Result(False, ttft, time.perf_counter() - t0, str(frame.get("v"))[:80])
+            elif kind == "done":
+                return _finished("".join(text), ttft, time.perf_counter() - t0)
+
+
+async def oasis(client: httpx.AsyncClient, args, i: int) -> Result:
+    base = args.target.replace("http", "ws", 1)
+    prompt = PROMPTS[i % len(PROMPTS)]
+    return await _ws_run(f"{base}/ws/oasis?sid=bench-{i % args.concurrency}",
+                         {"prompt": prompt, "message": prompt}, args.timeout)
+
+
+async def deep(client: httpx.AsyncClient, args, i: int) -> Result:
+    base = args.target.replace("http", "ws", 1)
+    return await _ws_run(f"{base}/ws/deep?sid=bench-{i % args.concurrency}",
+                         {"prompt": PROMPTS[i % len(PROMPTS)], "mode": args.mode}, args.timeout)
+
+
+async def council(client: httpx.AsyncClient, args, i: int) -> Result:
+    t0, ttft, replies = time.perf_counter(), None, {}
+    body = {"prompt": PROMPTS[i % len(PROMPTS)], "session_id": f"bench-{i % args.concurrency}"}
+    async with client.stream("POST", f"{args.target}/v2/council", json=body) as r:
+        if r.status_code != 200:
+            return Result(False, None, time.perf_counter() - t0, f"HTTP {r.status_code}")
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[5:])
+            if event.get("t") == "agent":
+                replies.setdefault(event.get("v"), [])
+            elif event.get("t") == "token":
+                if ttft is None:
+                    ttft = time.perf_counter() - t0
+                replies.setdefault(event.get("a"), []).append(str(event.get("v", "")))
+            elif event.get("t") == "done":
+                total = time.perf_counter() - t0
+                # every member has to have really answered; one "..." makes the council a fallback
+                for name, parts in replies.items():
+                    res = _finished("".join(parts), ttft, total)
+                    if not res.ok:
+                        res.error = f"{name}: {res.error}"
+                        return res
+                return Result(True, ttft, total)
+    return Result(False, ttft, time.perf_counter() - t0, "stream ended without done")
+
+
+async def _http(client: httpx.AsyncClient, method: str, url: str, **kw) -> Result:
+    t0 = time.perf_counter()
+    async with client.stream(method, url, **kw) as r:
+        ttfb = time.perf_counter() - t0
+        await r.aread()
+        total = time.perf_counter() - t0
+        if r.status_code != 200:
+            return Result(False, ttfb, total, f"HTTP {r.status_code}")
+        try:
+            answer = r.json().get("response") or ""
+        except ValueError:
+            return Result(False, ttfb, total, "invalid JSON")
+        return _finished(answer, ttfb, total)
+
+
+async def think(client: httpx.AsyncClient, args, i: int) -> Result:
+    return await _http(client, "POST", f"{args.target}/think", json={"prompt": PROMPTS[i % len(PROMPTS)]})
+
+
+async def tick(client: httpx.AsyncClient, args, i: int) -> Result:
+    return await _http(client, "GET", f"{args.target}/agent/tick")
+
+
+SCENARIOS = {"oasis": oasis, "deep": deep, "council": council, "think": think, "tick": tick}
+
+
+def _pct(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def summarize(name: str, results: list, wall: float) -> dict:
+    ok     = [r for r in results if r.ok]
+    ttfts  = [r.ttft for r in ok if r.ttft is not None]
+    totals = [r.total for r in ok]
+    errors, fallbacks = {}, {}
+    for r in results:
+        if not r.ok:
+            bucket = fallbacks if r.fallback else errors
+            bucket[r.error] = bucket.get(r.error, 0) + 1
+    ms = lambda v: round(v * 1000, 1) if v is not None else None
+    return {
+        "scenario": name, "requests": len(results), "ok": len(ok),
+        "fallbacks": fallbacks, "errors": errors,
+        "wall_s": round(wall, 2), "rps": round(len(ok) / wall, 2) if wall else 0.0,
+        "ttft_ms":  {f"p{q}": ms(_pct(ttfts, q)) for q in (50, 95, 99)},
+        "total_ms": {f"p{q}": ms(_pct(totals, q)) for q in (50, 95, 99)},
+        "mean_total_ms": ms(statistics.fmean(totals)) if totals else None,
+    }
+
+
+async def run(args) -> dict:
+    scenario = SCENARIOS[args.scenario]
+    results: list = []
+    counter = iter(range(args.requests or 10 ** 9))
+    stop_at = time.perf_counter() + args.duration if args.duration else None
+    limits  = httpx.Limits(max_connections=args.concurrency * 2)
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        async def worker():
+            for i in counter:
+                if stop_at and time.perf_counter() >= stop_at:
+                    return
+                t0 = time.perf_counter()
+                try:
+                    results.append(await asyncio.wait_for(scenario(client, args, i), args.timeout))
+                except Exception as e:
+                    results.append(Result(False, None, time.perf_counter() - t0, type(e).__name__))
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - t0
+    return summarize(args.scenario, results, wall)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="GodLocal load driver")
+    ap.add_argument("scenario", choices=sorted(SCENARIOS))
+    ap.add_argument("--target", default="http://127.0.0.1:8000")
+    ap.add_argument("-c", "--concurrency", type=int, default=10)
+    ap.add_argument("-n", "--requests", type=int, default=100, help="total requests (0 = until --duration)")
+    ap.add_argument("--duration", type=float, default=0, help="stop after this many seconds")
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--mode", default="deep", help="/ws/deep mode: deep | quick")
+    ap.add_argument("--json", help="also write the summary to this file")
+    args = ap.parse_args()
+
+    report = asyncio.run(run(args))
+    print(f"{report['scenario']}: {report['ok']}/{report['requests']} ok in {report['wall_s']}s "
+          f"→ {report['rps']} req/s")
+    for key in ("ttft_ms", "total_ms"):
+        row = report[key]
+        print(f"  {key:<9} p50={row['p50']}  p95={row['p95']}  p99={row['p99']}")
+    if report["fallbacks"]:
+        print("  fallbacks:", ", ".join(f"{k} ×{v}" for k, v in report["fallbacks"].items()))
+    if report["errors"]:
+        print("  errors:", ", ".join(f"{k} ×{v}" for k, v in report["errors"].items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,11 +13,15 @@ Supabase SQL:
 import os, json, logging
 from datetime import datetime, timezone
 from supabase import create_client, Client
+try:
+    from metrics import instrument_supabase
+except ImportError:  # used outside the backend: no metrics
+    instrument_supabase = lambda client: client
 
 logger = logging.getLogger("godlocal.hitl.cell_state")
 MAX_RAW_TURNS = 20
 
-def _client(): return create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"])
+def _client(): return instrument_supabase(create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]))
 
 class CellState:
     def __init__(self, cell_id: str, llm_summarize_fn=None):
@@ -35,10 +35,14 @@ import os
 import uuid
 from datetime import datetime, timezone
 from supabase import create_client, Client
+try:
+    from metrics import instrument_supabase
+except ImportError:  # used outside the backend: no metrics
+    instrument_supabase = lambda client: client
 
 
 def _client() -> Client:
-    return create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"])
+    return instrument_supabase(create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"]))
 
 
 class TaskQueue:
@@ -0,0 +1,246 @@
+"""
+GodLocal metrics — in-process counters shared by app.py (FastAPI) and server.py (Flask)
+=====================================================================================
+Prometheus text exposition without the client library: a metric is a dict of
+label-tuple → value behind one lock, an observation is a bisect plus two adds,
+so instrumentation can stay on in production. Both backends expose render()
+at /metrics; godlocal_hitl wraps its Supabase client with instrument_supabase().
+"""
+import time, bisect, threading
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry: list = []
+_collectors: list = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self._lock  = threading.Lock()
+        self._values: dict = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labels, k)} {_num(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            row[0][idx] += 1
+            row[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the block's duration; an `outcome` label set to "error" if it raises."""
+        t0 = time.perf_counter()
+        try:
+            yield labels
+        except BaseException:
+            if "outcome" in self.labels and labels.get("outcome", "ok") == "ok":
+                labels["outcome"] = "error"
+            raise
+        finally:
+            labels.setdefault("outcome", "ok")
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def render(self) -> list:
+        with self._lock:
+            items = [(k, list(row[0]), row[1]) for k, row in self._values.items()]
+        out = self.header()
+        for key, counts, total in items:
+            running = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                running += n
+                le = 'le="' + _num(bound) + '"'
+                out.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {running}")
+            out.append(f"{self.name}_sum{_labels(self.labels, key)} {total:.6f}")
+            out.append(f"{self.name}_count{_labels(self.labels, key)} {running}")
+        return out
+
+
+def register_collector(fn):
+    """fn() -> iterable of (name, kind, help, [(labels_dict, value), ...]) evaluated at scrape time."""
+    _collectors.append(fn)
+    return fn
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for fn in _collectors:
+        try:
+            families = list(fn())
+        except Exception:
+            continue
+        for name, kind, help, samples in families:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {_num(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# ── Shared metric families ────────────────────────────────────────────────────
+
+GROQ_LATENCY  = Histogram("godlocal_groq_request_seconds",
+                          "Groq chat completion latency (to last byte for streams)", ("model", "outcome"))
+TOOL_LATENCY  = Histogram("godlocal_tool_seconds", "Agent tool execution latency", ("tool", "outcome"))
+EXECUTOR_WAIT = Histogram("godlocal_executor_wait_seconds",
+                          "Time a job waited for an executor thread", ("pool",))
+EXECUTOR_DEPTH    = Gauge("godlocal_executor_queue_depth", "Jobs waiting for a worker or admission slot", ("pool",))
+EXECUTOR_INFLIGHT = Gauge("godlocal_executor_inflight", "Jobs currently running", ("pool",))
+EXECUTOR_REJECTED = Counter("godlocal_executor_rejected_total", "Jobs shed because the pool queue was full", ("pool",))
+WS_CONNECTIONS = Gauge("godlocal_ws_connections", "Open WebSocket connections", ("endpoint",))
+WS_OPENED      = Counter("godlocal_ws_connections_total", "WebSocket connections accepted", ("endpoint",))
+WS_FRAMES      = Counter("godlocal_ws_frames_total", "WebSocket frames sent", ("endpoint",))
+WS_BYTES       = Counter("godlocal_ws_bytes_total", "WebSocket payload bytes sent", ("endpoint",))
+SUPABASE_LATENCY = Histogram("godlocal_supabase_seconds", "Supabase round-trip latency",
+                             ("table", "op", "outcome"))
+
+
+_caches: dict = {}
+
+
+def register_cache(name: str, stats_fn):
+    """stats_fn() -> dict with "hits" and "misses"; read at scrape time, so lookups pay nothing extra."""
+    _caches[name] = stats_fn
+
+
+@register_collector
+def _cache_families():
+    stats = {name: fn() for name, fn in list(_caches.items())}
+    ratio = lambda st: st["hits"] / (st["hits"] + st["misses"]) if st["hits"] + st["misses"] else 0.0
+    return [
+        ("godlocal_cache_hits_total", "counter", "Cache hits",
+         [({"cache": n}, st["hits"]) for n, st in stats.items()]),
+        ("godlocal_cache_misses_total", "counter", "Cache misses",
+         [({"cache": n}, st["misses"]) for n, st in stats.items()]),
+        ("godlocal_cache_hit_ratio", "gauge", "Cache hits / lookups since start",
+         [({"cache": n}, round(ratio(st), 4)) for n, st in stats.items()]),
+    ]
+
+
+def queued(pool: str, fn, *args, **kwargs):
+    """
+    Wrap fn for an executor so the time between submit and start lands in
+    EXECUTOR_WAIT; the wrapper's `.waited` holds that wait once it has started.
+    """
+    submitted = time.perf_counter()
+
+    def run():
+        run.waited = time.perf_counter() - submitted
+        EXECUTOR_WAIT.observe(run.waited, pool=pool)
+        return fn(*args, **kwargs)
+    run.waited = None
+    return run
+
+
+# ── Supabase instrumentation ──────────────────────────────────────────────────
+
+_SUPABASE_OPS = {"select", "insert", "update", "upsert", "delete", "rpc"}
+
+
+class _TimedQuery:
+    """Proxy over a postgrest builder chain; .execute() is timed into SUPABASE_LATENCY."""
+
+    def __init__(self, target, table: str, op: str = ""):
+        self._target, self._table, self._op = target, table, op
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name == "execute":
+            def execute(*a, **kw):
+                with SUPABASE_LATENCY.time(table=self._table, op=self._op or "query"):
+                    return attr(*a, **kw)
+            return execute
+        if not callable(attr):
+            return attr
+        op = self._op or (name if name in _SUPABASE_OPS else "")
+
+        def call(*a, **kw):
+            return _TimedQuery(attr(*a, **kw), self._table, op)
+        return call
+
+
+class _TimedClient:
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name: str):
+        return _TimedQuery(self._client.table(name), name)
+
+    def rpc(self, fn: str, *a, **kw):
+        return _TimedQuery(self._client.rpc(fn, *a, **kw), fn, "rpc")
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def instrument_supabase(client):
+    return _TimedClient(client)
@@ -1,6 +1,6 @@
 """
 GodLocal API Backend — Flask / Gunicorn for Render
-Routes: /health /status /mobile/status /mobile/kill-switch /market /think /agent/tick
+Routes: /health /status /mobile/status /mobile/kill-switch /market /think /agent/tick /metrics /admin/profile
         /hitl/task  /hitl/tasks
         /ws/oasis   WebSocket — streams thinking + token events to Oasis UI
 
@@ -14,6 +14,7 @@ import requests
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from datetime import datetime
+import metrics, tracing, state
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("godlocal.server")
@@ -22,15 +23,31 @@ app = Flask(__name__)
 CORS(app)
 
 # -- State ------------------------------------------------------------------
-_lock         = threading.Lock()
-_kill_switch  = os.environ.get("XZERO_KILL_SWITCH", "false").lower() == "true"
-_thoughts: list = []
-_sparks:   list = []
-_market_cache: dict = {"data": None, "ts": 0.0}
+# Kill switch, thoughts, sparks and the market snapshot live in the state
+# backend (STATE_BACKEND=sqlite shares them between Gunicorn workers).
+_state        = state.open_state()
+_KILL_DEFAULT = os.environ.get("XZERO_KILL_SWITCH", "false").lower() == "true"
+MAX_THOUGHTS, MAX_SPARKS, MARKET_TTL = 20, 50, 300
+_market_stats: dict = {"hits": 0, "misses": 0}
+
+def kill_switch() -> bool:
+    return bool(_state.get("xzero", "kill_switch", _KILL_DEFAULT))
+
+def set_kill_switch(active: bool) -> bool:
+    _state.set("xzero", "kill_switch", bool(active))
+    return bool(active)
+
+def recent(name: str, n: int) -> list:
+    """Newest n entries of "thoughts" or "sparks"."""
+    return _state.get("xzero", name, [])[-n:]
+metrics.register_cache("market", lambda: dict(_market_stats))
 
 GROQ_KEY      = os.environ.get("GROQ_API_KEY", "")
 COMPOSIO_KEY  = os.environ.get("COMPOSIO_API_KEY", "")
 MODELS        = ["llama-3.3-70b-versatile", "llama-3.1-8b-instant", "llama3-8b-8192"]
+GROQ_BASE_URL      = os.environ.get("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+COINGECKO_BASE_URL = os.environ.get("COINGECKO_BASE_URL", "https://api.coingecko.com/api/v3")
+COMPOSIO_BASE_URL  = os.environ.get("COMPOSIO_BASE_URL", "https://backend.composio.dev/api/v2")
 
 # -- HITL bootstrap ---------------------------------------------------------
 _HITL_READY   = False
@@ -90,7 +107,7 @@ def _fire_and_forget_tweet(text: str):
         return
     try:
         requests.post(
-            "https://backend.composio.dev/api/v2/actions/TWITTER_CREATION_OF_A_POST/execute",
+            f"{COMPOSIO_BASE_URL}/actions/TWITTER_CREATION_OF_A_POST/execute",
             json={"input": {"text": text}},
             headers={"x-api-key": COMPOSIO_KEY, "Content-Type": "application/json"},
             timeout=15,
@@ -100,19 +117,21 @@ def _fire_and_forget_tweet(text: str):
 
 # -- Market -----------------------------------------------------------------
 def get_market():
-    now = time.time()
-    if now - _market_cache["ts"] < 300 and _market_cache["data"]:
-        return _market_cache["data"]
+    now    = time.time()
+    cached = _state.get("xzero", "market")
+    if cached and cached["data"] and now - cached["ts"] < MARKET_TTL:
+        _market_stats["hits"] += 1
+        return cached["data"]
+    _market_stats["misses"] += 1
     try:
         r = requests.get(
-            "https://api.coingecko.com/api/v3/simple/price",
+            f"{COINGECKO_BASE_URL}/simple/price",
             params={"ids": "bitcoin,ethereum,solana,binancecoin,sui",
                     "vs_currencies": "usd", "include_24hr_change": "true"},
             timeout=8,
         )
         data = r.json()
-        _market_cache["data"] = data
-        _market_cache["ts"]   = now
+        _state.set("xzero", "market", {"data": data, "ts": now})
         return data
     except Exception as e:
         return {"error": str(e)}
@@ -131,16 +150,23 @@ def groq_call(messages, tools=None, idx=0):
     if tools:
         body["tools"]       = tools
         body["tool_choice"] = "auto"
+    t0 = time.perf_counter()
     try:
-        r = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            json=body, headers=headers, timeout=30,
-        )
+        with tracing.span("groq", model=MODELS[idx]) as attrs:
+            r = requests.post(
+                f"{GROQ_BASE_URL}/chat/completions",
+                json=body, headers=headers, timeout=30,
+            )
+            if r.status_code != 429:
+                r.raise_for_status()
+            attrs["outcome"] = "rate_limited" if r.status_code == 429 else "ok"
+        metrics.GROQ_LATENCY.observe(time.perf_counter() - t0, model=MODELS[idx], outcome=attrs["outcome"])
         if r.status_code == 429:
             return groq_call(messages, tools, idx + 1)
-        r.raise_for_status()
         return r.json(), None
     except Exception as e:
+        outcome = "timeout" if isinstance(e, requests.Timeout) else "error"
+        metrics.GROQ_LATENCY.observe(time.perf_counter() - t0, model=MODELS[idx], outcome=outcome)
         return groq_call(messages, tools, idx + 1) if idx < len(MODELS) - 1 else (None, str(e))
 
 # -- Tool schemas -----------------------------------------------------------
@@ -201,30 +227,30 @@ def all_tools():
 
 # -- Tool executor ----------------------------------------------------------
 def run_tool(name, args):
-    global _kill_switch
+    with metrics.TOOL_LATENCY.time(tool=name), tracing.span("tool", tool=name):
+        return _run_tool(name, args)
+
+def _run_tool(name, args):
     if name == "get_market_data":
         return json.dumps(get_market())
     if name == "get_system_status":
-        return json.dumps({"kill_switch": _kill_switch,
+        return json.dumps({"kill_switch": kill_switch(),
                            "hitl_ready": _HITL_READY,
-                           "sparks": len(_sparks), "thoughts": len(_thoughts)})
+                           "sparks": len(recent("sparks", MAX_SPARKS)),
+                           "thoughts": len(recent("thoughts", MAX_THOUGHTS))})
     if name == "get_recent_thoughts":
-        return json.dumps(_thoughts[-5:])
+        return json.dumps(recent("thoughts", 5))
     if name == "set_kill_switch":
-        with _lock:
-            _kill_switch = bool(args.get("active", False))
-        return json.dumps({"ok": True, "kill_switch": _kill_switch})
+        return json.dumps({"ok": True, "kill_switch": set_kill_switch(args.get("active", False))})
     if name == "add_spark":
         spark = {**args, "ts": datetime.utcnow().isoformat()}
-        with _lock:
-            _sparks.append(spark)
-            if len(_sparks) > 50: _sparks.pop(0)
+        _state.push("xzero", "sparks", spark, MAX_SPARKS)
         return json.dumps({"ok": True, "spark": spark})
 
     if not COMPOSIO_KEY:
         return json.dumps({"error": "COMPOSIO_API_KEY not set"})
     headers = {"x-api-key": COMPOSIO_KEY, "Content-Type": "application/json"}
-    base = "https://backend.composio.dev/api/v2/actions"
+    base = f"{COMPOSIO_BASE_URL}/actions"
     try:
         if name == "post_tweet":
             text = args.get("text", "")
@@ -272,6 +298,10 @@ def react(prompt, history=None, ws_emit=None):
     Called with ('thinking', text) before each step and ('tool_done', result)
     after each tool call, so Oasis can display live reasoning.
     """
+    with tracing.trace("react"):
+        return _react(prompt, history, ws_emit)
+
+def _react(prompt, history=None, ws_emit=None):
     now_str = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
     msgs = [{"role": "system", "content":
         f"You are GodLocal autonomous AI agent.\n"
@@ -287,7 +317,8 @@ def react(prompt, history=None, ws_emit=None):
     used_model = MODELS[0]
     for step in range(8):
         force_text = (step == 7)
-        resp, err = groq_call(msgs, tools=None if force_text else tools)
+        with tracing.span("llm.step", step=step):
+            resp, err = groq_call(msgs, tools=None if force_text else tools)
         if err or not resp:
             if ws_emit:
                 ws_emit("thinking", f"[error] {err}")
@@ -311,11 +342,9 @@ def react(prompt, history=None, ws_emit=None):
                              "content": result})
         else:
             text = msg.get("content") or ""
-            with _lock:
-                _thoughts.append({"text": text[:200],
-                                  "ts": datetime.utcnow().isoformat(),
-                                  "model": used_model})
-                if len(_thoughts) > 20: _thoughts.pop(0)
+            _state.push("xzero", "thoughts", {"text": text[:200],
+                                              "ts": datetime.utcnow().isoformat(),
+                                              "model": used_model}, MAX_THOUGHTS)
             return text, steps, used_model
     return "Internal error", steps, used_model
 
@@ -369,6 +398,14 @@ if _WS_AVAILABLE:
     @sock.route("/ws/oasis")
     def ws_oasis(ws):
         """Stream thinking + tokens to Oasis UI in real time."""
+        metrics.WS_OPENED.inc(endpoint="/ws/oasis")
+        metrics.WS_CONNECTIONS.inc(endpoint="/ws/oasis")
+        try:
+            _ws_oasis(ws)
+        finally:
+            metrics.WS_CONNECTIONS.dec(endpoint="/ws/oasis")
+
+    def _ws_oasis(ws):
         while True:
             try:
                 raw = ws.receive()
@@ -382,7 +419,10 @@ if _WS_AVAILABLE:
 
                 def emit(t, v=""):
                     try:
-                        ws.send(json.dumps({"t": t, "v": v}))
+                        frame = json.dumps({"t": t, "v": v})
+                        ws.send(frame)
+                        metrics.WS_FRAMES.inc(endpoint="/ws/oasis")
+                        metrics.WS_BYTES.inc(len(frame), endpoint="/ws/oasis")
                     except Exception:
                         pass
 
@@ -392,7 +432,8 @@ if _WS_AVAILABLE:
                 prompt = message or "[Image] Describe this."
 
                 emit("thinking_start")
-                response_text, steps, model = react(prompt, ws_emit=ws_emit)
+                with tracing.trace("ws.oasis") as tr:
+                    response_text, steps, model = react(prompt, ws_emit=ws_emit)
                 emit("thinking_done")
 
                 # Stream response word-by-word
@@ -401,6 +442,8 @@ if _WS_AVAILABLE:
                     emit("token", word + (" " if i < len(words) - 1 else ""))
 
                 emit("done")
+                if data.get("debug"):
+                    emit("trace", tr.timeline())
 
             except Exception as e:
                 try:
@@ -423,25 +466,48 @@ def health():
 @app.route("/status",         methods=["GET"])
 @app.route("/mobile/status",  methods=["GET"])
 def status():
-    return jsonify({"kill_switch": _kill_switch,
+    return jsonify({"kill_switch": kill_switch(),
                     "hitl_ready":  _HITL_READY,
-                    "sparks":      _sparks[-10:],
-                    "thoughts":    _thoughts[-5:],
-                    "market":      _market_cache.get("data"),
+                    "sparks":      recent("sparks", 10),
+                    "thoughts":    recent("thoughts", 5),
+                    "market":      (_state.get("xzero", "market") or {}).get("data"),
                     "ts":          datetime.utcnow().isoformat()})
 
 @app.route("/mobile/kill-switch", methods=["POST"])
 def kill_switch_toggle():
-    global _kill_switch
     data = request.get_json() or {}
-    with _lock:
-        _kill_switch = bool(data.get("active", False))
-    return jsonify({"ok": True, "kill_switch": _kill_switch})
+    return jsonify({"ok": True, "kill_switch": set_kill_switch(data.get("active", False))})
 
 @app.route("/market", methods=["GET"])
 def market():
     return jsonify(get_market())
 
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+@app.route("/admin/profile", methods=["GET"])
+def admin_profile():
+    """
+    Sample all thread stacks (?seconds=5&interval_ms=10&idle=0) and return
+    collapsed stacks for flamegraph.pl / speedscope; ?format=json for counts.
+    Needs ADMIN_TOKEN via X-Admin-Token or Authorization: Bearer. Only
+    useful with a threaded server: a sync worker has nothing else to sample.
+    """
+    token = request.headers.get("X-Admin-Token") or request.headers.get("Authorization")
+    if not tracing.admin_allowed(token):
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        report = tracing.sample_stacks(float(request.args.get("seconds", 5)),
+                                       float(request.args.get("interval_ms", 10)) / 1000,
+                                       request.args.get("idle", "0") in ("1", "true"))
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    if request.args.get("format") == "json":
+        return jsonify(report)
+    return report["collapsed"], 200, {"Content-Type": "text/plain; charset=utf-8",
+                                      "X-Samples": str(report["samples"])}
+
 @app.route("/ping", methods=["GET"])
 def ping():
     return jsonify({"pong": True})
@@ -453,10 +519,15 @@ def think():
     history = data.get("history", [])
     if not prompt:
         return jsonify({"error": "prompt required"}), 400
-    response, steps, model = react(prompt, history)
-    follow_up = generate_follow_up(prompt, response)
-    return jsonify({"response": response, "steps": steps,
-                    "model": model, "follow_up_questions": follow_up})
+    with tracing.trace("think") as tr:
+        response, steps, model = react(prompt, history)
+        with tracing.span("follow_up"):
+            follow_up = generate_follow_up(prompt, response)
+    out = {"response": response, "steps": steps,
+           "model": model, "follow_up_questions": follow_up}
+    if data.get("debug") or request.args.get("debug"):
+        out["trace"] = tr.timeline()
+    return jsonify(out)
 
 @app.route("/agent/tick", methods=["GET", "POST"])
 def tick():
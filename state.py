@@ -0,0 +1,147 @@
+"""
+GodLocal shared state — small JSON key/value namespaces for app.py and server.py
+==============================================================================
+Profiles, user keys, the kill switch, recent thoughts/sparks and the market
+snapshot used to live in module-level dicts, so every worker process had its
+own copy. open_state() picks where they live instead:
+
+  STATE_BACKEND=memory   in-process dicts (default; one worker)
+  STATE_BACKEND=sqlite   one SQLite file in WAL mode (STATE_DB_PATH), shared by
+                         every worker on the host — run one worker per core
+
+  st = state.open_state()
+  st.set("profiles", sid, {...});  st.get("profiles", sid, {})
+  st.update("user_keys", sid, lambda keys: {**keys, "X": "y"}, {})   # atomic
+  st.push("sparks", "all", spark, cap=50);  st.incr("mem_version", sid)
+
+Values are anything json.dumps accepts. update() is a read-modify-write under
+one lock (memory) or one BEGIN IMMEDIATE transaction (sqlite), so concurrent
+writers in different processes never lose each other's changes.
+"""
+import os, json, logging, threading
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger("godlocal.state")
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory").lower()    # memory | sqlite
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "godlocal_state.db")
+
+
+class StateBackend(ABC):
+    """get/set/delete/update per (namespace, key); push and incr are built on update."""
+    shared = False
+
+    @abstractmethod
+    def get(self, ns: str, key: str, default=None): ...
+
+    @abstractmethod
+    def set(self, ns: str, key: str, value): ...
+
+    @abstractmethod
+    def delete(self, ns: str, key: str): ...
+
+    @abstractmethod
+    def update(self, ns: str, key: str, fn, default=None):
+        """Atomically replace the value with fn(current or default); returns the new value."""
+
+    def push(self, ns: str, key: str, item, cap: int) -> list:
+        """Append to a list value, keeping only the newest `cap` items."""
+        return self.update(ns, key, lambda items: (items + [item])[-cap:], [])
+
+    def incr(self, ns: str, key: str, amount: int = 1) -> int:
+        return self.update(ns, key, lambda n: n + amount, 0)
+
+    def snapshot(self) -> dict:
+        return {"backend": type(self).__name__, "shared": self.shared}
+
+
+class InProcessState(StateBackend):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: dict = {}    # ns -> {key: value}
+
+    def get(self, ns: str, key: str, default=None):
+        with self._lock:
+            return self._data.get(ns, {}).get(key, default)
+
+    def set(self, ns: str, key: str, value):
+        with self._lock:
+            self._data.setdefault(ns, {})[key] = value
+
+    def delete(self, ns: str, key: str):
+        with self._lock:
+            self._data.get(ns, {}).pop(key, None)
+
+    def update(self, ns: str, key: str, fn, default=None):
+        with self._lock:
+            space = self._data.setdefault(ns, {})
+            value = space[key] = fn(space.get(key, default))
+            return value
+
+
+class SQLiteState(StateBackend):
+    """
+    One row per (ns, key) with a JSON value. Each thread (and each forked
+    worker) opens its own connection; WAL lets readers run alongside the single
+    writer and busy_timeout queues writers instead of failing with SQLITE_BUSY.
+    """
+    shared = True
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._conn().execute("""create table if not exists state (
+            ns text not null, key text not null, value text not null,
+            primary key (ns, key)) without rowid""")
+
+    def _conn(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():    # never reuse a connection across fork
+            import sqlite3
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=self.busy_timeout_ms / 1000)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def get(self, ns: str, key: str, default=None):
+        row = self._conn().execute("select value from state where ns=? and key=?", (ns, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, ns: str, key: str, value):
+        self._conn().execute("insert or replace into state values (?,?,?)",
+                             (ns, key, json.dumps(value, ensure_ascii=False)))
+
+    def delete(self, ns: str, key: str):
+        self._conn().execute("delete from state where ns=? and key=?", (ns, key))
+
+    def update(self, ns: str, key: str, fn, default=None):
+        db = self._conn()
+        db.execute("begin immediate")     # take the write lock before reading
+        try:
+            row   = db.execute("select value from state where ns=? and key=?", (ns, key)).fetchone()
+            value = fn(json.loads(row[0]) if row else default)
+            db.execute("insert or replace into state values (?,?,?)",
+                       (ns, key, json.dumps(value, ensure_ascii=False)))
+            db.execute("commit")
+        except BaseException:
+            db.execute("rollback")
+            raise
+        return value
+
+    def snapshot(self) -> dict:
+        return {**super().snapshot(), "path": self.path}
+
+
+def open_state(backend: str = STATE_BACKEND, path: str = STATE_DB_PATH) -> StateBackend:
+    """The configured backend; falls back to in-process state if the shared one can't be opened."""
+    if backend == "sqlite":
+        try:
+            return SQLiteState(path)
+        except Exception as e:
+            logger.warning(f"State backend sqlite unavailable ({path}), keeping state in-process: {e}")
+    elif backend != "memory":
+        logger.warning(f"Unknown STATE_BACKEND {backend!r}, keeping state in-process")
+    return InProcessState()
@@ -0,0 +1,18 @@
+-- GodLocal agent memories (app.py SupabaseMemoryBackend, MEMORY_BACKEND=supabase)
+-- Run in Supabase SQL Editor
+
+create table if not exists memories (
+  session_id  text   not null,
+  id          text   not null,
+  content     text   not null,
+  ts          bigint not null,            -- unix epoch, milliseconds
+  type        text   not null default 'fact',   -- 'fact' (remember tool) | 'qa' (auto summary)
+  primary key (session_id, id)
+);
+
+-- MemoryStore loads the newest MEMORY_PER_SESSION rows of a session
+create index if not exists idx_memories_session_ts
+  on memories (session_id, ts desc);
+
+-- RLS on with no policies: only the service key (which bypasses RLS) can read/write
+alter table memories enable row level security;
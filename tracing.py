@@ -0,0 +1,201 @@
+"""
+GodLocal tracing — per-request span timelines and a sampling profiler
+=====================================================================
+Shared by app.py (FastAPI) and server.py (Flask).
+
+  with tracing.trace("ws.oasis", sid=sid) as tr:   # one per request
+      with tracing.span("groq", model=m) as attrs:   # anywhere below it
+          attrs["outcome"] = "ok"
+  tr.timeline()  # → [{"name", "at_ms", "ms", "depth", ...attrs}]
+
+The active trace and parent span live in contextvars, so asyncio tasks spawned
+inside a request inherit them and span() outside a trace is a no-op. The
+profiler samples sys._current_frames() and returns collapsed stacks
+(`frame;frame;frame count`) that flamegraph.pl / speedscope read directly.
+"""
+import os, sys, time, hmac, logging, threading, itertools
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger("godlocal.tracing")
+
+ADMIN_TOKEN     = os.environ.get("ADMIN_TOKEN", "")
+TRACE_SLOW_MS   = float(os.environ.get("TRACE_SLOW_MS", "15000"))   # log traces slower than this
+TRACE_MAX_SPANS = 500
+PROFILE_MAX_SECONDS = 60.0
+
+_trace:  ContextVar = ContextVar("godlocal_trace", default=None)
+_parent: ContextVar = ContextVar("godlocal_span", default=0)
+_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ("id", "parent", "name", "start", "end", "attrs")
+
+    def __init__(self, name: str, parent: int, attrs: dict):
+        self.id, self.parent, self.name = next(_ids), parent, name
+        self.start, self.end, self.attrs = time.perf_counter(), None, attrs
+
+
+class Trace:
+    def __init__(self, name: str, attrs: dict):
+        self.name  = name
+        self.t0    = time.perf_counter()
+        self.spans: list = []
+        self.dropped = 0
+        self.root  = self._open(name, 0, attrs)
+
+    def _open(self, name: str, parent: int, attrs: dict) -> Span:
+        sp = Span(name, parent, attrs)
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append(sp)     # list.append is atomic; spans may close on other tasks
+        else:
+            self.dropped += 1
+        return sp
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.root.end or time.perf_counter()
+        return (end - self.t0) * 1000
+
+    def timeline(self) -> list:
+        parent = {sp.id: sp.parent for sp in self.spans}
+        depth  = {0: -1}
+
+        def depth_of(sid: int) -> int:
+            if sid not in depth:
+                depth[sid] = depth_of(parent.get(sid, 0)) + 1
+            return depth[sid]
+
+        out = []
+        for sp in sorted(self.spans, key=lambda s: s.start):
+            depth_of(sp.id)
+            end = sp.end if sp.end is not None else time.perf_counter()
+            out.append({"name": sp.name, "at_ms": round((sp.start - self.t0) * 1000, 1),
+                        "ms": round((end - sp.start) * 1000, 1), "depth": depth[sp.id],
+                        **({"open": True} if sp.end is None else {}), **sp.attrs})
+        return out
+
+    def summary(self) -> str:
+        top = sorted((s for s in self.spans if s is not self.root and s.end),
+                     key=lambda s: s.end - s.start, reverse=True)[:5]
+        parts = ", ".join(f"{s.name}={(s.end - s.start) * 1000:.0f}ms" for s in top)
+        return f"{self.name} {self.duration_ms:.0f}ms [{parts}]"
+
+
+def current() -> Trace | None:
+    return _trace.get()
+
+
+@contextmanager
+def trace(name: str, **attrs):
+    """Start a request trace; nested trace() calls join the outer one as a span."""
+    if _trace.get() is not None:
+        with span(name, **attrs):
+            yield _trace.get()
+        return
+    tr = Trace(name, attrs)
+    t_token, p_token = _trace.set(tr), _parent.set(tr.root.id)
+    try:
+        yield tr
+    except BaseException as e:
+        tr.root.attrs.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        tr.root.end = time.perf_counter()
+        _parent.reset(p_token)
+        _trace.reset(t_token)
+        if tr.duration_ms >= TRACE_SLOW_MS:
+            logger.warning(f"Slow request: {tr.summary()}")
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Time a block under the active trace; yields its attrs dict for annotating results."""
+    tr = _trace.get()
+    if tr is None:
+        yield attrs
+        return
+    sp = tr._open(name, _parent.get(), attrs)
+    token = _parent.set(sp.id)
+    try:
+        yield sp.attrs
+    except BaseException as e:
+        sp.attrs.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        sp.end = time.perf_counter()
+        _parent.reset(token)
+
+
+def record(name: str, seconds: float, **attrs):
+    """Add an already-finished span that ended now and lasted `seconds` (for callers that only know the latency)."""
+    tr = _trace.get()
+    if tr is None:
+        return
+    sp = tr._open(name, _parent.get(), attrs)
+    sp.end   = time.perf_counter()
+    sp.start = sp.end - seconds
+
+
+def mark(name: str, **attrs):
+    """Zero-length event on the active trace (e.g. "first_token")."""
+    with span(name, **attrs):
+        pass
+
+
+# ── Admin / profiler ──────────────────────────────────────────────────────────
+
+def admin_allowed(token: str | None) -> bool:
+    """True when ADMIN_TOKEN is configured and `token` (header value, "Bearer " optional) matches."""
+    if not ADMIN_TOKEN or not token:
+        return False
+    if token.startswith("Bearer "):
+        token = token[7:]
+    return hmac.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode())
+
+
+_IDLE_LEAVES = {"select", "poll", "wait", "_wait_for_tstate_lock", "_worker", "accept"}
+_profile_lock = threading.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float = 0.01, include_idle: bool = False) -> dict:
+    """
+    Sample every thread's stack for `seconds`; returns {"collapsed": str, "samples": n, ...}.
+    Blocks the calling thread, so run it off the event loop. One profile at a time.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("a profile is already running")
+    try:
+        seconds  = max(0.1, min(float(seconds), PROFILE_MAX_SECONDS))
+        interval = max(0.001, float(interval))
+        me       = threading.get_ident()
+        counts   = Counter()
+        rounds   = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                if not include_idle and frame.f_code.co_name in _IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(tid, f"thread-{tid}"))
+                counts[";".join(reversed(stack))] += 1
+            rounds += 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+    collapsed = "\n".join(f"{stack} {n}" for stack, n in counts.most_common())
+    return {"seconds": seconds, "interval_ms": interval * 1000, "rounds": rounds,
+            "samples": sum(counts.values()), "collapsed": collapsed + "\n" if collapsed else ""}